@@ -7,18 +7,22 @@ import PriceSource
 from PriceSource import PriceSourceError
 import cache
 import settings
+import transport
 
 from core import _log_error
 from settings import get_setting, set_setting, has_creds
 
 from functools import partial
-import networkx as nx
 
 import string
 import threading
 import multiprocessing
+from multiprocessing import TimeoutError
 import time
+import heapq
+import itertools
 import math
+from collections import defaultdict, deque
 
 import requests.exceptions
 
@@ -26,20 +30,170 @@ class PriceNetworkError(PriceSource.PriceSourceError):
     pass
 
 
+# Marks threads belonging to a PriceNetwork fetch pool.
+_fetch_worker = threading.local()
+
+
+class _FetchResult(object):
+    """
+    The price a fetch pool worker fetched, once it is done.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+
+    def _set(self, value, error=None):
+        self._value = value
+        self._error = error
+        self._done.set()
+
+
+    def get(self, timeout):
+        """
+        Returns the price, raising TimeoutError if it isn't fetched
+        within timeout seconds, or the error the fetch raised.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError()
+        if self._error:
+            raise self._error
+        return self._value
+
+
+class _FetchPool(object):
+    """
+    Worker threads fetching prices from sources. Queued fetches run in
+    request priority order, and background fetches are kept off the
+    last reserved workers, so interactive fetches don't queue behind a
+    background sweep whose fetches are waiting on rate limits.
+    """
+
+    def __init__(self, workers, reserved):
+        self._cond = threading.Condition()
+        self._queue = [] # heap of (priority, seq, fn, args, deadline, result)
+        self._seq = itertools.count()
+        self._max_background = max(1, workers - reserved)
+        self._num_background = 0
+        self._interactive = transport.INTERACTIVE
+        self._closed = False
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name="price fetch worker")
+            thread.daemon = True
+            thread.start()
+
+
+    def apply_async(self, priority, fn, args, deadline=None):
+        """
+        Queues fn(*args) and returns a _FetchResult for it. If it isn't
+        started by deadline, it is dropped and its result is None.
+        """
+        result = _FetchResult()
+        with self._cond:
+            if self._closed:
+                result._set(None)
+                return result
+            heapq.heappush(self._queue, (priority, next(self._seq), fn, args, deadline, result))
+            self._cond.notify_all()
+        return result
+
+
+    def close(self):
+        """
+        Stops the worker threads once they finish their current fetch.
+        Fetches still queued are dropped.
+        """
+        with self._cond:
+            self._closed = True
+            while self._queue:
+                heapq.heappop(self._queue)[-1]._set(None)
+            self._cond.notify_all()
+
+
+    def _next_task(self):
+        """
+        Returns the next task to run, or None once the pool is closed.
+        """
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                if self._queue:
+                    priority = self._queue[0][0]
+                    if (priority <= self._interactive or
+                        self._num_background < self._max_background):
+                        break
+                self._cond.wait()
+            task = heapq.heappop(self._queue)
+            if task[0] > self._interactive:
+                self._num_background += 1
+            return task
+
+
+    def _work(self):
+        _fetch_worker.active = True
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            priority, seq, fn, args, deadline, result = task
+            try:
+                if deadline is not None and time.time() >= deadline:
+                    # nobody waits for it anymore
+                    result._set(None)
+                else:
+                    result._set(fn(*args))
+            except Exception as e:
+                result._set(None, e)
+            finally:
+                if priority > self._interactive:
+                    with self._cond:
+                        self._num_background -= 1
+                        self._cond.notify_all()
+
+
+def _split_cached_price(cached):
+    """
+    Returns the (price, fetch time) of a price from the shared cache.
+    Prices cached by earlier versions are plain floats, taken as fetched
+    now.
+    """
+    if isinstance(cached, (list, tuple)):
+        return float(cached[0]), float(cached[1])
+    return float(cached), time.time()
+
+
 class PriceNetwork(PriceSource.PriceSource):
 
     def __init__(self):
         super(PriceNetwork, self).__init__()
         self._lock = threading.RLock()
         self._sources = []
-        self.init_sources()
+        self._fetch_pool = None
+        self._closed = False
 
         self._price_graph = None
+        self._routes = {}
+        self._edge_sources = defaultdict(set)
+        self._pending_diffs = deque()
+        self._markets_requested = {} # id(source) -> last time asked to publish
+        self._edge_rates = {}
+        self._edge_rates_lock = threading.Lock()
+
+        self.init_sources()
 
 
     def init_sources(self):
         with self._lock:
+            for source in self._sources:
+                source.remove_markets_listener(self._on_markets_changed)
             self._sources = []
+            self._price_graph = None
+            self._routes = {}
+            self._edge_sources = defaultdict(set)
+            self._markets_requested = {}
             for source_name in get_setting("options", "price_sources",
                                            default=["Bitfinex", "Bittrex",
                                                     "Poloniex", "Conversions",
@@ -47,7 +201,9 @@ class PriceNetwork(PriceSource.PriceSource):
                 if hasattr(PriceSource, source_name):
                     Source = getattr(PriceSource, source_name)
                     if not Source.requires_creds() or has_creds(Source.__name__):
-                        self._sources.append(Source())
+                        source = Source()
+                        source.add_markets_listener(self._on_markets_changed)
+                        self._sources.append(source)
 
                     
     def get_sources(self):
@@ -55,27 +211,196 @@ class PriceNetwork(PriceSource.PriceSource):
 
 
     def add_source(self, source):
+        """
+        Adds a source and its markets to the price network.
+        """
+        symbols = source.get_symbols()
+        markets = source.get_markets()
         G = self._get_price_graph()
         with self._lock:
-            G.add_nodes_from(source.get_symbols())
             self._sources.append(source)
-            for mkt in source.get_markets():
+            source.add_markets_listener(self._on_markets_changed)
+            G.add_nodes_from(symbols)
+            self._apply_markets_diff(G, source, markets, [])
+
+
+    def remove_source(self, source):
+        """
+        Removes a source from the price network along with any
+        markets that only it was providing.
+        """
+        G = self._get_price_graph()
+        with self._lock:
+            if not source in self._sources:
+                return
+            self._sources.remove(source)
+            source.remove_markets_listener(self._on_markets_changed)
+            self._markets_requested.pop(id(source), None)
+            removed = [edge for edge, ids in self._edge_sources.iteritems()
+                       if id(source) in ids]
+            self._apply_markets_diff(G, source, [], ["/".join(edge) for edge in removed])
+
+
+    def _on_markets_changed(self, source, added, removed):
+        """
+        Market change listener registered with every source. Diffs are
+        queued here and applied the next time the graph is used, so a
+        source never waits on the network lock while publishing.
+        """
+        self._pending_diffs.append((source, added, removed))
+
+
+    def _apply_pending_diffs(self, G):
+        """
+        Applies any queued market diffs to the price graph and routes.
+        """
+        with self._lock:
+            while self._pending_diffs:
+                source, added, removed = self._pending_diffs.popleft()
+                if source in self._sources:
+                    self._apply_markets_diff(G, source, added, removed)
+
+
+    def _apply_markets_diff(self, G, source, added, removed):
+        """
+        Records which source provides each market edge, adding edges new
+        to the graph and dropping edges no source provides anymore.
+        """
+        with self._lock:
+            new_edges = []
+            for mkt in added:
                 from_mkt, to_mkt = mkt.split("/")
-                G.add_edge(from_mkt, to_mkt)
-    
+                edge = tuple(sorted((from_mkt, to_mkt)))
+                self._edge_sources[edge].add(id(source))
+                new_edges.append(edge)
+            stale_edges = []
+            for mkt in removed:
+                from_mkt, to_mkt = mkt.split("/")
+                edge = tuple(sorted((from_mkt, to_mkt)))
+                if not edge in self._edge_sources:
+                    continue
+                self._edge_sources[edge].discard(id(source))
+                if not self._edge_sources[edge]:
+                    del self._edge_sources[edge]
+                    stale_edges.append(edge)
+            self._add_edges(G, new_edges)
+            self._remove_edges(G, stale_edges)
+
 
     def _get_price_graph(self):
-        markets = self.get_markets()
+        with self._lock:
+            if self._price_graph:
+                self._apply_pending_diffs(self._price_graph)
+                return self._price_graph
+            # diffs published before now are covered by the markets below
+            self._pending_diffs.clear()
+            sources = list(self._sources)
+        source_markets = []
+        for source in sources:
+            try:
+                source_markets.append((source, source.get_markets()))
+            except Exception as e:
+                _log_error(['PriceNetwork.get_markets',
+                            source._class_name(), str(e)])
+        symbols = self.get_symbols()
+        base_symbols = self.get_base_symbols()
         with self._lock:
           if not self._price_graph:
+              import networkx as nx
               G = nx.Graph()
-              G.add_nodes_from(self.get_symbols())
-              for mkt in markets:
-                  from_mkt, to_mkt = mkt.split("/")
-                  G.add_edge(from_mkt, to_mkt)
+              G.add_nodes_from(symbols)
               self._price_graph = G
+              self._edge_sources = defaultdict(set)
+              for source, markets in source_markets:
+                  self._apply_markets_diff(G, source, markets, [])
+              self._build_routes(G, base_symbols)
+          self._apply_pending_diffs(self._price_graph)
         return self._price_graph
-    
+
+
+    def _compute_routes(self, G, root):
+        """
+        Returns a dict mapping every node reachable from root to the
+        shortest path from root to that node.
+        """
+        import networkx as nx
+        paths = nx.single_source_shortest_path(G, root)
+        return dict((target, tuple(path)) for target, path in paths.iteritems())
+
+
+    def _build_routes(self, G, roots):
+        """
+        Precomputes the route table for each of the root symbols.
+        """
+        with self._lock:
+            self._routes = {}
+            for root in roots:
+                if root in G:
+                    self._routes[root] = self._compute_routes(G, root)
+
+
+    def _add_edges(self, G, edges):
+        """
+        Adds edges to the price graph and recomputes the routes of any
+        root whose shortest paths the new edges can change.
+        """
+        with self._lock:
+            new_edges = [(u, v) for u, v in edges if not G.has_edge(u, v)]
+            G.add_edges_from(new_edges)
+            for root, routes in self._routes.items():
+                for u, v in new_edges:
+                    if not u in routes and not v in routes:
+                        continue
+                    if not u in routes or not v in routes or \
+                       abs(len(routes[u]) - len(routes[v])) > 1:
+                        self._routes[root] = self._compute_routes(G, root)
+                        break
+
+
+    def _remove_edges(self, G, edges):
+        """
+        Removes edges from the price graph, drops nodes left without any
+        markets and recomputes the routes of any root that used the edges.
+        """
+        with self._lock:
+            old_edges = [(u, v) for u, v in edges if G.has_edge(u, v)]
+            G.remove_edges_from(old_edges)
+            with self._edge_rates_lock:
+                for edge in old_edges:
+                    self._edge_rates.pop(tuple(sorted(edge)), None)
+            for u, v in old_edges:
+                for node in (u, v):
+                    if node in G and G.degree(node) == 0:
+                        G.remove_node(node)
+                        self._routes.pop(node, None)
+            for root, routes in self._routes.items():
+                for u, v in old_edges:
+                    if routes.get(v) == routes.get(u, ()) + (v,) or \
+                       routes.get(u) == routes.get(v, ()) + (u,):
+                        self._routes[root] = self._compute_routes(G, root)
+                        break
+
+
+    def get_route(self, from_asset, to_asset):
+        """
+        Returns the shortest path from_asset to_asset from the route table,
+        or None if there isn't one. Routes from symbols that aren't yet in
+        the table are computed and stored the first time they are needed.
+        """
+        G = self._get_price_graph()
+        with self._lock:
+            if from_asset in self._routes:
+                return self._routes[from_asset].get(to_asset)
+            if to_asset in self._routes:
+                path = self._routes[to_asset].get(from_asset)
+                if path:
+                    path = tuple(reversed(path))
+                return path
+            if not from_asset in G:
+                return None
+            self._routes[from_asset] = self._compute_routes(G, from_asset)
+            return self._routes[from_asset].get(to_asset)
+
 
     def get_symbols(self):
         """
@@ -136,33 +461,218 @@ class PriceNetwork(PriceSource.PriceSource):
         return mkt_srcs
 
     
+    def close(self):
+        """
+        Stops the fetch pool's worker threads and stops listening to the
+        sources' market changes. Prices fetched after this query the
+        sources one at a time.
+        """
+        with self._lock:
+            self._closed = True
+            pool, self._fetch_pool = self._fetch_pool, None
+            for source in self._sources:
+                source.remove_markets_listener(self._on_markets_changed)
+        if pool:
+            pool.close()
+
+
+    def _get_fetch_pool(self):
+        """
+        Returns the worker pool used to query sources in parallel, or
+        None once the network is closed.
+        """
+        with self._lock:
+            if self._closed:
+                return None
+            if not self._fetch_pool:
+                workers = get_setting("options", "price_fetch_workers", default=8)
+                reserved = get_setting("options", "price_fetch_interactive_workers", default=2)
+                self._fetch_pool = _FetchPool(int(workers), int(reserved))
+            return self._fetch_pool
+
+
+    def _fetch_source_price(self, source, from_asset, to_asset):
+        """
+        Queries a single source for the unit price of from_asset/to_asset.
+        Returns None if the source failed to produce a price.
+        """
+        try:
+            return float(source.get_price(from_asset, to_asset, 1.0))
+        except PriceSourceError as e:
+            _log_error(['PriceNetwork._do_get_price',
+                        source._class_name(), str(e)])
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            _log_error(['PriceNetwork._do_get_price',
+                        source._class_name(), str(e)])
+        return None
+
+
+    def _pool_fetch_source_price(self, priority, deadline, source, from_asset, to_asset):
+        """
+        Runs _fetch_source_price from a fetch pool worker thread, making
+        requests with the priority of the thread that asked for it, that
+        give up once it stops waiting for them.
+        """
+        with transport.request_priority(priority), transport.request_deadline(deadline):
+            return self._fetch_source_price(source, from_asset, to_asset)
+
+
+    def _get_market_price_sources(self, from_asset, to_asset):
+        """
+        Returns the sources that list a market for from_asset and to_asset
+        in either direction.
+        """
+        mkt_key = from_asset + "/" + to_asset
+        inv_mkt_key = to_asset + "/" + from_asset
+        with self._lock:
+            sources = list(self._sources)
+        mkt_sources = []
+        for source in sources:
+            try:
+                mkts = source.get_markets()
+                if mkt_key in mkts or inv_mkt_key in mkts:
+                    mkt_sources.append(source)
+            except PriceSourceError as e:
+                _log_error(['PriceNetwork._do_get_price',
+                            source._class_name(), str(e)])
+            except requests.exceptions.ConnectionError as e:
+                _log_error(['PriceNetwork._do_get_price',
+                            source._class_name(), str(e)])
+        return mkt_sources
+
+
+    def _fetch_unit_prices(self, from_asset, to_asset):
+        """
+        Returns the list of unit prices for from_asset/to_asset reported
+        by each source that lists the market. When parallel fetching is
+        enabled, all sources are queried at the same time and any that
+        don't answer within the price_fetch_timeout option are ignored.
+        Their requests time out then too, and fetches that haven't
+        started by then are dropped, so they don't hold on to workers.
+        """
+        sources = self._get_market_price_sources(from_asset, to_asset)
+
+        # Query inline if there is nothing to overlap or if we are already
+        # running on a pool worker (e.g. PortfolioNAV pricing recursively),
+        # since waiting on the pool from one of its own workers can deadlock,
+        # or if the network was closed and has no pool.
+        parallel = get_setting("options", "price_fetch_parallel", default=True)
+        pool = None
+        if parallel and len(sources) > 1 and not getattr(_fetch_worker, "active", False):
+            pool = self._get_fetch_pool()
+        if not pool:
+            prices = [self._fetch_source_price(source, from_asset, to_asset)
+                      for source in sources]
+            return [price for price in prices if price != None]
+
+        timeout = float(get_setting("options", "price_fetch_timeout", default=10))
+        priority = transport.get_request_priority()
+        deadline = time.time() + timeout
+        pending = [(source, pool.apply_async(priority, self._pool_fetch_source_price,
+                                             (priority, deadline, source, from_asset, to_asset),
+                                             deadline))
+                   for source in sources]
+        unit_prices = []
+        for source, result in pending:
+            try:
+                price = result.get(max(0.0, deadline - time.time()))
+            except TimeoutError:
+                _log_error(['PriceNetwork._do_get_price',
+                            source._class_name(),
+                            "timed out after %s seconds" % timeout])
+                continue
+            if price != None:
+                unit_prices.append(price)
+        return unit_prices
+
+
+    def get_edge_rate(self, from_asset, to_asset):
+        """
+        Returns a (rate, num_sources, fetch_time) tuple for the edge between
+        from_asset and to_asset from the edge rate cache, or None if it isn't
+        cached or is older than the cache_price_expiration option. The rate
+        is how much to_asset one from_asset is worth and num_sources is how
+        many sources were averaged to get it, or 0 if it came from the
+        shared cache.
+        """
+        edge = tuple(sorted((from_asset, to_asset)))
+        with self._edge_rates_lock:
+            entry = self._edge_rates.get(edge)
+        if not entry:
+            return None
+        rate, num_sources, fetch_time = entry
+        expire = get_setting("options", "cache_price_expiration", default=60)
+        if expire > 0 and time.time() - fetch_time > expire:
+            return None
+        if edge[0] != from_asset:
+            try:
+                rate = 1.0/rate
+            except ZeroDivisionError:
+                pass
+        return (rate, num_sources, fetch_time)
+
+
+    def _set_edge_rate(self, from_asset, to_asset, rate, num_sources, fetch_time=None):
+        """
+        Stores the rate of from_asset in terms of to_asset in the edge rate
+        cache. One entry per asset pair serves both directions. fetch_time
+        is when the rate was fetched from its sources, now by default, so
+        a rate taken from the shared cache doesn't live longer here.
+        """
+        if fetch_time is None:
+            fetch_time = time.time()
+        edge = tuple(sorted((from_asset, to_asset)))
+        if edge[0] != from_asset:
+            try:
+                rate = 1.0/rate
+            except ZeroDivisionError:
+                pass
+        with self._edge_rates_lock:
+            self._edge_rates[edge] = (rate, num_sources, fetch_time)
+
+
+    def _prefetch_edge_rates(self, edges):
+        """
+        Loads the rates of the (from_asset, to_asset) edges that aren't in
+        the edge rate cache from the shared cache with one batched lookup.
+        Edges that miss there are left for _do_get_price to fetch.
+        """
+        mkt_keys = {}
+        for from_asset, to_asset in edges:
+            if from_asset != to_asset and not self.get_edge_rate(from_asset, to_asset):
+                mkt_keys[from_asset + "/" + to_asset] = (from_asset, to_asset)
+        if not mkt_keys:
+            return
+        expire = get_setting("options", "cache_price_expiration", default=60)
+        for mkt_key, cached in cache.get_many(mkt_keys.keys(), expire).iteritems():
+            from_asset, to_asset = mkt_keys[mkt_key]
+            cached_price, fetch_time = _split_cached_price(cached)
+            self._set_edge_rate(from_asset, to_asset, cached_price, 0, fetch_time)
+
+
     def _do_get_price(self, from_asset, to_asset, amount=1.0):
         """
         Helper function for get_price.
         """
+        # the edge rate cache serves both directions of a market
+        entry = self.get_edge_rate(from_asset, to_asset)
+        if entry:
+            return entry[0] * amount
+
         mkt_key = from_asset + "/" + to_asset
-        inv_mkt_key = to_asset + "/" + from_asset            
 
         do_cache = False
         unit_prices = []
         # return from the cache if it is already available
-        if cache.has_key(mkt_key):
-            unit_prices.append(cache.get_val(mkt_key))
+        expire = get_setting("options", "cache_price_expiration", default=60)
+        cached = cache.get_val(mkt_key, expire)
+        if cached != None:
+            cached_price, fetch_time = _split_cached_price(cached)
+            unit_prices.append(cached_price)
         else:
             do_cache = True
-            with self._lock:
-                for source in self._sources:
-                    try:
-                        mkts = source.get_markets()
-                        if mkt_key in mkts or inv_mkt_key in mkts:
-                                price = source.get_price(from_asset, to_asset, 1.0)
-                                unit_prices.append(float(price))
-                    except PriceSourceError as e:
-                        _log_error(['PriceNetwork._do_get_price',
-                                    source._class_name(), str(e)])
-                    except requests.exceptions.ConnectionError as e:
-                        _log_error(['PriceNetwork._do_get_price',
-                                    source._class_name(), str(e)])
+            fetch_time = time.time()
+            unit_prices = self._fetch_unit_prices(from_asset, to_asset)
                     
         if len(unit_prices) == 0:
             raise PriceNetworkError("%s: Couldn't determine price of %s/%s" % (self._class_name(),
@@ -174,8 +684,10 @@ class PriceNetwork(PriceSource.PriceSource):
         # Make sure to copy it to the cache so future retrievals
         # within 60 seconds are quick.
         if do_cache:
-            expire = get_setting("options", "cache_price_expiration", default=60)
-            cache.set_val(mkt_key, float(avg_price), expire=expire)
+            cache.set_val(mkt_key, [float(avg_price), fetch_time], expire=expire)
+            self._set_edge_rate(from_asset, to_asset, avg_price, len(unit_prices), fetch_time)
+        else:
+            self._set_edge_rate(from_asset, to_asset, avg_price, 0, fetch_time)
 
         return avg_price * amount
 
@@ -187,27 +699,33 @@ class PriceNetwork(PriceSource.PriceSource):
         if from_asset == to_asset:
             return (from_asset,)
 
-        G = self._get_price_graph()
+        sh_p = self.get_route(from_asset, to_asset)
+        if sh_p:
+            return sh_p
 
-        # Sometimes the sources may add new markets after the
-         # price network is initialized. So lets add them here.
-        do_add_edge = False
-        if not from_asset in G and from_asset in self.get_symbols():
-            G.add_node(from_asset)
-            do_add_edge = True
-        if not to_asset in G and to_asset in self.get_symbols():
-            do_add_edge = True
-            G.add_node(to_asset)
-        mkt = from_asset + "/" + to_asset
-        if do_add_edge and mkt in self.get_markets():
-            G.add_edge(from_asset, to_asset)
-
-        sh_p = None
-        try:
-            sh_p = nx.shortest_path(G, from_asset, to_asset)
-        except Exception as e:
+        # Not every source publishes its market changes as they happen,
+        # so ask them to publish before giving up. That can mean a request,
+        # so each source is asked at most once per cache_price_expiration.
+        expire = get_setting("options", "cache_price_expiration", default=60)
+        now = time.time()
+        with self._lock:
+            sources = [source for source in self._sources
+                       if now - self._markets_requested.get(id(source), 0) >= expire]
+            for source in sources:
+                self._markets_requested[id(source)] = now
+        for source in sources:
+            try:
+                source.publish_markets()
+            except Exception as e:
+                _log_error(['PriceNetwork.get_shortest_path',
+                            source._class_name(), str(e)])
+
+        if sources:
+            sh_p = self.get_route(from_asset, to_asset)
+        if not sh_p:
             _log_error(['PriceNetwork.get_price',
-                        self._class_name(), str(e)])
+                        self._class_name(),
+                        "No path from %s to %s" % (from_asset, to_asset)])
         return sh_p
 
 
@@ -232,6 +750,58 @@ class PriceNetwork(PriceSource.PriceSource):
         return cur_value
 
     
+    def get_prices_batch(self, amounts, pairs, edge_rates=None):
+        """
+        Prices many conversions at once. amounts is a sequence of amounts
+        and pairs a sequence of (from_asset, to_asset) tuples of the same
+        length. Returns a numpy array holding how much of each to_asset you
+        would have for the corresponding amount of from_asset. Each distinct
+        route is resolved once and each edge rate is fetched once per call.
+        If edge_rates is an empty dict, it is filled with the rate used for
+        every (from_asset, to_asset) edge along the routes.
+        """
+        import numpy as np
+        amounts = np.asarray(amounts, dtype=float)
+        if len(amounts) != len(pairs):
+            raise PriceNetworkError("%s: got %d amounts for %d pairs" % (self._class_name(),
+                                                                         len(amounts),
+                                                                         len(pairs)))
+        # group the request indices by pair
+        groups = defaultdict(list)
+        for idx, pair in enumerate(pairs):
+            groups[tuple(pair)].append(idx)
+
+        values = np.zeros(len(amounts))
+        paths = {}
+        for (from_asset, to_asset), idxs in groups.iteritems():
+            idxs = np.asarray(idxs)
+            group_amounts = amounts[idxs]
+            if from_asset == to_asset or not group_amounts.any():
+                values[idxs] = group_amounts
+                continue
+
+            sh_p = self.get_shortest_path(from_asset, to_asset)
+            if not sh_p:
+                raise PriceNetworkError("No path from {0} to {1}"
+                                        .format(from_asset, to_asset))
+            paths[(from_asset, to_asset)] = (idxs, zip(sh_p[0:], sh_p[1:]))
+
+        # one round-trip to the shared cache for every edge we need
+        self._prefetch_edge_rates(set(edge for idxs, edges in paths.itervalues()
+                                      for edge in edges))
+
+        if edge_rates is None:
+            edge_rates = {}
+        for idxs, edges in paths.itervalues():
+            rates = []
+            for edge in edges:
+                if not edge in edge_rates:
+                    edge_rates[edge] = self._do_get_price(edge[0], edge[1], 1.0)
+                rates.append(edge_rates[edge])
+            values[idxs] = amounts[idxs] * np.prod(rates)
+        return values
+
+
     def price(self, trade_pair_str, value = 1.0):
         # trade_pair_str is a string with a slash separating two
         # asset symbols, like XBT/USD
@@ -243,12 +813,18 @@ class PriceNetwork(PriceSource.PriceSource):
 
 
 _pn = None
+_pending_sources = []
 def init():
     """
-    (Re-)initializes the PriceNetwork singleton.
+    (Re-)initializes the PriceNetwork singleton, closing the one it
+    replaces.
     """
     global _pn
-    _pn = PriceNetwork()
+    old_pn, _pn = _pn, PriceNetwork()
+    if old_pn:
+        old_pn.close()
+    while _pending_sources:
+        _pn.add_source(_pending_sources.pop(0))
 
 
 def _get_price_network():
@@ -270,10 +846,25 @@ def instance():
 
 def add_source(source):
     """
-    Adds a source to the price network.
+    Adds a source to the price network. If the network hasn't been
+    created yet, the source is added when it is, so registering a
+    source doesn't build the price graph.
     """
+    if not _pn:
+        _pending_sources.append(source)
+        return
     instance().add_source(source)
 
+
+def remove_source(source):
+    """
+    Removes a source from the price network.
+    """
+    if source in _pending_sources:
+        _pending_sources.remove(source)
+        return
+    instance().remove_source(source)
+
     
 def _do_get_price(value, trade_pair_str):    
     asset_strs = string.split(trade_pair_str,"/",1)
@@ -317,27 +908,41 @@ def get_price(*args, **kwargs):
     return _do_get_price(value, trade_pair_str)
 
 
-def get_prices(balances, base_asset):
+def get_prices_batch(amounts, pairs, edge_rates=None):
+    """
+    Returns a numpy array with the price of each amount in amounts
+    converted according to the (from_asset, to_asset) pair at the
+    same position in pairs.
+    """
+    return instance().get_prices_batch(amounts, pairs, edge_rates)
+
+
+def get_prices(balances, base_asset, edge_rates=None):
     """
     Given a dict of balances, returns another dict with the
-    prices of each asset in terms of the base_asset.
+    prices of each asset in terms of the base_asset. If edge_rates
+    is an empty dict, it is filled with the edge rates used.
     """
+    assets = [asset for asset, balance in balances.iteritems()
+              if balance != 0.0]
+    amounts = [float(balances[asset]) for asset in assets]
+    prices = get_prices_batch(amounts, [(asset, base_asset) for asset in assets],
+                              edge_rates)
     values = {}
-    for asset, balance in balances.iteritems():
-        if balance == 0.0:
-            continue
-        price = get_price(balance, asset, base_asset)
+    for asset, balance, price in zip(assets, amounts, prices):
         if price != 0.0:
-            values[asset] = (balance, price)
+            values[asset] = (balance, float(price))
     return values
 
 
-def get_nav(balances, base_asset):
+def get_nav(balances, base_asset, edge_rates=None):
     """
     Gven a dict of balances, returns the net asset value
-    of the whole collection in terms of the base_asset.
+    of the whole collection in terms of the base_asset. If
+    edge_rates is an empty dict, it is filled with the edge
+    rates used.
     """
-    prices = get_prices(balances, base_asset)
+    prices = get_prices(balances, base_asset, edge_rates)
     nav = 0.0
     for asset, item in prices.iteritems():
         nav += item[1]
@@ -380,6 +985,9 @@ def get_all_prices(mkts=None):
     prices = {}
     if not mkts:
         mkts = get_markets()
+    # warm the edge rate cache with one batched lookup of the shared cache
+    edges = [tuple(cur.strip() for cur in string.split(mkt, "/", 1)) for mkt in mkts]
+    instance()._prefetch_edge_rates([edge for edge in edges if len(edge) == 2])
     for mkt in mkts:
         try:
             price = get_price(mkt)
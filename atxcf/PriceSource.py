@@ -16,10 +16,9 @@ from settings import (
     get_setting, has_setting, set_setting
 )
 
-import requests
+import transport
 import requests.exceptions
 import re
-from pyquery import PyQuery as pq
 import unicodedata
 import json
 
@@ -27,10 +26,9 @@ import math
 import time
 import datetime
 import threading
+import weakref
 import os
 
-import locale
-locale.setlocale(locale.LC_ALL, '')
 
 
 class PriceSourceError(RuntimeError):
@@ -45,6 +43,11 @@ class PriceSource(object):
         # limit price updates to 60 second intervals
         self._update_interval = get_settings_option("price_update_interval", 60)
 
+        # market change notification state
+        self._markets_lock = threading.RLock()
+        self._markets_listeners = []
+        self._published_markets = None
+
     def get_symbols(self):
         """
         Returns list of asset/currency symbols tradable at this exchange.
@@ -92,6 +95,52 @@ class PriceSource(object):
             self.check_symbol(asset_symbol, uppercase)
 
 
+    def add_markets_listener(self, listener):
+        """
+        Registers a callable to be notified when this source's markets
+        change. It is called as listener(source, added, removed) where
+        added and removed are lists of market pair strings.
+        """
+        with self._markets_lock:
+            if not listener in self._markets_listeners:
+                self._markets_listeners.append(listener)
+
+
+    def remove_markets_listener(self, listener):
+        """
+        Unregisters a market change listener.
+        """
+        with self._markets_lock:
+            if listener in self._markets_listeners:
+                self._markets_listeners.remove(listener)
+
+
+    def publish_markets(self):
+        """
+        Notifies listeners of any difference between the current market
+        list and the one last published.
+        """
+        self._publish_markets(self.get_markets())
+
+
+    def _publish_markets(self, markets):
+        """
+        Diffs markets against the last published market list and passes
+        the added and removed markets to each listener. Sources should
+        call this whenever they refresh their market list.
+        """
+        with self._markets_lock:
+            cur_markets = set(markets)
+            prev_markets = self._published_markets or set()
+            added = list(cur_markets - prev_markets)
+            removed = list(prev_markets - cur_markets)
+            self._published_markets = cur_markets
+            if not added and not removed:
+                return
+            for listener in list(self._markets_listeners):
+                listener(self, added, removed)
+
+
     @classmethod
     def requires_creds(cls):
         """
@@ -118,6 +167,8 @@ class Bitfinex(PriceSource):
         super(Bitfinex, self).__init__()
         self.bfx = None
         self.bfx_symbols = None
+        self._price_map = {}
+        self._ticker_ts = time.time()
         self._lock = threading.RLock()
 
 
@@ -129,17 +180,62 @@ class Bitfinex(PriceSource):
     def _bfx_symbols(self):
         if not self.bfx_symbols:
             cache_key = self._class_name() + ".bfx_symbols"
-            if cache.has_key(cache_key):
-                self.bfx_symbols = cache.get_val(cache_key)
-            else:
-                try:
-                    self.bfx_symbols = self._bfx_client().symbols()
-                    cache.set_val(cache_key, self.bfx_symbols)
-                except:
-                    raise PriceSourceError("%s: Error getting symbols from bitfinex" % self._class_name())
+            try:
+                self.bfx_symbols = cache.get_or_compute(cache_key,
+                                                        self._bfx_client().symbols)
+            except:
+                raise PriceSourceError("%s: Error getting symbols from bitfinex" % self._class_name())
+            self._publish_markets([i.upper()[:3] + '/' + i.upper()[3:] for i in self.bfx_symbols])
         return self.bfx_symbols
 
 
+    def _get_price_map(self):
+        """
+        Returns a snapshot of last prices for every Bitfinex market,
+        fetched with as few tickers requests as possible.
+        """
+        if not self._price_map:
+            try:
+                tickers = self._bfx_client().tickers(self._bfx_symbols())
+            except requests.exceptions.ReadTimeout:
+                raise PriceSourceError("%s: Error getting tickers: requests.exceptions.ReadTimeout" % self._class_name())
+            except ValueError:
+                raise PriceSourceError("%s: throttled" % self._class_name())
+            cur_time = time.time()
+            for bfx_symbol, ticker in tickers.iteritems():
+                self._price_map[bfx_symbol] = (ticker["last_price"], cur_time)
+            self._ticker_ts = cur_time
+        return self._price_map
+
+
+    def _update_price_map(self, force=False):
+        with self._lock:
+            # update ticker if it is older than timeout seconds.
+            timeout = self._update_interval
+            if force or time.time() - self._ticker_ts > timeout:
+                self._price_map = {}
+
+
+    def _get_price(self, bfx_symbol):
+        """
+        Returns the last price for bfx_symbol from the price map snapshot,
+        falling back to a single ticker request if the snapshot lacks it.
+        """
+        self._update_price_map()
+        with self._lock:
+            price_map = self._get_price_map()
+            if bfx_symbol in price_map:
+                return float(price_map[bfx_symbol][0])
+            try:
+                price = float(self._bfx_client().ticker(bfx_symbol)["last_price"])
+            except requests.exceptions.ReadTimeout:
+                raise PriceSourceError("%s: Error getting last_price: requests.exceptions.ReadTimeout" % self._class_name())
+            except ValueError:
+                raise PriceSourceError("%s: throttled" % self._class_name())
+            self._price_map[bfx_symbol] = (price, time.time())
+            return price
+
+
     def get_symbols(self):
         """
         List of symbols at Bitfinex
@@ -188,12 +284,7 @@ class Bitfinex(PriceSource):
                 if not bfx_symbol in self._bfx_symbols():
                     raise PriceSourceError("%s: Missing market" % self._class_name())
 
-            try:
-                price = float(self._bfx_client().ticker(bfx_symbol)["last_price"])
-            except requests.exceptions.ReadTimeout:
-                raise PriceSourceError("%s: Error getting last_price: requests.exceptions.ReadTimeout" % self._class_name())
-            except ValueError:
-                raise PriceSourceError("%s: throttled" % self._class_name())
+            price = self._get_price(bfx_symbol)
 
         if inverse:
             try:
@@ -235,9 +326,24 @@ class Poloniex(PriceSource):
                 self._pol_ticker_ts = time.time()
             except:
                 raise PriceSourceError("%s: Error getting ticker" % self._class_name())
+            # publish whatever the new ticker changed, whether or not the
+            # cached market list is due for a refresh
+            self._publish_markets(self._pol_markets(self._pol_ticker))
         return self._pol_ticker
 
 
+    @staticmethod
+    def _pol_markets(ticker):
+        """
+        Returns the market pairs listed in a Poloniex ticker.
+        """
+        mkts = []
+        for cur in ticker.iterkeys():
+            pair = cur.split("_")
+            mkts.append(pair[1] + "/" + pair[0])
+        return mkts
+
+
     def _update_ticker(self):
         with self._lock:
             # update ticker if it is older than the specified amount of seconds.
@@ -254,51 +360,47 @@ class Poloniex(PriceSource):
         if self._symbols != None:
             return self._symbols
         key = self._class_name() + ".symbols"
-        if cache.has_key(key):
-            self._symbols = cache.get_val(key)
-            return self._symbols
+        self._symbols = cache.get_or_compute(key, self._ticker_symbols)
+        return self._symbols
+
+
+    def _ticker_symbols(self):
         symbol_set = set()
         with self._lock:
             for cur in self._get_pol_ticker().iterkeys():
                 for item in cur.split("_"):
                     symbol_set.add(item)
-        symbols = list(symbol_set)
-        cache.set_val(key, symbols)
-        self._symbols = symbols
-        return symbols
+        return list(symbol_set)
 
 
     def get_base_symbols(self):
         """
         List of base currencies at Poloniex
         """
-        symbol_set = set()
         key = self._class_name() + ".base_symbols"
-        if cache.has_key(key):
-            return cache.get_val(key)
+        return cache.get_or_compute(key, self._ticker_base_symbols)
+
+
+    def _ticker_base_symbols(self):
+        symbol_set = set()
         with self._lock:
             for cur in self._get_pol_ticker().iterkeys():
                 items = cur.split("_")
                 symbol_set.add(items[0]) # the first item is the base currency
-        symbols = list(symbol_set)
-        cache.set_val(key, symbols)
-        return symbols
+        return list(symbol_set)
 
 
     def get_markets(self):
         """
         List of all trade pairs
         """
-        mkts = []
         key = self._class_name() + ".markets"
-        if cache.has_key(key):
-            return cache.get_val(key)    
+        return cache.get_or_compute(key, self._ticker_markets)
+
+
+    def _ticker_markets(self):
         with self._lock:
-            for cur in self._get_pol_ticker().iterkeys():
-                pair = cur.split("_")
-                mkts.append(pair[1] + "/" + pair[0])
-        cache.set_val(key, mkts)
-        return mkts
+            return self._pol_markets(self._get_pol_ticker())
 
 
     def get_price(self, from_asset, to_asset, amount = 1.0):
@@ -344,23 +446,33 @@ class CryptoAssetCharts(PriceSource):
         self._asset_symbols = set()
         self._base_symbols = set()
         self._price_map = {}
-        try:
-            self._response = requests.get(self._req_url)
-        except:
-            raise PriceSourceError("%s: Error getting cryptoassetcharts.info" % self._class_name())
-        self._response_ts = time.time()
+        self._response = None
+        self._response_ts = 0
         self._lock = threading.RLock()
 
-        self._update_info()
+
+    def _ensure_info(self):
+        """
+        Scrapes the site the first time its info is needed.
+        """
+        with self._lock:
+            if self._response is None:
+                self._update_info()
+
 
     def _update_info(self):
+        from pyquery import PyQuery as pq
         with self._lock:
             # if it is older than timeout seconds, do another request.
             timeout = self._update_interval
             if time.time() - self._response_ts > timeout:
-                self._response = requests.get(self._req_url)
-                if self._response.status_code != 200:
+                try:
+                    response = transport.get(self._req_url)
+                except requests.exceptions.RequestException:
+                    raise PriceSourceError("%s: Error getting cryptoassetcharts.info" % self._class_name())
+                if response.status_code != 200:
                     raise PriceSourceError("%s: Error getting cryptoassetcharts.info" % self._class_name())
+                self._response = response
                 self._response_ts = time.time()
             doc = pq(self._response.content)
             tbl = doc("#tableAssets")
@@ -383,8 +495,9 @@ class CryptoAssetCharts(PriceSource):
                 base_symbol = price_str_comp[1]
                 self._base_symbols.add(base_symbol)
             
-                price_val = locale.atof(price_str_comp[0].replace(',', ''))
+                price_val = float(price_str_comp[0].replace(',', ''))
                 self._price_map["_"+asset_symbol+"/"+base_symbol] = price_val
+            self._publish_markets(self._price_map.keys())
         
 
     def get_symbols(self):
@@ -392,6 +505,7 @@ class CryptoAssetCharts(PriceSource):
         List all asset symbols at the site.
         """
         # Prefix asset symbols with _ so they don't collide with other real symbol names.
+        self._ensure_info()
         with self._lock:
             return ['_'+s for s in self._asset_symbols] + self.get_base_symbols()
 
@@ -400,6 +514,7 @@ class CryptoAssetCharts(PriceSource):
         """
         List base currencies that market prices are listed in.
         """
+        self._ensure_info()
         with self._lock:
             return list(self._base_symbols)
 
@@ -408,6 +523,7 @@ class CryptoAssetCharts(PriceSource):
         """
         List all markets known by CryptoAssetCharts
         """
+        self._ensure_info()
         with self._lock:
             return list(self._price_map.iterkeys())
  
@@ -426,6 +542,7 @@ class CryptoAssetCharts(PriceSource):
         trade_pair_str = to_asset + '/' + from_asset
 
         with self._lock:
+            self._ensure_info()
             if not trade_pair_str in self._price_map.iterkeys():
                 inverse = True
                 trade_pair_str = from_asset + '/' + to_asset
@@ -464,8 +581,8 @@ class CoinExchange(PriceSource):
         if cur_time - self._response_ts > timeout:
 
             try:
-                reqs = (requests.get(self._req_url),
-                        requests.get(self._price_url))
+                reqs = (transport.get(self._req_url),
+                        transport.get(self._price_url))
             except requests.exceptions.ConnectionError as e:
                 raise PriceSourceError("%s: %s" % (self._class_name(), str(e)))
             for req in reqs:
@@ -491,6 +608,8 @@ class CoinExchange(PriceSource):
                 if mkt_id in mkt_ids: # some markets are inactive it seems.
                     self._mkt_prices[mkt_str] = mkt_ids[mkt_id]["LastPrice"]
             self._response_ts = cur_time
+            self._publish_markets([mkt["MarketAssetCode"]+"/"+mkt["BaseCurrencyCode"]
+                                   for mkt in self._mkt_info["result"]])
 
     
     def get_symbols(self):
@@ -593,6 +712,8 @@ class Bittrex(PriceSource):
                 self._markets = self._client().get_markets()["result"]
             except:
                 raise PriceSourceError("%s: Error getting markets" % self._class_name())
+            self._publish_markets([str(c["MarketCurrency"]+"/"+c["BaseCurrency"])
+                                   for c in self._markets])
         return self._markets
 
 
@@ -640,15 +761,9 @@ class Bittrex(PriceSource):
         """
         Returns list of asset/currency symbols tradable at this exchange.
         """
-        symbols = None
         key = self._class_name() + ".symbols"
-        if cache.has_key(key):
-            symbols = cache.get_val(key)
-        else:
-            with self._lock:
-                symbols = self._get_symbols()
-                cache.set_val(key, symbols)
-        return symbols
+        with self._lock:
+            return cache.get_or_compute(key, self._get_symbols)
 
 
     def get_base_symbols(self):
@@ -656,15 +771,9 @@ class Bittrex(PriceSource):
         Returns list of base currency symbols used. For instance, in the
         trade pair XBT/USD, the base symbol is USD.
         """
-        base_symbols = None
         key = self._class_name() + ".base_symbols"
-        if cache.has_key(key):
-            base_symbols = cache.get_val(key)
-        else:
-            with self._lock:
-                base_symbols = self._get_base_symbols()
-                cache.set_val(key, base_symbols)
-        return base_symbols
+        with self._lock:
+            return cache.get_or_compute(key, self._get_base_symbols)
 
 
     def get_markets(self):
@@ -725,6 +834,7 @@ def set_conversions(conv):
     Setting conversions used. Should be a dict.
     """
     set_setting("conversions", conv)
+    _publish_conversions()
 
 
 def get_conversion(conv_mkt):
@@ -740,6 +850,17 @@ def set_conversion(conv_mkt, value):
     """
     # TODO: check conv_mkt for FROM/TO form
     set_setting("conversions", conv_mkt, value)
+    _publish_conversions()
+
+
+# Live Conversions sources, notified when the conversions change.
+_conversions_sources = weakref.WeakSet()
+def _publish_conversions():
+    """
+    Publishes conversion market changes from every Conversions source.
+    """
+    for source in list(_conversions_sources):
+        source.publish_markets()
 
     
 class Conversions(PriceSource):
@@ -748,6 +869,11 @@ class Conversions(PriceSource):
     mNXT <-> NXT, XBT <-> BTC, etc.
     """
 
+    def __init__(self):
+        super(Conversions, self).__init__()
+        _conversions_sources.add(self)
+
+
     def _get_conversions(self):
         return get_conversions()
     
@@ -773,7 +899,9 @@ class Conversions(PriceSource):
         """
         Returns list of conversions supported as if they were markets themselves.
         """
-        return list(self._get_conversions().iterkeys())
+        mkts = list(self._get_conversions().iterkeys())
+        self._publish_markets(mkts)
+        return mkts
 
 
     def get_price(self, from_asset, to_asset, amount = 1.0):
@@ -851,26 +979,28 @@ class Coinigy(PriceSource):
         """
         if not self._markets:
             key = self._class_name() + "._markets"
-            if cache.has_key(key):
-                self._markets = cache.get_val(key)
-            else:
-                if not has_creds(self._class_name()):
-                    raise PriceSourceError("%s: missing credentials" % self._class_name())
-                api_key, api_secret = get_creds(self._class_name())
-                headers = {
-                    'Content-Type': 'application/json',
-                    'X-API-KEY': api_key,
-                    'X-API-SECRET': api_secret
-                }
-                result = requests.post("https://api.coinigy.com/api/v1/exchanges", headers=headers)
-                res = json.loads(result.text)
-                if not 'data' in res:
-                    raise PriceSourceError(str(res))
-                self._markets = [item['mkt_name'] for item in res['data']]
-                cache.set_val(key, self._markets, expire=60*60*24)
+            self._markets = cache.get_or_compute(key, self._fetch_markets,
+                                                 expire=60*60*24)
+            self._publish_markets(self._markets)
         return self._markets
 
 
+    def _fetch_markets(self):
+        if not has_creds(self._class_name()):
+            raise PriceSourceError("%s: missing credentials" % self._class_name())
+        api_key, api_secret = get_creds(self._class_name())
+        headers = {
+            'Content-Type': 'application/json',
+            'X-API-KEY': api_key,
+            'X-API-SECRET': api_secret
+        }
+        result = transport.post("https://api.coinigy.com/api/v1/exchanges", headers=headers)
+        res = json.loads(result.text)
+        if not 'data' in res:
+            raise PriceSourceError(str(res))
+        return [item['mkt_name'] for item in res['data']]
+
+
     def get_price(self, from_asset, to_asset, amount = 1.0):
         """
         Returns ticker data from the Coingy API
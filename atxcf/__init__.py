@@ -48,70 +48,156 @@ __author__ = 'Joe Rivera <transfix@sublevels.net>'
 __repo__    = 'https://github.com/transfix/atxcf'
 __license__ = 'The MIT License (MIT)'
 
-from .PriceSource import (
-    PriceSource, PriceSourceError, Bitfinex, Poloniex, CryptoAssetCharts,
-    Bittrex, CoinExchange, Conversions, Coinigy, set_conversion, get_conversion,
-    get_conversions, set_conversions
-)
-
-from .PriceNetwork import (
-    PriceNetwork, PriceNetworkError, add_source
-)
-from .PriceNetwork import init as init_price_network
-
-from .settings import (
-    init_settings, clear_settings, get_settings, set_settings,
-    reload_settings, write_settings, get_option, set_option,
-    get_options, remove_option, get_creds, set_creds, get_all_creds,
-    remove_creds, SettingsError, has_setting, set_setting,
-    get_setting, remove_setting, get_settings_filename, get_last_modified,
-    get_default_program_url, set_settings_filename,
-    add_settings_pre_change_callback, add_settings_post_change_callback,
-    remove_settings_pre_change_callback, remove_settings_post_change_callback,
-    get_settings_change_callbacks
-)
-
-from .cmd import (
-    get_symbols, get_base_symbols, get_price, get_prices, get_nav,
-    get_markets, get_market_sources, get_top_coins, CmdError,
-    get_commands, get_help, keep_prices_updated, get_all_prices,
-    log_prices, compute_candles, get_candle,
-    get_candle_begin, get_candle_end,
-    get_candle_low, get_candle_high,
-    get_current_begin, get_current_end,
-    get_current_low, get_current_high,
-    get_current_percent_change
-)
-
-from .accounts import (
-    number_of_users, get_users, has_user, add_user, get_user_email,
-    set_user_email, get_balance, set_balance, transfer,
-    get_transfer_logfile_name, set_transfer_logfile_name,
-    get_user_ledger_name, get_assets, get_user_changelog,
-    set_user_changelog, get_metadata_value, set_metadata_value,
-    set_domain, get_domain, get_metadata,
-    has_pre_set_balance_callback, has_post_set_balance_callback,
-    add_pre_set_balance_callback, del_pre_set_balance_callback,
-    add_post_set_balance_callback, del_post_set_balance_callback,
-    inc_balance, dec_balance, InsufficientBalance
-)
-
-from .xch import (
-    get_exchange_logfile_name, get_exchange_marketlog_name, exchange,
-    limit_buy, limit_sell, orderbook
-)
-
-from .cache import (
-    get_val, has_key, set_val
-)
-
-from .portfolio import (
-    get_portfolio, get_portfolio_values, get_portfolio_nav
-)
-
-from .shares import (
-    get_shares_logfile_name, get_initial_rate, get_initial_rate_asset,
-    get_num_shares_outstanding, get_portfolio_nav_share_ratio, get_shareholders,
-    get_shareholder_names, get_num_shareholders, create_shares, redeem_shares,
-    grant_shares, has_shares
-)
+import importlib
+import sys
+import types
+
+# Public names by the submodule they come from. Submodules are imported
+# the first time one of their names is used, so "import atxcf" doesn't
+# load networkx, numpy or requests, read the settings or touch the
+# network.
+_exports = {
+    "PriceSource": (
+        "PriceSource", "PriceSourceError", "Bitfinex", "Poloniex",
+        "CryptoAssetCharts", "Bittrex", "CoinExchange", "Conversions",
+        "Coinigy", "set_conversion", "get_conversion", "get_conversions",
+        "set_conversions"
+    ),
+
+    "PriceNetwork": (
+        "PriceNetwork", "PriceNetworkError", "add_source", "remove_source",
+        "get_prices_batch"
+    ),
+
+    "settings": (
+        "init_settings", "clear_settings", "get_settings", "set_settings",
+        "reload_settings", "write_settings", "get_option", "set_option",
+        "get_options", "remove_option", "get_creds", "set_creds",
+        "get_all_creds", "remove_creds", "SettingsError", "has_setting",
+        "set_setting", "get_setting", "get_setting_view",
+        "get_settings_version", "SettingsView", "remove_setting",
+        "get_settings_filename", "get_last_modified",
+        "get_default_program_url", "set_settings_filename",
+        "add_settings_pre_change_callback", "add_settings_post_change_callback",
+        "remove_settings_pre_change_callback",
+        "remove_settings_post_change_callback",
+        "get_settings_change_callbacks", "get_settings_journal_filename",
+        "append_record", "append_records", "flush_records",
+        "flush_settings_change_callbacks",
+        "get_settings_role", "set_settings_role", "publish_settings",
+        "get_shared_settings_filename"
+    ),
+
+    "cmd": (
+        "get_symbols", "get_base_symbols", "get_price", "get_prices",
+        "get_nav", "get_markets", "get_market_sources", "get_top_coins",
+        "CmdError", "get_commands", "get_help", "keep_prices_updated",
+        "get_all_prices", "log_prices", "compute_candles", "get_candle",
+        "get_candle_begin", "get_candle_end",
+        "get_candle_low", "get_candle_high",
+        "get_current_begin", "get_current_end",
+        "get_current_low", "get_current_high",
+        "get_current_percent_change"
+    ),
+
+    "accounts": (
+        "number_of_users", "get_users", "has_user", "add_user",
+        "get_user_email", "set_user_email", "get_balance", "set_balance",
+        "transfer", "get_transfer_logfile_name", "set_transfer_logfile_name",
+        "get_user_ledger_name", "get_assets", "get_user_changelog",
+        "set_user_changelog", "get_metadata_value", "set_metadata_value",
+        "set_domain", "get_domain", "get_metadata",
+        "has_pre_set_balance_callback", "has_post_set_balance_callback",
+        "add_pre_set_balance_callback", "del_pre_set_balance_callback",
+        "add_post_set_balance_callback", "del_post_set_balance_callback",
+        "inc_balance", "dec_balance", "InsufficientBalance",
+        "get_balances_filename", "transfer_batch", "get_holders",
+        "get_ledger_id"
+    ),
+
+    "xch": (
+        "get_exchange_logfile_name", "get_exchange_marketlog_name",
+        "exchange", "limit_buy", "limit_sell", "orderbook"
+    ),
+
+    "cache": (
+        "get_val", "has_key", "set_val", "get_or_compute"
+    ),
+
+    "portfolio": (
+        "get_portfolio", "get_portfolio_values", "get_portfolio_nav"
+    ),
+
+    "shares": (
+        "get_shares_logfile_name", "get_initial_rate",
+        "get_initial_rate_asset", "get_num_shares_outstanding",
+        "get_portfolio_nav_share_ratio", "get_shareholders",
+        "get_shareholder_names", "get_num_shareholders", "create_shares",
+        "redeem_shares", "grant_shares", "has_shares", "SharesError"
+    ),
+}
+
+# public name -> (submodule, name in the submodule)
+_lazy_attrs = {
+    "init_price_network": ("PriceNetwork", "init"),
+}
+for _module_name, _names in _exports.iteritems():
+    for _name in _names:
+        _lazy_attrs[_name] = (_module_name, _name)
+
+
+class _LazyModule(types.ModuleType):
+    """
+    Stands in for the atxcf package and imports submodules on first use.
+    """
+
+    def _resolve(self, name):
+        module_name, attr = _lazy_attrs[name]
+        module = importlib.import_module("." + module_name, self.__name__)
+        return getattr(module, attr)
+
+
+    def __getattr__(self, name):
+        if name in _lazy_attrs:
+            value = self._resolve(name)
+        elif not name.startswith("_"):
+            # a submodule that hasn't been imported yet, e.g. atxcf.cache
+            try:
+                value = importlib.import_module("." + name, self.__name__)
+            except ImportError:
+                raise AttributeError("module %s has no attribute %s" % (self.__name__, name))
+        else:
+            raise AttributeError("module %s has no attribute %s" % (self.__name__, name))
+        self.__dict__[name] = value
+        return value
+
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_lazy_attrs))
+
+
+def _shadowing_property(name):
+    """
+    Returns a property for a public name that is also the name of a
+    submodule. Importing the submodule stores it in the package dict,
+    and the property takes precedence over that entry.
+    """
+    resolved = []
+    def get(self):
+        if not resolved:
+            resolved.append(self._resolve(name))
+        return resolved[0]
+    return property(get)
+
+
+for _name in ("PriceSource", "PriceNetwork"):
+    setattr(_LazyModule, _name, _shadowing_property(_name))
+
+
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(globals())
+_module.__all__ = sorted(_lazy_attrs)
+# keep the original module alive, python 2 clears the globals of
+# collected modules and the functions above still use them
+_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _module
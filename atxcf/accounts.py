@@ -5,20 +5,29 @@ handles double entry accounting for the system.
 
 import csv
 import time
+import uuid
+import itertools
 import threading
 from copy import deepcopy
-from collections import defaultdict
+from collections import defaultdict, deque
+from contextlib import contextmanager
 from json import dumps
 
 from settings import (
     get_settings_option, get_settings, set_settings, set_option,
-    get_option, get_setting, set_setting, get_settings_filename
+    get_option, get_setting, set_setting, get_settings_filename,
+    get_setting_view, has_setting, remove_setting, get_settings_version,
+    get_settings_role
 )
 
 from utils import (
-    append_record
+    append_record, append_records
 )
 
+from core import SettingsError
+
+from ledger import Ledger
+
 from PriceNetwork import get_price
 
 class InsufficientBalance(RuntimeError):
@@ -31,20 +40,42 @@ class InsufficientBalance(RuntimeError):
 
 _lock = threading.RLock()
 
+# Balances are changed holding the locks of the users involved rather
+# than _lock, so transfers between different users don't wait on each
+# other. Users hash to one of these locks, and they are always taken in
+# index order so that threads locking several users can't deadlock.
+_num_user_locks = 64
+_user_locks = [threading.RLock() for i in xrange(_num_user_locks)]
+
+
+@contextmanager
+def _locked_users(*names):
+    """
+    Holds the locks of the named users until the with block exits.
+    """
+    locks = [_user_locks[i] for i in
+             sorted(set(hash(name) % _num_user_locks for name in names))]
+    for lock in locks:
+        lock.acquire()
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
 # serial number for every log entry in the system. Every new log entry
 # represents some atomic change to a user account in the system.
-_log_id = 0
+_log_ids = itertools.count()
 def _log_change(name, item, cur_time=None, meta={}):
     """
     Adds a change to the specified user's changelog
     """
-    global _log_id
     if not cur_time:
         cur_time = time.time()
-    fields = [cur_time, _log_id, name, item, dumps(meta)]
+    fields = [cur_time, next(_log_ids), name, item, dumps(meta)]
     log_filename = get_user_changelog(name)
     append_record(log_filename, fields)
-    _log_id += 1
 
 
 def get_domain():
@@ -63,25 +94,11 @@ def set_domain(domain, meta=None):
         set_setting("accounts", "domain", domain, meta=meta)
     
 
-def _get_accounts():
-    """
-    Returns accounts dict from settings.
-    """
-    return get_setting("accounts", default={})
-
-
 def _get_users():
     """
-    Returns the user dict from settings.
-    """
-    return get_setting("accounts", "users", default={})
-
-
-def _get_balances(user):
-    """
-    Returns the balances dict from settings.
+    Returns a read-only view of the user dict from settings.
     """
-    return get_setting("accounts", "users", user, "balances", default={})
+    return get_setting_view("accounts", "users", default={})
 
 
 def number_of_users():
@@ -180,25 +197,139 @@ def set_user_min_value_asset(name, asset, meta={}):
         set_setting("accounts", "users", name, "min_value_asset", asset, meta=meta)
 
         
+def get_balances_filename():
+    """
+    Returns the filename of the ledger keeping the users' balances.
+    """
+    return get_settings_option("accounts_balances_file",
+                               "%s.balances.csv" % get_settings_filename())
+
+
+def _migrate_balances(ledger):
+    """
+    Moves the balances kept in the settings by earlier versions into
+    the ledger.
+    """
+    for name, user in _get_users().iteritems():
+        for asset, balance in user.get("balances", {}).iteritems():
+            if not "amount" in balance:
+                continue
+            ledger.set_balance(name, asset, balance["amount"])
+            if len(balance) > 1:
+                remove_setting("accounts", "users", name, "balances", asset, "amount")
+            else:
+                remove_setting("accounts", "users", name, "balances", asset)
+
+
+def _has_settings_balances():
+    for user in _get_users().itervalues():
+        for balance in user.get("balances", {}).itervalues():
+            if "amount" in balance:
+                return True
+    return False
+
+
+_ledger = None
+_ledger_key = None
+_ledger_lock = threading.RLock()
+def _get_ledger():
+    """
+    Returns the ledger for the current settings. The ledger belongs to
+    the settings naming its id. A new ledger is only started when there
+    is no ledger file yet; a ledger file that doesn't match the settings
+    raises a SettingsError rather than being replaced.
+    """
+    global _ledger
+    global _ledger_key
+    get_settings() # loads the settings, bumping the version if needed
+    key = (get_settings_filename(), get_settings_version())
+    ledger = _ledger
+    if ledger and _ledger_key == key:
+        return ledger
+    with _ledger_lock:
+        filename = get_balances_filename()
+        if get_settings_role() == "reader":
+            if not _ledger or _ledger.filename != filename:
+                _ledger = Ledger(filename, read_only=True)
+            _ledger_key = key
+            return _ledger
+        if not _ledger or _ledger.filename != filename:
+            if _ledger:
+                _ledger.close()
+            _ledger = Ledger(filename)
+        ledger_id = None
+        if has_setting("accounts", "ledger_id"):
+            ledger_id = get_setting("accounts", "ledger_id")
+        if _ledger.is_empty():
+            if ledger_id:
+                raise SettingsError("Ledger %s of the settings is missing from %s" % (ledger_id, filename))
+            _ledger.create(str(uuid.uuid4()))
+            _migrate_balances(_ledger)
+            set_setting("accounts", "ledger_id", _ledger.ledger_id)
+        elif not _ledger.ledger_id:
+            raise SettingsError("Ledger %s has no ledger id" % filename)
+        elif not ledger_id:
+            # settings that lost the id take the existing ledger back,
+            # unless they hold balances of their own
+            if _has_settings_balances():
+                raise SettingsError("Settings hold balances that aren't in ledger %s of %s" % (_ledger.ledger_id, filename))
+            set_setting("accounts", "ledger_id", _ledger.ledger_id)
+        elif _ledger.ledger_id != ledger_id:
+            raise SettingsError("Ledger %s in %s doesn't match ledger %s of the settings" % (_ledger.ledger_id, filename, ledger_id))
+        _ledger_key = (get_settings_filename(), get_settings_version())
+        return _ledger
+
+
+def get_ledger_id():
+    """
+    Returns the id of the ledger holding the balances. It changes when
+    the settings are replaced and a new ledger is started.
+    """
+    return _get_ledger().ledger_id
+
+
 def get_assets(name):
     """
     Lists all assets for which the specified user has a
     known balance.
     """
-    return [i for i in _get_balances(name)]
+    ledger = _get_ledger()
+    if get_settings_role() == "reader":
+        ledger.refresh()
+    return ledger.get_assets(name)
 
 
 def get_balance(name, asset):
     """
     Gets the balance for an asset held by the specified user.
     """
-    return get_setting("accounts", "users", name, "balances", asset, "amount", default=0.0)
+    ledger = _get_ledger()
+    if get_settings_role() == "reader":
+        ledger.refresh()
+    return ledger.get_balance(name, asset)
+
+
+def get_holders(asset):
+    """
+    Returns a dict of the users holding a positive balance of asset
+    and their balances.
+    """
+    ledger = _get_ledger()
+    if get_settings_role() == "reader":
+        ledger.refresh()
+    return ledger.get_holders(asset)
 
 
 _set_balance_callbacks_lock = threading.RLock()
 _pre_set_balance_callbacks = {}
 _post_set_balance_callbacks = {}
 
+# Balance changes waiting for their post callbacks, in the order they
+# were made. The callbacks run after the users' locks are released, one
+# change at a time.
+_post_set_balance_queue = deque()
+_post_set_balance_dispatch_lock = threading.RLock()
+
 def has_pre_set_balance_callback(name):
     with _set_balance_callbacks_lock:
         return name in _pre_set_balance_callbacks
@@ -234,22 +365,75 @@ def del_post_set_balance_callback(name):
         del _post_set_balance_callbacks[name]
 
         
-def set_balance(name, asset, amount, cur_time=None, meta={}):
+def _invoke_pre_set_balance_callbacks(changes, cur_time):
     """
-    Sets the balance for an asset held by the specified user.
+    Calls the pre callbacks for every (name, asset, amount, meta) balance
+    change. They run holding the users' locks, before the changes are
+    made, and may raise to prevent them.
     """
-    global _lock
     with _set_balance_callbacks_lock:
-        for key, call in _pre_set_balance_callbacks.iteritems():
+        callbacks = _pre_set_balance_callbacks.values()
+    for name, asset, amount, meta in changes:
+        for call in callbacks:
             call(name, asset, amount, cur_time, meta)
-    with _lock:
-        set_setting("accounts", "users", name, "balances", asset, "amount", float(amount))
+
+
+def _queue_post_set_balance_callbacks(changes, cur_time):
+    for name, asset, amount, meta in changes:
+        _post_set_balance_queue.append((name, asset, amount, cur_time, meta))
+
+
+def _dispatch_post_set_balance_callbacks():
+    """
+    Calls the post callbacks for the queued balance changes. Call it
+    with no user locks held. Returns once the changes queued so far have
+    been dispatched, by this thread or another one.
+    """
+    with _post_set_balance_dispatch_lock:
+        while _post_set_balance_queue:
+            name, asset, amount, cur_time, meta = _post_set_balance_queue.popleft()
+            with _set_balance_callbacks_lock:
+                callbacks = _post_set_balance_callbacks.values()
+            for call in callbacks:
+                call(name, asset, amount, cur_time, meta)
+
+
+# Keep the shares outstanding updated. This and the shareholders
+# callback live here rather than in shares so that balance changes
+# keep the share settings right without importing shares.
+def _post_set_portfolio_share_balance(name, asset, amount, cur_time=None, meta={}):
+    if name == asset:
+        set_setting("shares", asset, "outstanding", abs(float(amount)))
+add_post_set_balance_callback("shares_outstanding", _post_set_portfolio_share_balance)
+
+
+# Keep the list of shareholders updated.
+def _post_set_portfolio_shareholders(name, asset, amount, cur_time=None, meta={}):
+    if get_setting("shares", asset, "outstanding", default=0) > 0:
+        set_setting("shares", asset, "shareholders", name, amount)
+add_post_set_balance_callback("shareholders", _post_set_portfolio_shareholders)
+
+
+def _set_balance(name, asset, amount, cur_time, meta):
+    """
+    Sets a balance holding the user's lock, queueing its post callbacks.
+    """
+    changes = [(name, asset, amount, meta)]
+    _invoke_pre_set_balance_callbacks(changes, cur_time)
+    _get_ledger().set_balance(name, asset, amount)
     if not cur_time:
         cur_time = time.time()
     _log_change(name, ("set_balance", asset, amount), cur_time, meta)
-    with _set_balance_callbacks_lock:
-        for key, call in _post_set_balance_callbacks.iteritems():
-            call(name, asset, amount, cur_time, meta)
+    _queue_post_set_balance_callbacks(changes, cur_time)
+
+
+def set_balance(name, asset, amount, cur_time=None, meta={}):
+    """
+    Sets the balance for an asset held by the specified user.
+    """
+    with _locked_users(name):
+        _set_balance(name, asset, amount, cur_time, meta)
+    _dispatch_post_set_balance_callbacks()
 
 
 def inc_balance(name, asset, amount, cur_time=None, meta={}):
@@ -258,10 +442,11 @@ def inc_balance(name, asset, amount, cur_time=None, meta={}):
     """
     bal = 0.0
     meta.update({"type": "inc_balance"})
-    with _lock:
+    with _locked_users(name):
         bal = get_balance(name, asset)
         bal += amount
-        set_balance(name, asset, bal, cur_time, meta)
+        _set_balance(name, asset, bal, cur_time, meta)
+    _dispatch_post_set_balance_callbacks()
     return bal
 
 
@@ -271,10 +456,11 @@ def dec_balance(name, asset, amount, cur_time=None, meta={}):
     """
     bal = 0.0
     meta.update({"type": "dec_balance"})
-    with _lock:
+    with _locked_users(name):
         bal = get_balance(name, asset)
         bal -= amount
-        set_balance(name, asset, bal, cur_time, meta)
+        _set_balance(name, asset, bal, cur_time, meta)
+    _dispatch_post_set_balance_callbacks()
     return bal
 
 
@@ -329,30 +515,6 @@ def get_user_ledger_name(name, asset):
     return get_setting("accounts", "users", name, "balances", asset, "ledger", default=default)
 
 
-def _credit(cur_time, name, account, asset, amount, meta={}):
-    """
-    Adds a credit entry in the ledger for the named user
-    against another user account for the specified asset
-    and amount.
-    """
-    new_amount = inc_balance(name, asset, float(amount), cur_time, meta)
-    # append to ledger csv    
-    fields=[cur_time, account, 0.0, float(amount), new_amount, meta]
-    append_record(get_user_ledger_name(name, asset), fields)
-
-
-def _debit(cur_time, name, account, asset, amount, meta={}):
-    """
-    Adds a debit entry in the ledger for the named user
-    against another user account for the specified asset
-    and amount.
-    """
-    new_amount = dec_balance(name, asset, float(amount), cur_time, meta)    
-    # append to ledger csv
-    fields=[cur_time, account, float(amount), 0.0, new_amount, meta]
-    append_record(get_user_ledger_name(name, asset), fields)
-    
-
 def get_transfer_logfile_name():
     """
     Gets the transfer logfile name.
@@ -367,32 +529,85 @@ def set_transfer_logfile_name(name):
     set_option("accounts_transfer_log", name)
 
     
-# Only one thread can do a transaction at any given time.
-def transfer(from_user, to_user, asset, amount,
-             cur_time=None, meta={}):
+def _batch_balance(balances, name, asset):
     """
-    Subtracts the specified amount from the from_user account's
-    balance of the specified asset and adds it to the to_user
-    account's balance of that asset.
+    Returns the balance of name's asset, as left by the transfers of a
+    batch so far.
+    """
+    balance = balances.get((name, asset))
+    if balance is None:
+        balance = get_balance(name, asset)
+    return balance
+
+
+def transfer_batch(transfers, cur_time=None, meta={}, issuer=None):
+    """
+    Makes a list of transfers at once. Each transfer is a tuple of
+    (from_user, to_user, asset, amount), optionally followed by a meta
+    dict to use instead of meta. All transfers are checked before any
+    is made, each against the balances left by the ones before it, so
+    if one of them would overdraw an account InsufficientBalance is
+    raised and none is made. Only the issuer account may hold a negative
+    balance, of the asset named after it, like a portfolio issuing its
+    own shares.
     """
-    global _lock
-    
     if not cur_time:
         cur_time = time.time()
 
-    with _lock:
-        from_balance = get_balance(from_user, asset)
-        #from_user_min_value = get_user_min_value(from_user)
-        #from_user_min_value_asset = get_user_min_value_asset(from_user)
-        #from_balance_in_min_val_asset = get_price(amount, asset, from_user_min_value_asset)
+    # only one thread at a time can transfer to or from any of the users
+    names = [t[0] for t in transfers] + [t[1] for t in transfers]
+    with _locked_users(*names):
+        balances = {}
+        changes = [] # (name, asset, amount, meta) for every balance set
+        ledger_records = defaultdict(list)
+        transfer_records = []
+        for t in transfers:
+            from_user, to_user, asset, amount = t[:4]
+            amount = float(amount)
+            t_meta = t[4] if len(t) > 4 else meta
+
+            from_balance = _batch_balance(balances, from_user, asset)
+            #from_user_min_value = get_user_min_value(from_user)
+            #from_user_min_value_asset = get_user_min_value_asset(from_user)
+            #from_balance_in_min_val_asset = get_price(amount, asset, from_user_min_value_asset)
+
+            issuing = issuer is not None and from_user == asset == issuer
+            if not issuing and from_balance - amount < 0.0:
+                raise InsufficientBalance(from_user, to_user, asset, amount, t_meta)
+
+            # double accounting
+            to_balance = _batch_balance(balances, to_user, asset) + amount
+            balances[(to_user, asset)] = to_balance
+            changes.append((to_user, asset, to_balance, dict(t_meta, type="inc_balance")))
+            ledger_records[get_user_ledger_name(to_user, asset)].append(
+                [cur_time, from_user, 0.0, amount, to_balance, t_meta])
+
+            from_balance = _batch_balance(balances, from_user, asset) - amount
+            balances[(from_user, asset)] = from_balance
+            changes.append((from_user, asset, from_balance, dict(t_meta, type="dec_balance")))
+            ledger_records[get_user_ledger_name(from_user, asset)].append(
+                [cur_time, to_user, amount, 0.0, from_balance, t_meta])
+
+            transfer_records.append([cur_time, from_user, to_user, asset, amount, t_meta])
+
+        if not changes:
+            return
+        _invoke_pre_set_balance_callbacks(changes, cur_time)
+        _get_ledger().set_balances([change[:3] for change in changes])
+        for name, asset, amount, c_meta in changes:
+            _log_change(name, ("set_balance", asset, amount), cur_time, c_meta)
+        for ledger_name, records in ledger_records.iteritems():
+            append_records(ledger_name, records)
+        append_records(get_transfer_logfile_name(), transfer_records)
+        _queue_post_set_balance_callbacks(changes, cur_time)
+    _dispatch_post_set_balance_callbacks()
 
-        if from_balance - amount < 0.0:
-            raise InsufficientBalance(from_user, to_user, asset, amount, meta)
-        
-        # double accounting
-        _credit(cur_time, to_user, from_user, asset, amount, meta)
-        _debit(cur_time, from_user, to_user, asset, amount, meta)
 
-        # append to transfers log csv
-        fields=[cur_time, from_user, to_user, asset, float(amount), meta]
-        append_record(get_transfer_logfile_name(), fields)    
+def transfer(from_user, to_user, asset, amount,
+             cur_time=None, meta={}):
+    """
+    Subtracts the specified amount from the from_user account's
+    balance of the specified asset and adds it to the to_user
+    account's balance of that asset.
+    """
+    transfer_batch([(from_user, to_user, asset, amount)], cur_time, meta)
@@ -1,9 +1,10 @@
-import requests
 import json
+import transport
 
 PROTOCOL = "https"
 HOST = "api.bitfinex.com"
 VERSION = "v1"
+VERSION_V2 = "v2"
 
 PATH_SYMBOLS = "symbols"
 PATH_TICKER = "ticker/%s"
@@ -11,9 +12,10 @@ PATH_TODAY = "today/%s"
 PATH_STATS = "stats/%s"
 PATH_LENDBOOK = "lendbook/%s"
 PATH_ORDERBOOK = "book/%s"
+PATH_TICKERS = "tickers"
 
-# HTTP request timeout in seconds
-TIMEOUT = 5.0
+# Maximum number of symbols to request per tickers call
+TICKERS_PER_REQUEST = 200
 
 class Client(object):
     """
@@ -22,14 +24,14 @@ class Client(object):
     See https://www.bitfinex.com/pages/api for API documentation.
     """
 
-    def server(self):
-        return "%s://%s/%s" % (PROTOCOL, HOST, VERSION)
+    def server(self, version=VERSION):
+        return "%s://%s/%s" % (PROTOCOL, HOST, version)
 
 
-    def url_for(self, path, path_arg=None, parameters=None):
+    def url_for(self, path, path_arg=None, parameters=None, version=VERSION):
 
         # build the basic url
-        url = "%s/%s" % (self.server(), path)
+        url = "%s/%s" % (self.server(version), path)
 
         # If there is a path_arh, interpolate it into the URL.
         # In this case the path that was provided will need to have string
@@ -72,6 +74,44 @@ class Client(object):
         return self._convert_to_floats(data)
 
 
+    def tickers(self, symbols):
+        """
+        GET /v2/tickers?symbols=tBTCUSD,tLTCUSD
+
+        curl "https://api.bitfinex.com/v2/tickers?symbols=tBTCUSD,tLTCBTC"
+        [
+            ["tBTCUSD",562.25,1.5,562.9999,2.1,-1.2,-0.002,562.25,7305.33,572.2398,550.09],
+            ["tLTCBTC",0.0175,40.0,0.0176,31.5,0.0001,0.005,0.0176,1203.7,0.018,0.0172]
+        ]
+
+        Takes a list of v1 style symbols (like 'btcusd') and fetches their
+        tickers TICKERS_PER_REQUEST at a time. Returns a dict mapping each
+        v1 style symbol to a dict of floats in the same form that ticker()
+        returns. Symbols the exchange doesn't report are left out.
+        """
+        symbols = list(symbols)
+        result = {}
+        for i in range(0, len(symbols), TICKERS_PER_REQUEST):
+            chunk = symbols[i:i+TICKERS_PER_REQUEST]
+            parameters = {"symbols": ",".join(["t" + s.upper() for s in chunk])}
+            data = self._get(self.url_for(PATH_TICKERS, parameters=parameters,
+                                          version=VERSION_V2))
+            for item in data:
+                # skip funding tickers and anything malformed
+                if len(item) < 11 or not item[0].startswith("t"):
+                    continue
+                result[item[0][1:].lower()] = {
+                    "bid": float(item[1]),
+                    "ask": float(item[3]),
+                    "mid": (float(item[1]) + float(item[3])) / 2.0,
+                    "last_price": float(item[7]),
+                    "volume": float(item[8]),
+                    "high": float(item[9]),
+                    "low": float(item[10])
+                }
+        return result
+
+
     def today(self, symbol):
         """
         GET /today/:symbol
@@ -179,7 +219,7 @@ class Client(object):
 
 
     def _get(self, url):
-        return requests.get(url, timeout=TIMEOUT).json()
+        return transport.get(url).json()
 
 
     def _build_parameters(self, parameters):
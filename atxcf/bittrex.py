@@ -4,7 +4,7 @@
 
 import urllib
 import time
-import requests
+import transport
 import hmac
 import hashlib
 
@@ -63,7 +63,7 @@ class Bittrex(object):
 
         headers = {"apisign": signature}
 
-        ret = requests.get(request_url, headers=headers)
+        ret = transport.get(request_url, headers=headers)
         return ret.json()
 
     def get_markets(self):
@@ -1,11 +1,17 @@
 # TODO: docstrings plz
+import os
+import json
 import time
 import threading
+import atexit
+from collections import OrderedDict
 import memcached_client
 from settings import (
     get_settings, set_settings, get_settings_option, set_option,
-    get_setting, set_setting
+    get_setting, set_setting, has_setting, remove_setting,
+    get_settings_filename, get_settings_role
 )
+from core import _log_error
 
 class Cache(object):
 
@@ -18,6 +24,32 @@ class Cache(object):
     def set_val(self, key, value, expire=None):
         pass
 
+    def get_many(self, keys):
+        values = {}
+        for key in keys:
+            value = self.get_val(key)
+            if value != None:
+                values[key] = value
+        return values
+
+    def set_many(self, mapping, expire=None):
+        for key, value in mapping.iteritems():
+            self.set_val(key, value, expire)
+
+    def get_val_ttl(self, key):
+        """
+        Returns the value of key and the seconds left until it expires,
+        or None for those if it doesn't expire or the cache can't tell.
+        """
+        return self.get_val(key), None
+
+    def get_many_ttl(self, keys):
+        """
+        Returns a dict of (value, seconds left) for the keys found, like
+        get_val_ttl.
+        """
+        return dict((key, (value, None)) for key, value in self.get_many(keys).iteritems())
+
 
 class MemcachedCache(Cache):
 
@@ -27,43 +59,161 @@ class MemcachedCache(Cache):
     def set_val(self, key, value, expire=None):
         memcached_client.set(key, value, expire)
 
+    def get_many(self, keys):
+        return memcached_client.get_many(keys)
+
+    def set_many(self, mapping, expire=None):
+        memcached_client.set_many(mapping, expire)
+
 
 class SettingsCache(Cache):
+    """
+    Cache kept in memory and written behind to its own JSON file next to
+    the settings file. Changes are flushed every
+    settings_cache_flush_interval seconds and at exit, rather than on
+    every set_val. The file is looked up on use, so a cache created
+    before the settings filename is set follows it.
+    """
 
     def __init__(self, name="default"):
         self._name = name
-        self._cache = self._get_settings_cache()
         self._lock = threading.RLock()
+        self._dirty = False
+        self._flush_thread = None
+        self._filename = None
+        self._cache = {}
+
+
+    def _get_filename(self):
+        return get_settings_option("settings_cache_filename_" + self._name,
+                                   "%s.cache.%s.json" % (get_settings_filename(), self._name))
+
+
+    def _get_cache(self):
+        """
+        Returns the cache for the current file, writing out the one for
+        the previous file if that changed. Callers must hold _lock.
+        """
+        filename = self._get_filename()
+        if filename != self._filename:
+            self._sync_cache()
+            self._filename = filename
+            self._dirty = False
+            self._cache = self._load_cache()
+        return self._cache
 
     
-    def _get_settings_cache(self):
-        return get_setting("cache", self._name, default={})
+    def _load_cache(self):
+        """
+        Loads the cache from its file. Entries left in the settings tree by
+        older versions are moved into the cache file.
+        """
+        cache = {}
+        if os.path.isfile(self._filename):
+            try:
+                with open(self._filename) as f:
+                    cache = json.load(f)
+            except (IOError, ValueError) as e:
+                _log_error(['SettingsCache._load_cache', self._filename, str(e)])
+        if has_setting("cache", self._name) and get_settings_role() != "reader":
+            legacy = get_setting("cache", self._name)
+            legacy.update(cache)
+            cache = legacy
+            remove_setting("cache", self._name)
+            self._dirty = True
+        return cache
+
+
+    def _dumps(self):
+        """
+        Returns the cache as JSON. Entries that can't be written are
+        logged and dropped, rather than failing every flush.
+        """
+        try:
+            return json.dumps(self._cache, separators=(',', ':'))
+        except (TypeError, ValueError):
+            pass
+        for key, value in self._cache.items():
+            try:
+                json.dumps({key: value})
+            except (TypeError, ValueError) as e:
+                _log_error(['SettingsCache._sync_cache', self._filename, repr(key), str(e)])
+                del self._cache[key]
+        return json.dumps(self._cache, separators=(',', ':'))
 
 
     def _sync_cache(self):
+        """
+        Writes the cache to its file if it changed since the last write,
+        dropping expired entries.
+        """
         with self._lock:
-            for key, value in self._cache.iteritems():
-                cur_val = get_setting("cache", self._name, key, default=value)
-                # update the cache on disk if in memory value is newer
-                if cur_val[0] < value[0]:
-                    set_setting("cache", self._name, key, value)
-                    
+            if not self._dirty or not self._filename:
+                return
+            cur_time = time.time()
+            for key, value in self._cache.items():
+                if value[1] > 0 and cur_time - value[0] > value[1]:
+                    del self._cache[key]
+            data = self._dumps()
+            tmp_filename = self._filename + ".tmp"
+            try:
+                with open(tmp_filename, 'w') as f:
+                    f.write(data)
+                try:
+                    os.rename(tmp_filename, self._filename)
+                except OSError:
+                    # windows won't rename over an existing file
+                    os.remove(self._filename)
+                    os.rename(tmp_filename, self._filename)
+            except (IOError, OSError) as e:
+                _log_error(['SettingsCache._sync_cache', self._filename, str(e)])
+                return
+            self._dirty = False
+
+
+    def flush(self):
+        self._sync_cache()
+
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(float(get_settings_option("settings_cache_flush_interval", 60)))
+            try:
+                self._sync_cache()
+            except Exception as e:
+                _log_error(['SettingsCache._flush_periodically', self._filename, str(e)])
+
+
+    def _start_flush_thread(self):
+        if not self._flush_thread:
+            self._flush_thread = threading.Thread(target=self._flush_periodically)
+            self._flush_thread.daemon = True
+            self._flush_thread.start()
+
 
     def clear_cache(self):
         with self._lock:
-            self._cache = {}
-            set_setting("cache", self._name, {})
+            self._get_cache().clear()
+            self._dirty = True
+        self._sync_cache()
 
         
     def get_val(self, key):
+        return self.get_val_ttl(key)[0]
+
+
+    def get_val_ttl(self, key):
         with self._lock:
-            if key in self._cache:
-                timeout = time.time() - self._cache[key][0]
-                expire = self._cache[key][1]
-                if expire > 0 and timeout > expire:
-                    return None
-                return self._cache[key][2]
-            return None
+            cache = self._get_cache()
+            if key in cache:
+                ts, expire, value = cache[key]
+                if expire > 0:
+                    ttl = expire - (time.time() - ts)
+                    if ttl <= 0:
+                        return None, None
+                    return value, ttl
+                return value, None
+            return None, None
 
     
     def set_val(self, key, value, expire=None):
@@ -71,10 +221,77 @@ class SettingsCache(Cache):
             if expire == None:
                 expire = 0
             cache_val = (time.time(), expire, value)
-            self._cache[key] = cache_val
-            set_setting("cache", self._name, key, cache_val)
+            self._get_cache()[key] = cache_val
+            self._dirty = True
+            self._start_flush_thread()
+
+
+    def get_many(self, keys):
+        with self._lock:
+            return super(SettingsCache, self).get_many(keys)
+
+
+    def set_many(self, mapping, expire=None):
+        with self._lock:
+            super(SettingsCache, self).set_many(mapping, expire)
+
+
+    def get_many_ttl(self, keys):
+        with self._lock:
+            values = {}
+            for key in keys:
+                value, ttl = self.get_val_ttl(key)
+                if value != None:
+                    values[key] = (value, ttl)
+            return values
+
+
+class LRUCache(Cache):
+    """
+    Bounded in-memory cache with per-key expiration. When full, the
+    least recently used key is evicted.
+    """
+
+    def __init__(self, max_size=1024, default_expire=60):
+        self._max_size = max_size
+        self._default_expire = default_expire
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
 
 
+    def clear_cache(self):
+        with self._lock:
+            self._cache = OrderedDict()
+
+
+    def get_val(self, key):
+        with self._lock:
+            if not key in self._cache:
+                return None
+            ts, expire, value = self._cache.pop(key)
+            if expire > 0 and time.time() - ts > expire:
+                return None
+            # re-insert to mark it most recently used
+            self._cache[key] = (ts, expire, value)
+            return value
+
+
+    def set_val(self, key, value, expire=None):
+        if expire == None:
+            expire = self._default_expire
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (time.time(), expire, value)
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+
+
+# In-process tier checked before the caches below. Entries without an
+# expiration only live for cache_l1_expiration seconds so values shared
+# through memcached don't go stale here.
+_l1_expiration = get_settings_option("cache_l1_expiration", 60)
+_l1 = LRUCache(get_settings_option("cache_l1_size", 1024), _l1_expiration)
+
 _caches = []
 if memcached_client.enabled():
     _caches.append(MemcachedCache())
@@ -82,11 +299,33 @@ if get_settings_option("using_settings_cache", True):
     _caches.append(SettingsCache())
 
 
-def get_val(key):
+def _promote(key, value, ttl, expire):
+    """
+    Copies a value found in a lower tier into the in-process tier, for no
+    longer than the lower tier still keeps it and the caller's expire.
+    When the lower tier can't tell, cache_l1_expiration bounds it too.
+    """
+    ttls = [t for t in (ttl, expire) if t]
+    if ttl is None and _l1_expiration:
+        ttls.append(_l1_expiration)
+    _l1.set_val(key, value, min(ttls) if ttls else 0)
+
+
+def get_val(key, expire=None):
+    """
+    Returns the cached value for key, or None. A value found below the
+    in-process tier is kept there for at most expire seconds.
+    """
     global _caches
+    value = _l1.get_val(key)
+    if value != None:
+        return value
     for cache in _caches:
         try:
-            return cache.get_val(key)
+            value, ttl = cache.get_val_ttl(key)
+            if value != None:
+                _promote(key, value, ttl, expire)
+            return value
         except:
             pass
     return None
@@ -98,9 +337,74 @@ def has_key(key):
 
 def set_val(key, value, expire=None):
     global _caches
+    if value != None:
+        _l1.set_val(key, value, expire or None)
     for cache in _caches:
         try:
             cache.set_val(key, value, expire)
         except:
             pass
 
+
+def get_many(keys, expire=None):
+    """
+    Returns a dict with the cached value of each key in keys that was
+    found. Keys missing from the in-process tier are looked up with one
+    batched request, and kept there like get_val does.
+    """
+    global _caches
+    values = _l1.get_many(keys)
+    missing = [key for key in keys if not key in values]
+    if not missing:
+        return values
+    for cache in _caches:
+        try:
+            found = cache.get_many_ttl(missing)
+            for key, (value, ttl) in found.iteritems():
+                _promote(key, value, ttl, expire)
+                values[key] = value
+            return values
+        except:
+            pass
+    return values
+
+
+def set_many(mapping, expire=None):
+    """
+    Caches every key, value pair in mapping with one batched request
+    per cache.
+    """
+    global _caches
+    for key, value in mapping.iteritems():
+        if value != None:
+            _l1.set_val(key, value, expire or None)
+    for cache in _caches:
+        try:
+            cache.set_many(mapping, expire)
+        except:
+            pass
+
+
+def flush():
+    """
+    Writes any caches that persist themselves to disk.
+    """
+    global _caches
+    for cache in _caches:
+        if hasattr(cache, "flush"):
+            cache.flush()
+atexit.register(flush)
+
+
+def get_or_compute(key, fn, expire=None):
+    """
+    Returns the cached value for key. On a miss, calls fn to compute
+    the value and caches it before returning it.
+    """
+    value = get_val(key)
+    if value == None:
+        value = fn()
+        if value != None:
+            set_val(key, value, expire)
+    return value
+
@@ -43,6 +43,8 @@ from shares import (
 )
 
 import cache
+from transport import request_priority as _request_priority
+from transport import BACKGROUND as _BACKGROUND
 
 #import coinmarketcap
 
@@ -67,14 +69,16 @@ def keep_prices_updated():
             interval = _get_settings_option("price_update_interval", 60)
             last_prices = {}
             while True:
-                for mkt in get_markets():
-                    last_price = None
-                    if mkt in last_prices:
-                        last_price = last_prices[mkt]
-                    price = get_price(mkt)
-                    if last_price != price:
-                        print "updater: ", time.time(), mkt, price
-                        last_prices[mkt] = price
+                # let interactive requests go ahead of the updater's
+                with _request_priority(_BACKGROUND):
+                    for mkt in get_markets():
+                        last_price = None
+                        if mkt in last_prices:
+                            last_price = last_prices[mkt]
+                        price = get_price(mkt)
+                        if last_price != price:
+                            print "updater: ", time.time(), mkt, price
+                            last_prices[mkt] = price
                 time.sleep(interval)
         print "Launching price updater thread"
         _updater_thread = threading.Thread(target=updater)
@@ -9,21 +9,193 @@ import json
 from json import dumps
 import time
 import threading
+import atexit
 import copy
 import csv
-from collections import defaultdict
+import shutil
+import mmap
+import struct
+import marshal
+import collections
 import uuid
 
 
+class _RecordWriter(object):
+    """
+    Keeps a csv file open and buffers the rows appended to it. Threads
+    that need their rows written at the same time share a single write
+    (and fsync) of everything buffered so far.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._file = None
+        self._rows = []
+        self._num_appended = 0
+        self._num_written = 0
+        self._writing = False
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+
+
+    def append(self, rows):
+        """
+        Buffers rows, to be written together. Returns the number of rows
+        appended so far and the number waiting to be written. Raises an
+        IOError once the writer is closed.
+        """
+        with self._cond:
+            if self._closed:
+                raise IOError("Record writer for %s is closed" % self._filename)
+            self._rows.extend(rows)
+            self._num_appended += len(rows)
+            return self._num_appended, len(self._rows)
+
+
+    def flush(self, num_rows=None, do_fsync=False):
+        """
+        Returns once at least the first num_rows rows appended are written,
+        or all of them if num_rows is None.
+        """
+        with self._cond:
+            if num_rows is None:
+                num_rows = self._num_appended
+            while self._num_written < num_rows:
+                if self._writing:
+                    # another thread is writing, our rows go in the next batch
+                    self._cond.wait()
+                    continue
+                rows = self._rows
+                self._rows = []
+                batch_end = self._num_appended
+                self._writing = True
+                self._cond.release()
+                try:
+                    self._write(rows, do_fsync)
+                finally:
+                    self._cond.acquire()
+                    self._writing = False
+                    self._num_written = batch_end
+                    self._cond.notify_all()
+
+
+    def _write(self, rows, do_fsync):
+        if not self._file:
+            self._file = open(self._filename, 'ab')
+        csv.writer(self._file).writerows(rows)
+        self._file.flush()
+        if do_fsync:
+            os.fsync(self._file.fileno())
+
+
+    def close(self):
+        """
+        Writes out and syncs every row appended, then closes the file.
+        """
+        with self._cond:
+            self._closed = True
+        self.flush(do_fsync=True)
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+_record_writers = collections.OrderedDict()
+_record_writers_lock = threading.Lock()
+_record_flusher = None
+
+
+def _get_record_writer(csv_filename, max_open):
+    """
+    Returns the writer for csv_filename. Only max_open files are kept
+    open, the least recently used one is closed to make room. Must be
+    called with _record_writers_lock held, and the rows appended to the
+    writer before releasing it, so they never go to a closed writer.
+    """
+    global _record_writers
+    csv_filename = os.path.abspath(csv_filename)
+    writer = _record_writers.pop(csv_filename, None)
+    if not writer:
+        writer = _RecordWriter(csv_filename)
+    _record_writers[csv_filename] = writer
+    while len(_record_writers) > max_open:
+        # closed under the lock, so its rows are written before any
+        # new writer for the same file opens it
+        _record_writers.popitem(last=False)[1].close()
+    return writer
+
+
+def flush_records(csv_filename=None, do_fsync=False):
+    """
+    Writes out the records buffered by append_record for csv_filename,
+    or for every file if csv_filename is None.
+    """
+    global _record_writers
+    global _record_writers_lock
+    with _record_writers_lock:
+        if csv_filename:
+            writers = [_record_writers.get(os.path.abspath(csv_filename))]
+        else:
+            writers = _record_writers.values()
+    for writer in writers:
+        if writer:
+            writer.flush(do_fsync=do_fsync)
+# registered before write_settings so it runs after it at exit
+atexit.register(flush_records)
+
+
+def _flush_records_periodically():
+    while True:
+        time.sleep(float(get_option("record_flush_interval", default=1.0)))
+        try:
+            flush_records(do_fsync=get_option("record_fsync", default="never") != "never")
+        except IOError:
+            pass
+
+
+def _start_record_flusher():
+    global _record_flusher
+    if not _record_flusher:
+        _record_flusher = threading.Thread(target=_flush_records_periodically)
+        _record_flusher.daemon = True
+        _record_flusher.start()
+
+
 def append_record(csv_filename, fields):
     """
     Appends record to specified csv file. 'fields' should be
-    a list.
+    a list. The file is kept open and records are buffered until
+    record_buffer_size of them pile up or record_flush_interval seconds
+    pass. The record_fsync option says when to fsync: "never", on every
+    "flush", or "always", which also waits for the record to be written.
+    """
+    _append_rows(csv_filename, [[uuid.uuid1()] + fields])
+
+
+def append_records(csv_filename, records):
+    """
+    Appends a list of records to specified csv file like append_record.
+    The records are written out together, with a single write and fsync.
     """
-    local_fields = [uuid.uuid1()] + fields
-    with open(csv_filename, 'ab') as f:
-        writer = csv.writer(f)
-        writer.writerow(local_fields)
+    _append_rows(csv_filename, [[uuid.uuid1()] + fields for fields in records])
+
+
+def _append_rows(csv_filename, rows):
+    """
+    Appends rows to csv_filename as is, with the buffering of append_record.
+    """
+    buffer_size = int(get_option("record_buffer_size", default=64))
+    fsync = get_option("record_fsync", default="never")
+    max_open = int(get_option("record_max_open_files", default=64))
+    with _record_writers_lock:
+        writer = _get_record_writer(csv_filename, max_open)
+        num_rows, num_buffered = writer.append(rows)
+    _start_record_flusher()
+    if fsync == "always" or num_buffered >= buffer_size:
+        writer.flush(num_rows, fsync != "never")
 
 
 def _log_setting(fields):
@@ -46,15 +218,38 @@ class SettingsError(RuntimeError):
     pass
 
 
+# The settings dict is copy-on-write: writers build a new dict with
+# only the path to the changed setting copied and swap it in under
+# _js_settings_lock. Readers walk whatever snapshot is current without
+# taking the lock, so a snapshot must never be changed in place.
 _js_settings_filename = None
 _js_settings = {}
 _js_settings_ts = 0
+_js_settings_version = 0
 _js_settings_lock = threading.RLock()
+_js_settings_write_lock = threading.Lock()
 _prevent_write = False
 
-# This dictionary stores the callables that are
-# invoked when a setting is changed.
-_settings_change_callbacks = defaultdict(lambda: defaultdict(list))
+
+class _CallbackNode(object):
+    """
+    Node of the change callback tree. Callbacks are kept by kind
+    ("__pre__", "__post__" or "") and then by name, apart from the ones
+    that also watch the paths below the node's.
+    """
+    __slots__ = ("children", "callbacks", "subtree_callbacks")
+
+    def __init__(self):
+        self.children = {}
+        self.callbacks = {}
+        self.subtree_callbacks = {}
+
+
+# The callables invoked when a setting is changed live in a tree that
+# follows the settings paths they were added for, so the callbacks for
+# a change are found by walking down the changed path.
+_settings_change_callbacks = _CallbackNode()
+_settings_change_callbacks_lock = threading.RLock()
 
 
 def _args_list_key(args):
@@ -64,13 +259,38 @@ def _args_list_key(args):
     return "|".join([str(arg) for arg in args])
 
 
+def _callback_kind(name):
+    for kind in ("__pre__", "__post__"):
+        if name.startswith(kind):
+            return kind
+    return ""
+
+
+def _get_callback_node(args, create=False):
+    """
+    Returns the callback tree node for the settings path args, or None
+    if there isn't one and create is False.
+    """
+    node = _settings_change_callbacks
+    for arg in args:
+        next_node = node.children.get(str(arg))
+        if not next_node:
+            if not create:
+                return None
+            next_node = _CallbackNode()
+            node.children[str(arg)] = next_node
+        node = next_node
+    return node
+
+
 def add_settings_change_callback(*args, **kwargs):
     """
-    Use this to set a change callback.
-    TODO: write more about this
+    Use this to set a change callback. The last argument is the callable
+    and the ones before it the settings path to watch. Changes to the
+    path invoke the callable with no arguments. With subtree=True,
+    changes to anything below the path invoke it too.
     """
-    global _settings_change_callbacks
-    global _js_settings_lock
+    global _settings_change_callbacks_lock
 
     if len(args) < 1:
         raise SettingsError("Invalid number of arguments to add_settings_change_callback")
@@ -82,20 +302,24 @@ def add_settings_change_callback(*args, **kwargs):
     args_key = _args_list_key(args[:-1])
     args_cb = args[-1]
     if not callable(args_cb):
-        raise SettingError("Missing callable argument to add_settings_change_callback")
+        raise SettingsError("Missing callable argument to add_settings_change_callback")
     
-    with _js_settings_lock:
-        _settings_change_callbacks[args_key][name].append(args_cb)
+    with _settings_change_callbacks_lock:
+        node = _get_callback_node(args[:-1], create=True)
+        callbacks = node.callbacks
+        if kwargs.get("subtree", False):
+            callbacks = node.subtree_callbacks
+        named = callbacks.setdefault(_callback_kind(name), {})
+        named.setdefault(name, []).append(args_cb)
     return args_key # might be useful to return this
         
 
 def remove_settings_change_callback(*args, **kwargs):
     """
-    Use this to remove a change callback.
-    TODO: write more...
+    Use this to remove the change callbacks added with the name keyword
+    argument for the settings path args.
     """
-    global _settings_change_callbacks
-    global _js_settings_lock
+    global _settings_change_callbacks_lock
 
     name = "default"
     if "name" in kwargs:
@@ -104,8 +328,16 @@ def remove_settings_change_callback(*args, **kwargs):
     args_key = ""
     if len(args) > 0:
         args_key = _args_list_key(args)
-    with _js_settings_lock:
-        del _settings_change_callbacks[args_key][name]
+    with _settings_change_callbacks_lock:
+        node = _get_callback_node(args)
+        if not node:
+            raise KeyError(name)
+        kind = _callback_kind(name)
+        removed = False
+        for callbacks in (node.callbacks, node.subtree_callbacks):
+            removed = callbacks.get(kind, {}).pop(name, None) != None or removed
+        if not removed:
+            raise KeyError(name)
     return args_key
 
 
@@ -114,60 +346,129 @@ def get_settings_change_callbacks(*args, **kwargs):
     Returns the list of callbacks for the specified setting
     arguments.
     """
-    global _settings_change_callbacks
-    global _js_settings_lock
+    global _settings_change_callbacks_lock
 
     prefix = ""
     if "prefix" in kwargs:
         prefix = kwargs["prefix"]
 
-    args_key = ""
-    if len(args) > 0:
-        args_key = _args_list_key(args)
     cbs = []
-    with _js_settings_lock:
-        for name, callbacks in _settings_change_callbacks[args_key].iteritems():
-            if prefix and name.startswith(prefix):
-                for cb in callbacks:
-                    cbs.append(cb) # TODO: clean this up
+    with _settings_change_callbacks_lock:
+        node = _get_callback_node(args)
+        if not node or not prefix:
+            return cbs
+        for named in node.callbacks.values() + node.subtree_callbacks.values():
+            for name, callbacks in named.iteritems():
+                if name.startswith(prefix):
+                    cbs.extend(callbacks)
     return cbs
 
 
-def _invoke_callbacks(*args, **kwargs):
-    for cb in get_settings_change_callbacks(*args, **kwargs):
-        cb()
+def _find_change_callbacks(args, kind):
+    """
+    Returns the callbacks of the kind for a change to the settings path
+    args: the ones watching the subtrees it is in, from the root of the
+    tree down, then the ones watching the path itself.
+    """
+    cbs = []
+    with _settings_change_callbacks_lock:
+        node = _settings_change_callbacks
+        for arg in (None,) + tuple(args):
+            if arg != None:
+                node = node.children.get(str(arg))
+                if not node:
+                    return cbs
+            for callbacks in node.subtree_callbacks.get(kind, {}).itervalues():
+                cbs.extend(callbacks)
+        for callbacks in node.callbacks.get(kind, {}).itervalues():
+            cbs.extend(callbacks)
+    return cbs
+
+
+# When the settings_async_callbacks option is on, post change callbacks
+# run on a dispatcher thread instead of the thread making the change.
+# Paths are queued once no matter how many times they change before
+# the dispatcher gets to them.
+_post_change_queue = collections.OrderedDict()
+_post_change_cond = threading.Condition(threading.Lock())
+_post_change_dispatching = False
+_post_change_dispatcher = None
+
+
+def _dispatch_post_changes():
+    global _post_change_dispatching
+    while True:
+        with _post_change_cond:
+            while not _post_change_queue:
+                _post_change_dispatching = False
+                _post_change_cond.notify_all()
+                _post_change_cond.wait()
+            key, args = _post_change_queue.popitem(last=False)
+            _post_change_dispatching = True
+        for cb in _find_change_callbacks(args, "__post__"):
+            try:
+                cb()
+            except Exception as e:
+                _log_error(['_dispatch_post_changes', key, str(e)])
+
+
+def _queue_post_change(args):
+    global _post_change_dispatcher
+    with _post_change_cond:
+        _post_change_queue[_args_list_key(args)] = args
+        if not _post_change_dispatcher:
+            _post_change_dispatcher = threading.Thread(target=_dispatch_post_changes)
+            _post_change_dispatcher.daemon = True
+            _post_change_dispatcher.start()
+        _post_change_cond.notify_all()
+
+
+def flush_settings_change_callbacks():
+    """
+    Waits until the queued post change callbacks have all run.
+    """
+    with _post_change_cond:
+        while _post_change_queue or _post_change_dispatching:
+            _post_change_cond.wait()
 
 
 def _invoke_pre_change_callbacks(*args):
-    _invoke_callbacks(*args, prefix="__pre__")
+    for cb in _find_change_callbacks(args, "__pre__"):
+        cb()
 
     
 def _invoke_post_change_callbacks(*args):
-    _invoke_callbacks(*args, prefix="__post__")
+    if _raw_option("settings_async_callbacks", False):
+        _queue_post_change(args)
+        return
+    for cb in _find_change_callbacks(args, "__post__"):
+        cb()
 
 
 def add_settings_pre_change_callback(*args, **kwargs):
     """
     Use this to add a pre change callback. Adds a '__pre__' prefix
-    to the name keyword argument.
+    to the name keyword argument and passes subtree on.
     """
     name = "default"
     if "name" in kwargs:
         name = kwargs["name"]
     new_name = "__pre__"+name
-    return add_settings_change_callback(*args, name=new_name)
+    return add_settings_change_callback(*args, name=new_name,
+                                        subtree=kwargs.get("subtree", False))
 
 
 def add_settings_post_change_callback(*args, **kwargs):
     """
     Use this to add a post change callback. Adds a '__post__' prefix
-    to the name keyword argument.
+    to the name keyword argument and passes subtree on.
     """
     name = "default"
     if "name" in kwargs:
         name = kwargs["name"]
     new_name = "__post__"+name
-    return add_settings_change_callback(*args, name=new_name)
+    return add_settings_change_callback(*args, name=new_name,
+                                        subtree=kwargs.get("subtree", False))
 
 
 def remove_settings_pre_change_callback(*args, **kwargs):
@@ -219,6 +520,15 @@ def get_default_program_url():
     return "https://gitlab.catx.io/catx/atxcf"
 
 
+def _default_settings(cur_time):
+    return {
+        "program_url": get_default_program_url(),
+        "version": "0.1",
+        "last_modified": cur_time,
+        "options": {},
+    }
+
+
 _settings_log = None
 def init_settings(do_write=False):
     """
@@ -226,16 +536,13 @@ def init_settings(do_write=False):
     """
     global _js_settings
     global _js_settings_ts
+    global _js_settings_version
     global _js_settings_lock
     with _js_settings_lock:
         cur_time = time.time()
-        _js_settings = {
-            "program_url": get_default_program_url(),
-            "version": "0.1",
-            "last_modified": cur_time,
-            "options": {},
-        }
+        _js_settings = _default_settings(cur_time)
         _js_settings_ts = cur_time
+        _js_settings_version += 1
     if do_write:
         write_settings()
 
@@ -253,22 +560,38 @@ def _get_settings():
     it loads it from disk.
     """
     global _js_settings
+    global _js_settings_ts
+    global _js_settings_version
     global _js_settings_lock
+    if _settings_role == "reader":
+        _refresh_shared_settings()
+    sett = _js_settings
+    if sett:
+        return sett
     doInit = False
     fn = get_settings_filename()
     with _js_settings_lock:
         if not _js_settings:
             # if a settings file doesn't exist, just init with defaults
-            if not os.path.isfile(fn):
+            if not os.path.isfile(fn) and not _has_journal():
                 doInit = True
             else:
                 try:
-                    _js_settings = json.load(open(fn))
-                    _js_settings_ts = get_last_modified(fn)
+                    if os.path.isfile(fn):
+                        sett = json.load(open(fn))
+                        _js_settings_ts = get_last_modified(fn)
+                    else:
+                        sett = _default_settings(time.time())
+                    # bring the snapshot up to date with changes made
+                    # since it was written
+                    _js_settings = _replay_journal(sett)
+                    _js_settings_version += 1
                 except IOError as e:
                     raise SettingsError("Error loading %s: %s" % (fn, e.message))
     if doInit:
         init_settings(True)
+    if _settings_role == "writer" and not _shared_publisher:
+        _start_shared_publisher()
     return _js_settings
 
 
@@ -279,42 +602,155 @@ def get_settings():
     return _get_settings()
 
 
-def get_setting(*args, **kwargs):
+def _raw_option(option, default=None):
     """
-    Use this to get settings in a thread safe way.
-    Use the keyword argument "default" to assign a default value
-    if a setting with the specified name isn't present.
+    Returns an option from the current snapshot without storing the
+    default. For use by the settings machinery itself.
+    """
+    options = _js_settings.get("options")
+    if not isinstance(options, dict):
+        return default
+    return options.get(option, default)
+
+
+def get_settings_version():
+    """
+    Returns a number that is bumped every time the settings change.
+    """
+    return _js_settings_version
+
+
+class SettingsView(collections.Mapping):
+    """
+    Read-only view of a dict in the settings tree. Dicts and lists
+    inside it are wrapped in views as they are accessed.
+    """
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return _settings_view(self._data[key])
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return "SettingsView(%r)" % self._data
+
+    def copy(self):
+        """
+        Returns a deep copy of the viewed dict that is safe to change.
+        """
+        return copy.deepcopy(self._data)
+
+
+class SettingsListView(collections.Sequence):
+    """
+    Read-only view of a list in the settings tree.
+    """
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return SettingsListView(self._data[idx])
+        return _settings_view(self._data[idx])
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return "SettingsListView(%r)" % self._data
+
+    def copy(self):
+        """
+        Returns a deep copy of the viewed list that is safe to change.
+        """
+        return copy.deepcopy(self._data)
+
+
+def _settings_view(value):
+    if isinstance(value, dict):
+        return SettingsView(value)
+    if isinstance(value, list):
+        return SettingsListView(value)
+    return value
+
+
+def _copy_setting(value):
+    if isinstance(value, (dict, list)):
+        return copy.deepcopy(value)
+    return value
+
+
+def _find_setting(args):
+    """
+    Walks the current settings snapshot along args. Returns a
+    (found, value) pair.
+    """
+    sett = _get_settings()
+    for arg in args:
+        if not isinstance(sett, dict) or not arg in sett:
+            return False, None
+        sett = sett[arg]
+    return True, sett
+
+
+def _lookup_setting(args, kwargs, wrap):
+    """
+    Helper for get_setting and get_setting_view. Stores the "default"
+    keyword argument if the setting isn't present, then returns the
+    setting passed through wrap.
     """
-    global _js_settings_ts
-    global _js_settings_lock
     if len(args) < 1:
         raise SettingsError("Invalid number of arguments to get_setting")
     default = None
     if "default" in kwargs:
         default = kwargs["default"]
-    meta = None
-    if "meta" in kwargs:
-        meta = kwargs["meta"]
-    do_set = False
-    with _js_settings_lock:
-        sett = _get_settings()
-        for arg in args[:-1]:
-            if not arg in sett:
-                sett[arg] = {}
-            next_sett = sett[arg]
-            sett = next_sett
-        if not args[-1] in sett:
-            if default == None:
-                return None
-            do_set = True
-        if not do_set:
-            return copy.deepcopy(sett[args[-1]])
+    found, value = _find_setting(args)
+    if not found:
+        if default == None:
+            return None
+        if get_settings_role() == "reader":
+            # readers can't change settings, just hand out the default
+            return wrap(default)
+        local_args = list(args)
+        local_args.append(default)
+        set_setting(*local_args, **kwargs)
+        # try it again, should succeed this time.
+        found, value = _find_setting(args)
+    return wrap(value)
+
+
+def get_setting(*args, **kwargs):
+    """
+    Use this to get settings in a thread safe way.
+    Use the keyword argument "default" to assign a default value
+    if a setting with the specified name isn't present.
+    Returns a copy of dicts and lists so the caller may change them.
+    Callers that only read a dict or list should use get_setting_view,
+    which doesn't copy it.
+    """
+    return _lookup_setting(args, kwargs, _copy_setting)
+
 
-    local_args = list(args)
-    local_args.append(default)
-    set_setting(*local_args, **kwargs)
-    # try it again, should succeed this time.
-    return get_setting(*args, **kwargs)
+def get_setting_view(*args, **kwargs):
+    """
+    Like get_setting, but dicts and lists are returned as read-only
+    views of the current settings snapshot instead of being copied.
+    Later changes to the settings don't show up in a view.
+    """
+    return _lookup_setting(args, kwargs, _settings_view)
 
     
 def has_setting(*args, **kwargs):
@@ -337,16 +773,49 @@ def get_settingslog_filename():
     return _settings_log
 
     
+def _assoc_setting(sett, path, value):
+    """
+    Returns a copy of the sett dict with value stored at path. Only the
+    dicts along path are copied, the rest is shared with sett.
+    """
+    new_sett = dict(sett)
+    if len(path) == 1:
+        new_sett[path[0]] = value
+    else:
+        new_sett[path[0]] = _assoc_setting(sett.get(path[0], {}), path[1:], value)
+    return new_sett
+
+
+def _dissoc_setting(sett, path):
+    """
+    Returns a copy of the sett dict without the entry at path.
+    """
+    new_sett = dict(sett)
+    if len(path) == 1:
+        del new_sett[path[0]]
+    else:
+        new_sett[path[0]] = _dissoc_setting(sett.get(path[0], {}), path[1:])
+    return new_sett
+
+
 def _set_settings(new_settings):
     """
     Replaces the settings dict with the input.
     """
     global _js_settings
     global _js_settings_ts
+    global _js_settings_version
     global _js_settings_lock
+    _check_writable()
+    new_settings = copy.deepcopy(new_settings)
     with _js_settings_lock:
-        _js_settings.update(new_settings)
+        sett = dict(_js_settings)
+        sett.update(new_settings)
+        _journal_append(*[["s", [key], value]
+                          for key, value in new_settings.iteritems()])
+        _js_settings = sett
         _js_settings_ts = time.time()
+        _js_settings_version += 1
 
 
 def set_settings(new_settings):
@@ -360,20 +829,22 @@ def set_setting(*args, **kwargs):
     """
     Use this to set a program setting in a thread safe way.
     """
+    global _js_settings
     global _js_settings_ts
+    global _js_settings_version
     global _js_settings_lock
     if len(args) < 2:
         raise SettingsError("Invalid number of arguments to set_setting")
+    _check_writable()
+    # copied, so the caller changing it later can't change the settings
+    value = copy.deepcopy(args[-1])
     _invoke_pre_change_callbacks(*args[:-1])
     with _js_settings_lock:
-        sett = _get_settings()
-        for arg in args[:-2]:
-            if not arg in sett:
-                sett[arg] = {}
-            next_sett = sett[arg]
-            sett = next_sett
-        sett[args[-2]] = args[-1]
+        sett = _assoc_setting(_get_settings(), args[:-1], value)
+        _journal_append(["s", list(args[:-1]), value])
+        _js_settings = sett
         _js_settings_ts = time.time()
+        _js_settings_version += 1
     _invoke_post_change_callbacks(*args[:-1])
     meta = None
     if "meta" in kwargs:
@@ -385,22 +856,22 @@ def remove_setting(*args, **kwargs):
     """
     Removes a setting entry in the settings dict.
     """
+    global _js_settings
     global _js_settings_ts
+    global _js_settings_version
     global _js_settings_lock
     if len(args) < 1:
         raise SettingsError("Invalid number of arguments to remove_setting")
+    _check_writable()
     meta = None
     if "meta" in kwargs:
         meta = kwargs["meta"]
     with _js_settings_lock:
-        sett = _get_settings()
-        for arg in args[:-1]:
-            if not arg in sett:
-                sett[arg] = {}
-            next_sett = sett[arg]
-            sett = next_sett
-        del sett[args[-1]]
+        sett = _dissoc_setting(_get_settings(), args)
+        _journal_append(["d", list(args)])
+        _js_settings = sett
         _js_settings_ts = time.time()
+        _js_settings_version += 1
         _log_setting([_js_settings_ts] + list(args) + [dumps(meta)])
 
     
@@ -415,14 +886,404 @@ def reload_settings():
     return get_settings()
 
 
+# When the settings_journal option is on, every change is appended to a
+# journal next to the settings file as soon as it is made. The settings
+# file itself becomes a snapshot that write_settings rewrites (compacts)
+# from time to time, after which the journal starts over. Loading reads
+# the snapshot and replays the journal on top of it.
+_journal_file = None
+_journal_filename = None
+_journal_records = 0
+_journal_compactor = None
+
+
+def get_settings_journal_filename():
+    """
+    Returns the settings journal filename.
+    """
+    return "%s.journal" % get_settings_filename()
+
+
+def _has_journal():
+    journal_fn = get_settings_journal_filename()
+    return os.path.isfile(journal_fn) or os.path.isfile(journal_fn + ".old")
+
+
+def _journal_enabled():
+    return bool(_raw_option("settings_journal", False))
+
+
+def _journal_append(*records):
+    """
+    Appends change records to the settings journal if journaling is on.
+    Callers must hold _js_settings_lock and append a change's records
+    before making it, so records are written in the order the changes
+    were made and a change that can't be journaled isn't made.
+    """
+    global _journal_file
+    global _journal_filename
+    global _journal_records
+    if not _journal_enabled():
+        return
+    journal_fn = get_settings_journal_filename()
+    try:
+        lines = "".join([dumps(record, separators=(',', ':')) + "\n"
+                         for record in records])
+        if _journal_file and _journal_filename != journal_fn:
+            _journal_file.close()
+            _journal_file = None
+        if not _journal_file:
+            _journal_file = open(journal_fn, 'a')
+            _journal_filename = journal_fn
+        _journal_file.write(lines)
+        _journal_file.flush()
+    except (IOError, TypeError, ValueError) as e:
+        raise SettingsError("Error writing %s: %s" % (journal_fn, str(e)))
+    _journal_records += len(records)
+    _start_journal_compactor()
+
+
+def _replay_journal(sett):
+    """
+    Applies the changes recorded in the settings journal to the sett
+    dict and returns the result.
+    """
+    journal_fn = get_settings_journal_filename()
+    for cur_fn in (journal_fn + ".old", journal_fn):
+        if not os.path.isfile(cur_fn):
+            continue
+        with open(cur_fn) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # blank, or cut short by a crash mid-write
+                    continue
+                try:
+                    if record[0] == "s":
+                        sett = _assoc_setting(sett, record[1], record[2])
+                    elif record[0] == "d":
+                        sett = _dissoc_setting(sett, record[1])
+                except (KeyError, IndexError, TypeError, AttributeError):
+                    pass
+    return sett
+
+
+def _rotate_journal():
+    """
+    Moves the journal out of the way so a snapshot can be written while
+    new changes go to a fresh journal. Callers must hold _js_settings_lock.
+    """
+    global _journal_file
+    global _journal_records
+    if _journal_file:
+        _journal_file.close()
+        _journal_file = None
+    _journal_records = 0
+    journal_fn = get_settings_journal_filename()
+    if not os.path.isfile(journal_fn):
+        return
+    old_fn = journal_fn + ".old"
+    if os.path.isfile(old_fn):
+        # left behind by a write that didn't finish, keep its records
+        with open(old_fn, 'a') as old_f:
+            old_f.write("\n")
+            with open(journal_fn) as f:
+                shutil.copyfileobj(f, old_f)
+        os.remove(journal_fn)
+    else:
+        os.rename(journal_fn, old_fn)
+
+
+def _compact_periodically():
+    while True:
+        time.sleep(float(get_option("settings_journal_compact_interval", default=300)))
+        if _journal_records > 0:
+            try:
+                write_settings()
+            except SettingsError as e:
+                _log_error(['_compact_periodically', '', str(e)])
+
+
+def _start_journal_compactor():
+    global _journal_compactor
+    if not _journal_compactor:
+        _journal_compactor = threading.Thread(target=_compact_periodically)
+        _journal_compactor.daemon = True
+        _journal_compactor.start()
+
+
+# Processes can share one copy of the settings. The process with the
+# "writer" settings role publishes snapshots of its settings into a
+# memory-mapped file next to the settings file. Processes with the
+# "reader" role map that file and swap in the latest snapshot whenever
+# its sequence number changes, instead of loading the settings file.
+# Readers can't change settings. The sequence number in the header is
+# odd while the writer is in the middle of a snapshot.
+_SHARED_MAGIC = "ATXCFSH1"
+_SHARED_HEADER = struct.Struct("<8sQQ") # magic, sequence number, length
+
+
+class _SharedSnapshot(object):
+    """
+    Memory-mapped settings snapshot file.
+    """
+
+    def __init__(self, filename, writable=False):
+        self.filename = filename
+        self._writable = writable
+        if writable:
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+            self._file = os.fdopen(fd, 'r+b')
+        else:
+            self._file = open(filename, 'rb')
+        self._map = None
+        self._remap()
+
+
+    def _remap(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+        size = os.fstat(self._file.fileno()).st_size
+        if size >= _SHARED_HEADER.size:
+            access = mmap.ACCESS_WRITE if self._writable else mmap.ACCESS_READ
+            self._map = mmap.mmap(self._file.fileno(), size, access=access)
+
+
+    def seq(self):
+        """
+        Returns the sequence number of the latest snapshot, 0 if there
+        is none.
+        """
+        if not self._map:
+            return 0
+        magic, seq, length = _SHARED_HEADER.unpack_from(self._map, 0)
+        if magic != _SHARED_MAGIC:
+            return 0
+        return seq
+
+
+    def read(self):
+        """
+        Returns a (seq, settings) pair for the latest snapshot, or None if
+        nothing has been published.
+        """
+        for attempt in range(1000):
+            if not self._map or len(self._map) < os.fstat(self._file.fileno()).st_size:
+                self._remap()
+            if not self._map:
+                return None
+            magic, seq, length = _SHARED_HEADER.unpack_from(self._map, 0)
+            if magic != _SHARED_MAGIC:
+                return None
+            if seq % 2:
+                time.sleep(0.001)
+                continue
+            end = _SHARED_HEADER.size + length
+            if end > len(self._map):
+                continue
+            payload = self._map[_SHARED_HEADER.size:end]
+            # make sure the writer didn't start over while we were copying
+            if _SHARED_HEADER.unpack_from(self._map, 0)[1] != seq:
+                continue
+            return seq, marshal.loads(payload)
+        raise SettingsError("Couldn't read settings snapshot from %s" % self.filename)
+
+
+    def write(self, sett):
+        """
+        Publishes the sett dict as the latest snapshot.
+        """
+        payload = marshal.dumps(sett)
+        seq = self.seq()
+        if seq % 2:
+            # a writer died in the middle of a snapshot
+            seq += 1
+        end = _SHARED_HEADER.size + len(payload)
+        if not self._map or end > len(self._map):
+            # grow by doubling so readers rarely have to remap
+            size = max(end, 4096, 2 * len(self._map) if self._map else 0)
+            self._file.truncate(size)
+            self._remap()
+        _SHARED_HEADER.pack_into(self._map, 0, _SHARED_MAGIC, seq + 1, 0)
+        self._map[_SHARED_HEADER.size:end] = payload
+        _SHARED_HEADER.pack_into(self._map, 0, _SHARED_MAGIC, seq + 2, len(payload))
+        return seq + 2
+
+
+    def close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+_settings_role = os.environ.get("ATXCF_SETTINGS_ROLE") or None
+_shared_lock = threading.RLock()
+_shared_snapshot = None
+_shared_seq = 0
+_shared_published_version = None
+_shared_next_open = 0
+_shared_publisher = None
+
+
+def get_settings_role():
+    """
+    Returns "writer" or "reader" if this process shares its settings
+    with other processes, else None. Defaults to the ATXCF_SETTINGS_ROLE
+    environment variable.
+    """
+    return _settings_role
+
+
+def set_settings_role(role):
+    """
+    Sets whether this process publishes its settings for other processes
+    ("writer"), uses the settings published by another process ("reader"),
+    or neither (None).
+    """
+    global _settings_role
+    global _shared_snapshot
+    global _shared_seq
+    global _shared_published_version
+    global _shared_next_open
+    if not role in (None, "writer", "reader"):
+        raise SettingsError("Invalid settings role %s" % role)
+    with _shared_lock:
+        if _shared_snapshot:
+            _shared_snapshot.close()
+            _shared_snapshot = None
+        _shared_seq = 0
+        _shared_published_version = None
+        _shared_next_open = 0
+        _settings_role = role
+    if role == "writer":
+        _start_shared_publisher()
+
+
+def get_shared_settings_filename():
+    """
+    Returns the filename of the shared settings snapshot.
+    """
+    return "%s.shm" % get_settings_filename()
+
+
+def _check_writable():
+    if _settings_role == "reader":
+        raise SettingsError("Settings are read-only in a settings reader process")
+
+
+def _get_shared_snapshot(writable):
+    """
+    Returns the snapshot file for the current settings filename, or None
+    if a reader finds none. Callers must hold _shared_lock.
+    """
+    global _shared_snapshot
+    global _shared_seq
+    global _shared_next_open
+    shared_fn = get_shared_settings_filename()
+    if _shared_snapshot and _shared_snapshot.filename != shared_fn:
+        _shared_snapshot.close()
+        _shared_snapshot = None
+        _shared_seq = 0
+    if not _shared_snapshot:
+        if not writable:
+            # don't look for a missing snapshot on every read
+            if time.time() < _shared_next_open:
+                return None
+            _shared_next_open = time.time() + 1.0
+            if not os.path.isfile(shared_fn):
+                return None
+        _shared_snapshot = _SharedSnapshot(shared_fn, writable)
+    return _shared_snapshot
+
+
+def _refresh_shared_settings():
+    """
+    Swaps in the latest published snapshot if it changed.
+    """
+    global _js_settings
+    global _js_settings_version
+    global _shared_seq
+    snapshot = _shared_snapshot
+    if snapshot and snapshot.seq() == _shared_seq:
+        return
+    if not snapshot and time.time() < _shared_next_open:
+        return
+    with _shared_lock:
+        snapshot = _get_shared_snapshot(False)
+        if not snapshot:
+            return
+        seq = snapshot.seq()
+        if seq == 0 or seq == _shared_seq:
+            return
+        published = snapshot.read()
+        if not published:
+            return
+        with _js_settings_lock:
+            _js_settings = published[1]
+            _js_settings_version += 1
+        _shared_seq = published[0]
+
+
+def publish_settings():
+    """
+    Publishes the current settings for settings reader processes if
+    this is the writer process and they changed since the last time.
+    """
+    global _shared_published_version
+    if _settings_role != "writer":
+        return
+    with _shared_lock:
+        sett = _get_settings()
+        version = _js_settings_version
+        snapshot = _get_shared_snapshot(True)
+        if version == _shared_published_version and snapshot.seq() > 0:
+            return
+        try:
+            snapshot.write(sett)
+        except (IOError, OSError, ValueError) as e:
+            raise SettingsError("Error publishing %s: %s" % (snapshot.filename, str(e)))
+        _shared_published_version = version
+
+
+def _publish_periodically():
+    global _shared_publisher
+    while True:
+        time.sleep(float(get_option("settings_shared_interval", default=0.1)))
+        with _shared_lock:
+            if _settings_role != "writer":
+                # stopped being the writer, a new publisher is started
+                # if this process becomes the writer again
+                _shared_publisher = None
+                return
+        try:
+            publish_settings()
+        except SettingsError as e:
+            _log_error(['_publish_periodically', '', str(e)])
+
+
+def _start_shared_publisher():
+    global _shared_publisher
+    if _shared_publisher:
+        return
+    with _shared_lock:
+        if not _shared_publisher:
+            _shared_publisher = threading.Thread(target=_publish_periodically)
+            _shared_publisher.daemon = True
+            _shared_publisher.start()
+
+
 def write_settings():
     """
-    Writes the settings dict to disk.
+    Writes the settings dict to disk. This also compacts the settings
+    journal, if there is one.
     """
     global _js_settings_ts
     global _js_settings_lock
     global _prevent_write
-    if _prevent_write:
+    if _prevent_write or get_settings_role() == "reader":
         return
 
     fn = get_settings_filename()
@@ -430,13 +1291,32 @@ def write_settings():
     #    return
     
     set_setting("last_modified", _js_settings_ts)
-    with _js_settings_lock:
+    with _js_settings_write_lock:
+        with _js_settings_lock:
+            sett = _get_settings()
+            try:
+                _rotate_journal()
+            except (IOError, OSError) as e:
+                raise SettingsError("Error rotating %s: %s" % (get_settings_journal_filename(),
+                                                               str(e)))
+        # the snapshot is never changed in place, so it can be written
+        # without holding up readers or writers
+        tmp_fn = fn + ".tmp"
         try:
-            with open(fn, 'w') as f:
-                json.dump(_get_settings(), f, sort_keys=True,
+            with open(tmp_fn, 'w') as f:
+                json.dump(sett, f, sort_keys=True,
                           indent=4, separators=(',', ': '))
-        except IOError as e:
-            raise SettingsError("Error writing %s: %s" % (fn, e.message))
+            try:
+                os.rename(tmp_fn, fn)
+            except OSError:
+                # windows won't rename over an existing file
+                os.remove(fn)
+                os.rename(tmp_fn, fn)
+            old_fn = get_settings_journal_filename() + ".old"
+            if os.path.isfile(old_fn):
+                os.remove(old_fn)
+        except (IOError, OSError) as e:
+            raise SettingsError("Error writing %s: %s" % (fn, str(e)))
     #_js_settings_ts = get_last_modified(fn)
 
 
@@ -555,13 +1435,16 @@ class BlockWrite(object):
         _prevent_write = False
     
 
-import atexit
+atexit.register(publish_settings)
 atexit.register(write_settings)
+# registered after write_settings so changes made by callbacks are saved
+atexit.register(flush_settings_change_callbacks)
 
 
 def _sync_settings():
     global _js_settings
     global _js_settings_ts
+    global _js_settings_version
     global _js_settings_lock
     
     while True:
@@ -589,10 +1472,10 @@ def _sync_settings():
                     with _js_settings_lock:
                         _js_settings = json.load(f)
                         _js_settings_ts = file_js_settings_ts
+                        _js_settings_version += 1
         finally:
             write_settings()
 
-get_settings()
 #_js_sync_thread = threading.Thread(target=_sync_settings)
 #_js_sync_thread.daemon = True
 #_js_sync_thread.start()
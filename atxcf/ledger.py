@@ -0,0 +1,302 @@
+"""
+Ledger engine keeping account balances for the accounts module.
+
+Balances are kept in memory, indexed by account and asset ids, instead
+of in the settings tree. Every change is appended to the ledger file,
+so the balances can be rebuilt by replaying it. The rows are:
+
+    i, ledger_id                           names the ledger
+    a, account_id, account                 assigns an account id
+    s, asset_id, asset                     assigns an asset id
+    b, account_id, asset_id, amount        sets a balance
+
+Each group of changes is flushed and synced to the file before it is
+applied in memory. When loaded, the file is compacted down to one row
+per balance if it has grown much longer than that.
+"""
+import os
+import csv
+import threading
+from cStringIO import StringIO
+
+from core import SettingsError
+
+
+class _Index(object):
+    """
+    The ids and balances of a ledger. The getters take the ledger's
+    index once, so they never see one that is replaced half way through.
+    """
+
+    def __init__(self):
+        self.account_ids = {}
+        self.accounts = []
+        self.asset_ids = {}
+        self.assets = []
+        self.balances = [] # by account id, dicts of amounts by asset id
+        self.holders = [] # by asset id, dicts of positive amounts by account id
+
+
+class Ledger(object):
+
+    def __init__(self, filename, read_only=False):
+        self.filename = filename
+        self.ledger_id = None
+        self._read_only = read_only
+        self._lock = threading.RLock()
+        self._index = _Index()
+        self._num_rows = 0
+        self._offset = 0
+        self._inode = None
+        self._file = None
+        with self._lock:
+            self._read()
+            if not read_only and self._num_rows > max(1024, 4 * self._num_live_rows()):
+                self._compact()
+
+
+    def _apply(self, index, row):
+        kind = row[0]
+        if kind == "b":
+            self._set(index, int(row[1]), int(row[2]), float(row[3]))
+        elif kind == "a":
+            account_id = int(row[1])
+            assert account_id == len(index.accounts)
+            # the id is published last for the lock-free readers
+            index.accounts.append(row[2])
+            index.balances.append({})
+            index.account_ids[row[2]] = account_id
+        elif kind == "s":
+            asset_id = int(row[1])
+            assert asset_id == len(index.assets)
+            index.assets.append(row[2])
+            index.holders.append({})
+            index.asset_ids[row[2]] = asset_id
+        elif kind == "i":
+            self.ledger_id = row[1]
+        self._num_rows += 1
+
+
+    def _set(self, index, account_id, asset_id, amount):
+        index.balances[account_id][asset_id] = amount
+        if amount > 0.0:
+            index.holders[asset_id][account_id] = amount
+        else:
+            index.holders[asset_id].pop(account_id, None)
+
+
+    def _read(self):
+        """
+        Applies the complete rows added to the ledger file since it was
+        last read. If the file was replaced, it is read into a new index
+        which then takes the place of the old one.
+        """
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return
+        index = self._index
+        if stat.st_ino != self._inode:
+            index = _Index()
+            self.ledger_id = None
+            self._num_rows = 0
+            self._offset = 0
+            self._inode = stat.st_ino
+        if stat.st_size > self._offset:
+            with open(self.filename, "rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+            # the last row may still be being written
+            end = data.rfind("\n") + 1
+            for row in csv.reader(data[:end].splitlines()):
+                if row:
+                    self._apply(index, row)
+            self._offset += end
+        self._index = index
+
+
+    def _num_live_rows(self):
+        index = self._index
+        return (1 + len(index.accounts) + len(index.assets) +
+                sum(len(balances) for balances in index.balances))
+
+
+    def _rows(self):
+        """
+        Yields the rows of a compacted ledger.
+        """
+        index = self._index
+        if self.ledger_id:
+            yield ["i", self.ledger_id]
+        for account_id, account in enumerate(index.accounts):
+            yield ["a", account_id, account]
+        for asset_id, asset in enumerate(index.assets):
+            yield ["s", asset_id, asset]
+        for account_id, balances in enumerate(index.balances):
+            for asset_id, amount in balances.iteritems():
+                yield ["b", account_id, asset_id, repr(amount)]
+
+
+    def _compact(self):
+        """
+        Replaces the ledger file with one holding a row per balance.
+        """
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            csv.writer(f).writerows(self._rows())
+            f.flush()
+            os.fsync(f.fileno())
+        self.close()
+        os.rename(tmp_filename, self.filename)
+        stat = os.stat(self.filename)
+        self._inode = stat.st_ino
+        self._offset = stat.st_size
+        self._num_rows = self._num_live_rows()
+
+
+    def _check_writable(self):
+        if self._read_only:
+            raise SettingsError("Balances are read-only in a settings reader process")
+
+
+    def _append(self, rows):
+        """
+        Writes rows to the ledger file and syncs it. If that fails, the
+        rows already written are cut off again so none of the group is
+        replayed.
+        """
+        buf = StringIO()
+        csv.writer(buf).writerows(rows)
+        data = buf.getvalue()
+        if not self._file:
+            self._file = open(self.filename, "ab")
+        size = os.fstat(self._file.fileno()).st_size
+        try:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except (IOError, OSError):
+            self.close()
+            with open(self.filename, "r+b") as f:
+                f.truncate(size)
+            raise
+        self._num_rows += len(rows)
+        if self._offset == size:
+            self._offset += len(data)
+
+
+    def is_empty(self):
+        """
+        Returns whether the ledger file is missing or holds no rows.
+        """
+        return self._num_rows == 0
+
+
+    def create(self, ledger_id):
+        """
+        Starts a new ledger named ledger_id. Refuses to touch a ledger
+        file that already holds rows.
+        """
+        self._check_writable()
+        with self._lock:
+            self._read()
+            if not self.is_empty():
+                raise SettingsError("Ledger %s already exists" % self.filename)
+            self.ledger_id = ledger_id
+            self._append([["i", ledger_id]])
+
+
+    def refresh(self):
+        """
+        Picks up the changes another process appended to the ledger file.
+        """
+        with self._lock:
+            self._read()
+
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+    def get_accounts(self):
+        return list(self._index.accounts)
+
+
+    def get_assets(self, account):
+        """
+        Returns the assets account has a balance of.
+        """
+        index = self._index
+        account_id = index.account_ids.get(account)
+        if account_id is None:
+            return []
+        return [index.assets[asset_id] for asset_id in index.balances[account_id].keys()]
+
+
+    def get_holders(self, asset):
+        """
+        Returns a dict of the accounts holding a positive balance of
+        asset and their balances.
+        """
+        index = self._index
+        asset_id = index.asset_ids.get(asset)
+        if asset_id is None:
+            return {}
+        return dict((index.accounts[account_id], amount)
+                    for account_id, amount in index.holders[asset_id].items())
+
+
+    def get_balance(self, account, asset):
+        index = self._index
+        account_id = index.account_ids.get(account)
+        asset_id = index.asset_ids.get(asset)
+        if account_id is None or asset_id is None:
+            return 0.0
+        return index.balances[account_id].get(asset_id, 0.0)
+
+
+    def set_balance(self, account, asset, amount):
+        self.set_balances([(account, asset, amount)])
+
+
+    def set_balances(self, balances):
+        """
+        Sets a list of (account, asset, amount) balances, appending them
+        to the ledger file as a group. Nothing changes in memory until
+        the group is in the file.
+        """
+        self._check_writable()
+        with self._lock:
+            index = self._index
+            rows = []
+            changes = []
+            new_accounts = {}
+            new_assets = {}
+            for account, asset, amount in balances:
+                amount = float(amount)
+                account_id = index.account_ids.get(account, new_accounts.get(account))
+                if account_id is None:
+                    account_id = len(index.accounts) + len(new_accounts)
+                    rows.append(["a", account_id, account])
+                    new_accounts[account] = account_id
+                asset_id = index.asset_ids.get(asset, new_assets.get(asset))
+                if asset_id is None:
+                    asset_id = len(index.assets) + len(new_assets)
+                    rows.append(["s", asset_id, asset])
+                    new_assets[asset] = asset_id
+                rows.append(["b", account_id, asset_id, repr(amount)])
+                changes.append((account_id, asset_id, amount))
+            self._append(rows)
+            for account, account_id in sorted(new_accounts.items(), key=lambda item: item[1]):
+                index.accounts.append(account)
+                index.balances.append({})
+                index.account_ids[account] = account_id
+            for asset, asset_id in sorted(new_assets.items(), key=lambda item: item[1]):
+                index.assets.append(asset)
+                index.holders.append({})
+                index.asset_ids[asset] = asset_id
+            for account_id, asset_id, amount in changes:
+                self._set(index, account_id, asset_id, amount)
@@ -1,8 +1,8 @@
 import json
 import threading
-import socket
-from pymemcache.client.base import Client
-from settings import get_settings_option, set_option
+from pymemcache.client.hash import HashClient
+from settings import get_settings_option
+from core import _log_error
 
 def json_serializer(key, value):
     if type(value) == str:
@@ -47,14 +47,68 @@ def readonly():
     return get_settings_option("memcached_readonly", True)
 
 
+def pool_size():
+    """
+    Returns the maximum number of pooled connections per server.
+    """
+    return int(get_settings_option("memcached_pool_size", default=16))
+
+
+def timeout():
+    """
+    Returns the connect and socket timeout in seconds for memcached requests.
+    """
+    return float(get_settings_option("memcached_timeout", default=1.0))
+
+
+def retry_attempts():
+    """
+    Returns how many times a failing server is retried before it is
+    considered dead.
+    """
+    return int(get_settings_option("memcached_retry_attempts", default=2))
+
+
+def retry_timeout():
+    """
+    Returns the number of seconds to wait before retrying a failing server.
+    """
+    return float(get_settings_option("memcached_retry_timeout", default=1.0))
+
+
+def dead_timeout():
+    """
+    Returns the number of seconds a dead server is left out of rotation
+    before it is tried again.
+    """
+    return float(get_settings_option("memcached_dead_timeout", default=60.0))
+
+
 _client_lock = threading.RLock()
 _client = None
 def _get_client():
+    """
+    Returns a client that spreads keys across all of the configured
+    servers by consistent (rendezvous) hashing. Each server gets its own
+    thread safe connection pool. A server that keeps failing is taken out
+    of rotation for dead_timeout seconds instead of disabling memcached,
+    and keys that hash to it miss in the meantime.
+    """
     global _client
     if not _client:
-        # TODO: use all the servers listed in the settings file
-        _client = Client(tuple(servers()[0]), serializer=json_serializer,
-                         deserializer=json_deserializer)
+        with _client_lock:
+            if not _client:
+                _client = HashClient([tuple(server) for server in servers()],
+                                     serializer=json_serializer,
+                                     deserializer=json_deserializer,
+                                     connect_timeout=timeout(),
+                                     timeout=timeout(),
+                                     use_pooling=True,
+                                     max_pool_size=pool_size(),
+                                     retry_attempts=retry_attempts(),
+                                     retry_timeout=retry_timeout(),
+                                     dead_timeout=dead_timeout(),
+                                     ignore_exc=True)
     return _client
 
 
@@ -68,27 +122,53 @@ def set(some_key, some_value, expire=None):
         if not expire:
             expire = default_key_expiration()
         try:
-            with _client_lock:
-                _get_client().set(some_key, some_value, expire=expire)
-        except socket.error:
-            # disable using memcached if we can't connect
-            set_option("using_memcached", False)
-            # TODO: log this event
+            _get_client().set(some_key, some_value, expire=expire)
+        except Exception as e:
+            _log_error(['memcached_client.set', some_key, str(e)])
 
 
 def get(some_key):
     if not enabled():
         return None
     try:
-        with _client_lock:
-            return _get_client().get(some_key)
-    except KeyError:
+        return _get_client().get(some_key)
+    except Exception as e:
+        _log_error(['memcached_client.get', some_key, str(e)])
         return None
-    except socket.error:
-        # disable using memcached if we can't connect
-        set_option("using_memcached", False)
-        # TODO: log this event
 
 
 def has_key(some_key):
     return get(some_key) != None
+
+
+def set_many(values, expire=None):
+    """
+    Stores every key, value pair in the values dict, sending one
+    multi-set per server.
+    """
+    if readonly() or not values:
+        return
+    if enabled():
+        if not expire:
+            expire = default_key_expiration()
+        try:
+            _get_client().set_many(values, expire=expire)
+        except Exception as e:
+            _log_error(['memcached_client.set_many', '', str(e)])
+
+
+def get_many(some_keys):
+    """
+    Returns a dict with the value of each key in some_keys that was found,
+    sending one multi-get per server. Keys on a dead server are left out.
+    """
+    if not enabled() or not some_keys:
+        return {}
+    try:
+        values = _get_client().get_many(some_keys)
+    except Exception as e:
+        _log_error(['memcached_client.get_many', '', str(e)])
+        return {}
+    # HashClient reports keys it couldn't reach as False
+    return dict((key, value) for key, value in values.iteritems()
+                if value is not None and value is not False)
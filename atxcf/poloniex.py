@@ -10,7 +10,7 @@ import urllib2
 import json
 import time
 import hmac,hashlib
-import requests
+import transport
 
 
 def createTimeStamp(datestr, format="%Y-%m-%d %H:%M:%S"):
@@ -36,7 +36,7 @@ class poloniex:
 
     def api_query(self, uri,  type='GET', payload={}):
         if type == 'GET':
-            r = requests.get(uri, params=payload)
+            r = transport.get(uri, params=payload)
             if r.status_code != 200:
                 r.raise_for_status()
             return json.loads(r.text)
@@ -48,7 +48,7 @@ class poloniex:
                 'Sign': sign,
                 'Key': self.APIKey
             }
-            r = requests.post(uri, data=payload, headers=headers)
+            r = transport.post(uri, data=payload, headers=headers)
 
             if r.status_code != 200:
                 r.raise_for_status()
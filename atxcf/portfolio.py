@@ -1,5 +1,12 @@
-from accounts import get_assets, get_balance
-from PriceNetwork import get_prices, get_nav
+import threading
+from collections import defaultdict
+
+from accounts import (
+    get_assets, get_balance, get_ledger_id, add_post_set_balance_callback
+)
+from settings import get_settings_role
+import PriceNetwork
+from PriceNetwork import get_prices, get_nav, PriceNetworkError
 
 
 def get_portfolio(name):
@@ -24,10 +31,73 @@ def get_portfolio_values(name, base_asset):
     return get_prices(port, base_asset)
 
 
+# Cached NAVs by portfolio name and base asset, as (nav, ledger id, edge
+# rates used) tuples. A portfolio's NAVs are dropped when one of its
+# balances changes, and a NAV is recomputed when the rate of an edge it
+# was priced through changes or expires.
+_nav_cache = defaultdict(dict)
+_nav_cache_gens = defaultdict(int)
+_nav_cache_lock = threading.Lock()
+
+
+def _drop_portfolio_navs(name, asset, amount, cur_time=None, meta={}):
+    with _nav_cache_lock:
+        _nav_cache_gens[name] += 1
+        _nav_cache.pop(name, None)
+add_post_set_balance_callback("portfolio_nav", _drop_portfolio_navs)
+
+
+def _edge_rates_current(edge_rates):
+    """
+    Returns whether the price network still has the same rates for
+    the edges in edge_rates.
+    """
+    pn = PriceNetwork.instance()
+    for (from_asset, to_asset), rate in edge_rates.iteritems():
+        entry = pn.get_edge_rate(from_asset, to_asset)
+        if not entry or abs(entry[0] - rate) > abs(rate) * 1e-12:
+            return False
+    return True
+
+
 def get_portfolio_nav(name, base_asset):
     """
     Returns the specified portfolio's net asset value in
     terms of the base_asset.
     """
-    return get_nav(get_portfolio(name), base_asset)
+    # other processes change the balances a settings reader sees
+    if get_settings_role() == "reader":
+        return get_nav(get_portfolio(name), base_asset)
+
+    ledger_id = get_ledger_id()
+    with _nav_cache_lock:
+        entry = _nav_cache[name].get(base_asset)
+        gen = _nav_cache_gens[name]
+    if entry and entry[1] == ledger_id and _edge_rates_current(entry[2]):
+        return entry[0]
 
+    edge_rates = {}
+    portfolio = get_portfolio(name)
+    try:
+        prices = get_prices(portfolio, base_asset, edge_rates)
+    except PriceNetworkError:
+        # one asset without a route fails the whole batch, so price them
+        # one at a time and leave out the ones that can't be priced
+        prices = {}
+        for asset, balance in portfolio.iteritems():
+            try:
+                prices.update(get_prices({asset: balance}, base_asset))
+            except PriceNetworkError:
+                pass
+    nav = 0.0
+    for asset, item in prices.iteritems():
+        nav += item[1]
+    # an asset left unpriced leaves no rate to notice it being priced
+    # later, so a NAV leaving one out isn't cached
+    if len(prices) < len(portfolio):
+        return nav
+    with _nav_cache_lock:
+        # don't cache it if the balances changed while computing it
+        if _nav_cache_gens[name] == gen:
+            _nav_cache[name][base_asset] = (nav, ledger_id, edge_rates)
+    return nav
@@ -1,13 +1,13 @@
 import time
 from portfolio import get_portfolio_nav, get_portfolio
 from accounts import (
-    set_balance, transfer, inc_balance, dec_balance, has_user,
-    get_users, get_balance, add_post_set_balance_callback,
-    add_user
+    set_balance, transfer, transfer_batch, inc_balance, dec_balance, has_user,
+    get_users, get_balance,
+    add_user, get_holders
 )
 from settings import get_setting, set_setting, get_settings_filename
-import cmd
-from utils import append_record
+import PriceNetwork
+from utils import append_record, append_records
 from PriceSource import PriceSource
 from PriceNetwork import add_source
 
@@ -160,20 +160,6 @@ def get_num_shares_outstanding(portfolio_name):
     return get_setting("shares", portfolio_name, "outstanding", default=0)
 
 
-# Keep the shares outstanding updated.
-def _post_set_portfolio_share_balance(name, asset, amount, cur_time=None, meta={}):
-    if name == asset:
-        set_setting("shares", asset, "outstanding", abs(float(amount)))
-add_post_set_balance_callback("shares_outstanding", _post_set_portfolio_share_balance)
-
-
-# Keep the list of shareholders updated.
-def _post_set_portfolio_shareholders(name, asset, amount, cur_time=None, meta={}):
-    if has_shares(asset):
-        set_setting("shares", asset, "shareholders", name, amount)
-add_post_set_balance_callback("shareholders", _post_set_portfolio_shareholders)
-
-
 def get_portfolio_nav_share_ratio(portfolio_name, base_asset):
     """
     Returns the exchange rate for one share of the specified
@@ -198,24 +184,24 @@ def is_shareholder(portfolio_name, shareholder_name):
     return get_balance(shareholder_name, portfolio_name) > 0
 
 
-def get_shareholder_names(portfolio_name):
-    shareholder_names = []
-    for user in get_users():
-        if is_shareholder(portfolio_name, user):
-            shareholder_names.append(user)
-    return shareholder_names
+def get_shareholders(portfolio_name):
+    """
+    Returns a dict of the shareholders of the specified portfolio and
+    their balances of its shares. The ledger keeps an index of the
+    holders of every asset, so this doesn't look at every user.
+    """
+    if not has_user(portfolio_name):
+        raise SharesError("Invalid portfolio: %s" % portfolio_name)
+    return dict((user, balance) for user, balance
+                in get_holders(portfolio_name).iteritems() if has_user(user))
 
 
-def get_shareholders(portfolio_name):
-    shareholders = {}
-    for user in get_users():
-        if is_shareholder(portfolio_name, user):
-            shareholders[user] = get_balance(user, portfolio_name)
-    return shareholders
+def get_shareholder_names(portfolio_name):
+    return get_shareholders(portfolio_name).keys()
 
 
 def get_num_shareholders(portfolio_name):
-    return len(get_shareholder_names(portfolio_name))
+    return len(get_shareholders(portfolio_name))
 
 
 def has_shares(portfolio_name):
@@ -253,8 +239,9 @@ def grant_shares(portfolio_name, shareholder_name, num_shares_to_grant):
         "xch_rate": xch_rate,
         "serial_no": _next_serial_no
     }
-    transfer(portfolio_name, shareholder_name, portfolio_name,
-             num_shares_to_grant, cur_time, meta)
+    transfer_batch([(portfolio_name, shareholder_name, portfolio_name,
+                     num_shares_to_grant)], cur_time, meta,
+                   issuer=portfolio_name)
 
     fields = ["grant", cur_time, _next_serial_no, shareholder_name,
               num_shares_to_grant, "", 0.0, xch_rate]
@@ -299,16 +286,19 @@ def create_shares(portfolio_name, shareholder_name, assets):
             xch_rates[asset] = get_portfolio_nav_share_ratio(portfolio_name,
                                                              asset)
         else:
-            xch_rates[asset] = cmd.get_price(initial_rate,
-                                             initial_rate_asset,
-                                             asset)
+            xch_rates[asset] = PriceNetwork.get_price(initial_rate,
+                                                      initial_rate_asset,
+                                                      asset)
 
     fee_rate = get_share_creation_fee_rate(portfolio_name) / 100.0 # normalized from percent
     fee_account = get_share_creation_fee_account(portfolio_name)
     if not has_user(fee_account):
         add_user(fee_account)
     
-    share_balance_per_asset = {}
+    # make every transfer at once, so either the shares are all created
+    # or none are
+    transfers = []
+    records = []
     for asset, balance in assets.iteritems():
         if asset == portfolio_name:
             continue
@@ -324,24 +314,22 @@ def create_shares(portfolio_name, shareholder_name, assets):
             "fee": fee_rate
         }
         
-        # TODO: check for sufficient shareholder balances
-
         # extract fee if any
         if fee_rate != 0.0:
-            transfer(shareholder_name, fee_account, asset, balance * fee_rate,
-                     cur_time, meta)
+            transfers.append((shareholder_name, fee_account, asset,
+                              balance * fee_rate, meta))
                        
-        transfer(shareholder_name, portfolio_name, asset, balance,
-                 cur_time, meta)
-        transfer(portfolio_name, shareholder_name, portfolio_name,
-                 new_shares, cur_time, meta)
+        transfers.append((shareholder_name, portfolio_name, asset, balance, meta))
+        transfers.append((portfolio_name, shareholder_name, portfolio_name,
+                          new_shares, meta))
         
-        fields = ["create", cur_time, _next_serial_no, shareholder_name,
-                  new_shares, asset, balance, xch_rate]
-        append_record(get_shares_logfile_name(portfolio_name), fields)
-
+        records.append(["create", cur_time, _next_serial_no, shareholder_name,
+                        new_shares, asset, balance, xch_rate])
         _next_serial_no += 1
-        set_setting("shares", "serial_no", _next_serial_no)
+
+    transfer_batch(transfers, cur_time, issuer=portfolio_name)
+    append_records(get_shares_logfile_name(portfolio_name), records)
+    set_setting("shares", "serial_no", _next_serial_no)
         
 
 def redeem_shares(portfolio_name, shareholder_name, num_shares_to_redeem):
@@ -377,6 +365,8 @@ def redeem_shares(portfolio_name, shareholder_name, num_shares_to_redeem):
     if not has_user(fee_account):
         add_user(fee_account)
                        
+    transfers = []
+    records = []
     for asset, balance in portfolio.iteritems():
         xch_rate = xch_rates[asset]
         value = balance * redemption_ratio
@@ -387,25 +377,24 @@ def redeem_shares(portfolio_name, shareholder_name, num_shares_to_redeem):
             "fee": fee_rate
         }
 
+        transfers.append((portfolio_name, shareholder_name, asset, value, meta))
+
         # extract fee if any
         if fee_rate != 0.0:
-            transfer(shareholder_name, fee_account, asset,
-                     value * fees,
-                     cur_time, meta)
-        
-        transfer(portfolio_name, shareholder_name, asset,
-                 value, cur_time, meta)
-        
-        fields = ["redeem", cur_time, _next_serial_no, shareholder_name,
-                  num_shares_to_redeem, asset, balance, xch_rate]
-        append_record(get_shares_logfile_name(portfolio_name), fields)
+            transfers.append((shareholder_name, fee_account, asset,
+                              value * fee_rate, meta))
         
+        records.append(["redeem", cur_time, _next_serial_no, shareholder_name,
+                        num_shares_to_redeem, asset, balance, xch_rate])
         _next_serial_no += 1
-        set_setting("shares", "serial_no", _next_serial_no)
 
     # Destroy the shares all at once.
-    transfer(shareholder_name, portfolio_name, portfolio_name,
-             num_shares_to_redeem, cur_time, meta)
+    transfers.append((shareholder_name, portfolio_name, portfolio_name,
+                      num_shares_to_redeem, meta))
+
+    transfer_batch(transfers, cur_time)
+    append_records(get_shares_logfile_name(portfolio_name), records)
+    set_setting("shares", "serial_no", _next_serial_no)
 
 
 class PortfolioNAV(PriceSource):
@@ -451,6 +440,7 @@ class PortfolioNAV(PriceSource):
         for portfolio in self.get_shared_portfolios():
             for base_symbol in self.get_base_symbols():
                 mkts.append(portfolio + "/" + base_symbol)
+        self._publish_markets(mkts)
         return mkts
 
 
@@ -501,12 +491,12 @@ class PortfolioNAV(PriceSource):
         if has_shares(from_asset):
             from_value = get_portfolio_nav_share_ratio(from_asset, base_asset)
         else:
-            from_value = cmd.get_price(1.0, from_asset, base_asset)
+            from_value = PriceNetwork.get_price(1.0, from_asset, base_asset)
 
         if has_shares(to_asset):
             to_value = get_portfolio_nav_share_ratio(to_asset, base_asset)
         else:
-            to_value = cmd.get_price(1.0, to_asset, base_asset)
+            to_value = PriceNetwork.get_price(1.0, to_asset, base_asset)
 
         try:
             price = from_value / to_value
@@ -5,6 +5,7 @@ stats module for the atxcf bot. Here we compute various metrics on historical da
 from settings import get_setting, set_setting, has_setting
 from PriceNetwork import get_all_prices
 import cache
+from transport import request_priority, BACKGROUND
 
 import time
 import os
@@ -28,7 +29,9 @@ def log_prices(mkts=None):
         # TODO: break this thread from outside
         
         pre_t = time.time()
-        cur_prices = get_all_prices(mkts)
+        # let interactive requests go ahead of the logger's
+        with request_priority(BACKGROUND):
+            cur_prices = get_all_prices(mkts)
         post_t = time.time()
 
         # only record changes from the last record
@@ -138,9 +141,12 @@ def get_new_price_history_files(market, interval=60*60, file_prefix=None):
     """
     Returns a list of unvisited price history files.
     """
+    all_names = get_price_history_files(file_prefix)
+    visited = cache.get_many([_visited_cache_key(fn, market, interval)
+                              for fn in all_names])
     file_names = []
-    for fn in get_price_history_files(file_prefix):
-        if not _is_visited(fn, market, interval):
+    for fn in all_names:
+        if not _visited_cache_key(fn, market, interval) in visited:
             file_names.append(fn)
     return file_names
 
@@ -251,14 +257,20 @@ def update_candles(market, interval=60*60, file_prefix=None):
     existing candles.
     """
     candles = compute_candles(market, interval, file_prefix)
+    if not candles:
+        return
+    candle_keys = dict((candle_bin, _candle_cache_key(market, interval, candle_bin))
+                       for candle_bin in candles)
+    cur_candles = cache.get_many(candle_keys.values())
+    merged = {}
     for candle_bin, new_candle in candles.iteritems():
-        cur_candle_key = _candle_cache_key(market, interval, candle_bin)
-        cur_candle = cache.get_val(cur_candle_key)
+        cur_candle_key = candle_keys[candle_bin]
+        cur_candle = cur_candles.get(cur_candle_key)
         if not cur_candle:
             cur_candle = make_Candle()
-        cache.set_val(cur_candle_key,
-                      merge_candles(make_Candle(*cur_candle),
-                                    new_candle))
+        merged[cur_candle_key] = merge_candles(make_Candle(*cur_candle),
+                                               new_candle)
+    cache.set_many(merged)
 
 
 def get_candle(market, candle_bin, interval=60*60, file_prefix=None):
@@ -0,0 +1,500 @@
+"""
+HTTP transport used by the exchange clients and price sources.
+
+In live mode requests go straight to the network. In record mode they
+also go to the network and each response is saved to disk, and in
+replay mode the saved responses are served instead, so price sources
+can be exercised with no network. Replay can add latency and inject
+errors to make that closer to the real thing.
+"""
+import os
+import json
+import time
+import heapq
+import base64
+import random
+import hashlib
+import itertools
+import threading
+import urllib
+import urlparse
+from contextlib import contextmanager
+
+import requests
+import requests.exceptions
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from settings import get_settings_option, get_settings_filename
+from core import _log_error
+
+
+# Query and form parameters that change on every request and so are
+# left out of the key a response is saved under.
+_volatile_params = frozenset(["nonce", "apikey", "apisign", "signature"])
+
+# Request priorities, lower goes first when requests to a host queue up.
+INTERACTIVE = 0
+BACKGROUND = 10
+
+# Requests per second and burst size allowed per exchange host. The
+# burst covers what the exchange allows per minute, so a sweep of its
+# markets isn't spread out over minutes.
+_default_rate_limits = {
+    "api.bitfinex.com": [1.5, 90],
+    "bittrex.com": [1.0, 60],
+    "poloniex.com": [6.0, 6],
+    "www.coinexchange.io": [1.0, 5],
+    "api.coinigy.com": [1.0, 5],
+    "cryptoassetcharts.info": [0.5, 2]
+}
+
+
+def mode():
+    """
+    Returns the transport mode, one of live, record or replay. It is
+    live by default.
+    """
+    return get_settings_option("http_transport_mode", default="live")
+
+
+def timeout():
+    """
+    Returns the timeout in seconds for requests that don't set their own.
+    """
+    return float(get_settings_option("http_timeout", default=5.0))
+
+
+def pool_size():
+    """
+    Returns how many connections are kept alive per host.
+    """
+    return int(get_settings_option("http_pool_size", default=10))
+
+
+def host_pool_sizes():
+    """
+    Returns a dict mapping hostnames to how many connections are kept
+    alive to them, for hosts that need more or fewer than pool_size.
+    """
+    return get_settings_option("http_host_pool_sizes", default={})
+
+
+def pool_hosts():
+    """
+    Returns how many hosts connections are kept alive to at once.
+    """
+    return int(get_settings_option("http_pool_hosts", default=16))
+
+
+def rate_limits():
+    """
+    Returns a dict mapping hostnames to the [requests per second, burst]
+    allowed to them. Requests to hosts that aren't listed aren't
+    limited.
+    """
+    return get_settings_option("http_rate_limits", default=_default_rate_limits)
+
+
+def recordings_dir():
+    """
+    Returns the directory responses are recorded to and replayed from.
+    """
+    return get_settings_option("http_recordings_dir",
+                               default="%s.http" % get_settings_filename())
+
+
+def replay_latency():
+    """
+    Returns the fixed number of seconds added to every replayed response.
+    """
+    return float(get_settings_option("http_replay_latency", default=0.0))
+
+
+def replay_latency_scale():
+    """
+    Returns how much of the recorded response time is added to every
+    replayed response. 1.0 replays responses as slowly as they were
+    recorded.
+    """
+    return float(get_settings_option("http_replay_latency_scale", default=0.0))
+
+
+def replay_error_rate():
+    """
+    Returns the probability that a replayed request fails.
+    """
+    return float(get_settings_option("http_replay_error_rate", default=0.0))
+
+
+def replay_error():
+    """
+    Returns how injected errors fail: "connection" or "timeout" raise the
+    corresponding requests exception, and a number returns a response
+    with that HTTP status.
+    """
+    return get_settings_option("http_replay_error", default="connection")
+
+
+def _request_key(method, url, params=None, data=None):
+    """
+    Returns the key a response to the request is saved under.
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    query_params = urlparse.parse_qsl(query, keep_blank_values=True)
+    for extra in (params, data):
+        if isinstance(extra, dict):
+            query_params.extend(extra.iteritems())
+    query_params = sorted((str(k), unicode(v).encode("utf-8")) for k, v in query_params
+                          if not str(k).lower() in _volatile_params)
+    return "%s %s://%s%s?%s" % (method.upper(), scheme, netloc, path,
+                                urllib.urlencode(query_params))
+
+
+def _recording_filename(key):
+    return os.path.join(recordings_dir(), hashlib.sha1(key).hexdigest() + ".json")
+
+
+_priority = threading.local()
+def get_request_priority():
+    """
+    Returns the priority of requests made by the current thread.
+    """
+    return getattr(_priority, "value", INTERACTIVE)
+
+
+@contextmanager
+def request_priority(priority):
+    """
+    Makes requests from the current thread use priority until the
+    with block exits.
+    """
+    prev_priority = get_request_priority()
+    _priority.value = priority
+    try:
+        yield
+    finally:
+        _priority.value = prev_priority
+
+
+_deadline = threading.local()
+def get_request_deadline():
+    """
+    Returns the time by which requests made by the current thread must
+    be answered, or None if they only have the usual timeout.
+    """
+    return getattr(_deadline, "value", None)
+
+
+@contextmanager
+def request_deadline(deadline):
+    """
+    Makes requests from the current thread give up at deadline, a
+    time.time() value, until the with block exits.
+    """
+    prev_deadline = get_request_deadline()
+    _deadline.value = deadline
+    try:
+        yield
+    finally:
+        _deadline.value = prev_deadline
+
+
+class RateLimiter(object):
+    """
+    Token bucket allowing rate requests per second on average and burst
+    at once. Requests over the limit wait and are let through in
+    priority order, first come first served within a priority.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._ts = time.time()
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._seq = itertools.count()
+
+
+    def _refill(self):
+        cur_time = time.time()
+        self._tokens = min(self.burst, self._tokens + (cur_time - self._ts) * self.rate)
+        self._ts = cur_time
+
+
+    def acquire(self, priority=INTERACTIVE, deadline=None):
+        """
+        Waits until the request may be sent and returns True, or returns
+        False if that isn't before deadline.
+        """
+        entry = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    self._refill()
+                    wait = None
+                    if self._waiting[0] == entry:
+                        if self._tokens >= 1.0:
+                            self._tokens -= 1.0
+                            return True
+                        wait = (1.0 - self._tokens) / self.rate
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                        wait = min(wait, remaining) if wait is not None else remaining
+                    self._cond.wait(wait)
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+def get_rate_limiter(host):
+    """
+    Returns the rate limiter for requests to host, or None if they
+    aren't limited.
+    """
+    limit = rate_limits().get(host)
+    if not limit:
+        return None
+    rate, burst = float(limit[0]), float(limit[1])
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(host)
+        if not limiter or limiter.rate != rate or limiter.burst != burst:
+            limiter = RateLimiter(rate, burst)
+            _rate_limiters[host] = limiter
+        return limiter
+
+
+class Transport(object):
+
+    def request(self, method, url, **kwargs):
+        raise NotImplementedError()
+
+
+    def close(self):
+        pass
+
+
+class LiveTransport(Transport):
+    """
+    Sends requests to the network through one session shared by every
+    client, so connections are kept alive and reused rather than
+    reconnecting for every request. The pool options are read when the
+    transport is created, see reset_transport.
+    """
+
+    def __init__(self):
+        self._session = requests.Session()
+        self._session.headers["Accept-Encoding"] = "gzip, deflate"
+        self._session.headers["Connection"] = "keep-alive"
+        for scheme in ("http://", "https://"):
+            self._session.mount(scheme, HTTPAdapter(pool_connections=pool_hosts(),
+                                                    pool_maxsize=pool_size()))
+            for host, size in host_pool_sizes().iteritems():
+                self._session.mount(scheme + host + "/",
+                                    HTTPAdapter(pool_connections=1, pool_maxsize=int(size)))
+
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", timeout())
+        return self._session.request(method, url, **kwargs)
+
+
+    def close(self):
+        self._session.close()
+
+
+class RecordingTransport(LiveTransport):
+    """
+    Sends requests to the network and saves every response.
+    """
+
+    def __init__(self):
+        super(RecordingTransport, self).__init__()
+        self._lock = threading.Lock()
+
+
+    def request(self, method, url, **kwargs):
+        response = super(RecordingTransport, self).request(method, url, **kwargs)
+        key = _request_key(method, url, kwargs.get("params"), kwargs.get("data"))
+        try:
+            self._save(key, response)
+        except (IOError, OSError) as e:
+            _log_error(['RecordingTransport.request', key, str(e)])
+        return response
+
+
+    def _save(self, key, response):
+        recording = {
+            "key": key,
+            "url": response.url,
+            "status_code": response.status_code,
+            "reason": response.reason,
+            "headers": dict(response.headers),
+            "encoding": response.encoding,
+            "elapsed": response.elapsed.total_seconds(),
+            "content": base64.b64encode(response.content)
+        }
+        fn = _recording_filename(key)
+        with self._lock:
+            if not os.path.isdir(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            tmp_fn = fn + ".tmp"
+            with open(tmp_fn, "w") as f:
+                json.dump(recording, f, sort_keys=True, indent=4,
+                          separators=(',', ': '))
+            os.rename(tmp_fn, fn)
+
+
+class ReplayTransport(Transport):
+    """
+    Serves saved responses. Requests that weren't recorded fail with a
+    ConnectionError, as if the network was down.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._recordings = {}
+
+
+    def _load(self, key):
+        fn = _recording_filename(key)
+        with self._lock:
+            if fn in self._recordings:
+                return self._recordings[fn]
+        recording = None
+        if os.path.isfile(fn):
+            try:
+                with open(fn) as f:
+                    recording = json.load(f)
+            except (IOError, ValueError) as e:
+                _log_error(['ReplayTransport._load', fn, str(e)])
+        # misses aren't kept, the response may be recorded later
+        if recording:
+            with self._lock:
+                self._recordings[fn] = recording
+        return recording
+
+
+    def _error_response(self, url, status_code):
+        response = Response()
+        response.url = url
+        response.status_code = status_code
+        response.reason = "Injected error"
+        response._content = ""
+        return response
+
+
+    def request(self, method, url, **kwargs):
+        key = _request_key(method, url, kwargs.get("params"), kwargs.get("data"))
+        recording = self._load(key)
+        if not recording:
+            raise requests.exceptions.ConnectionError("No recorded response for %s" % key)
+
+        delay = replay_latency() + replay_latency_scale() * recording["elapsed"]
+        if delay > 0:
+            time.sleep(delay)
+
+        error_rate = replay_error_rate()
+        if error_rate > 0 and random.random() < error_rate:
+            error = replay_error()
+            if error == "timeout":
+                raise requests.exceptions.ReadTimeout("Injected timeout for %s" % key)
+            if error == "connection":
+                raise requests.exceptions.ConnectionError("Injected error for %s" % key)
+            return self._error_response(url, int(error))
+
+        response = Response()
+        response.url = recording["url"]
+        response.status_code = recording["status_code"]
+        response.reason = recording["reason"]
+        response.headers = CaseInsensitiveDict(recording["headers"])
+        response.encoding = recording["encoding"]
+        response._content = base64.b64decode(recording["content"])
+        return response
+
+
+_transports = {
+    "live": LiveTransport,
+    "record": RecordingTransport,
+    "replay": ReplayTransport
+}
+_transport = None
+_transport_mode = None
+_transport_lock = threading.Lock()
+def get_transport():
+    """
+    Returns the transport for the current mode.
+    """
+    global _transport
+    global _transport_mode
+    cur_mode = mode()
+    transport = _transport
+    if transport and _transport_mode == cur_mode:
+        return transport
+    if not cur_mode in _transports:
+        raise ValueError("Unknown http_transport_mode %s" % cur_mode)
+    old_transport = None
+    with _transport_lock:
+        if not _transport or _transport_mode != cur_mode:
+            old_transport = _transport
+            _transport = _transports[cur_mode]()
+            _transport_mode = cur_mode
+        transport = _transport
+    if old_transport:
+        old_transport.close()
+    return transport
+
+
+def reset_transport():
+    """
+    Closes the current transport so the next request creates a new one
+    with the current options.
+    """
+    global _transport
+    with _transport_lock:
+        old_transport = _transport
+        _transport = None
+    if old_transport:
+        old_transport.close()
+
+
+def request(method, url, **kwargs):
+    """
+    Sends a request through the current transport once the rate limit
+    of its host allows it. Replayed requests don't go to the host, so
+    they aren't limited. If the thread has a request deadline, the
+    request times out by then. Takes the same arguments as
+    requests.request and returns a requests Response.
+    """
+    transport = get_transport()
+    deadline = get_request_deadline()
+    if not isinstance(transport, ReplayTransport):
+        limiter = get_rate_limiter(urlparse.urlsplit(url).hostname)
+        if limiter and not limiter.acquire(get_request_priority(), deadline):
+            raise requests.exceptions.Timeout("Rate limit of %s not met by the deadline" % url)
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise requests.exceptions.Timeout("Deadline passed before requesting %s" % url)
+        request_timeout = kwargs.get("timeout") or timeout()
+        if isinstance(request_timeout, tuple):
+            kwargs["timeout"] = tuple(min(t, remaining) for t in request_timeout)
+        else:
+            kwargs["timeout"] = min(float(request_timeout), remaining)
+    return transport.request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
@@ -111,29 +111,31 @@ def exchange(swap_a, swap_b, meta={}):
 
     Both arguments are tuples of the form (user, asset, amount).
     """
-    # TODO: check if sufficient balance for exchange and fees for both parties
-    local_meta = meta
+    local_meta = dict(meta)
     
     cur_time = time.time()
-    accounts.transfer(swap_a[0], swap_b[0],
-                      swap_a[1], swap_a[2],
-                      cur_time, False, local_meta)
-    accounts.transfer(swap_b[0], swap_a[0],
-                      swap_b[1], swap_b[2],
-                      cur_time, False, local_meta)
+    transfers = [
+        (swap_a[0], swap_b[0], swap_a[1], swap_a[2]),
+        (swap_b[0], swap_a[0], swap_b[1], swap_b[2])
+    ]
 
     # extract fee if any
-    if fee_rate != 0.0:
-        fee_a = get_exchange_fee_rate(swap_a[1])
-        fee_b = get_exchange_fee_rate(swap_b[1])
+    fee_a = get_exchange_fee_rate(swap_a[1])
+    fee_b = get_exchange_fee_rate(swap_b[1])
+    if fee_a != 0.0 or fee_b != 0.0:
         local_meta.update({"fee_a": fee_a,
                            "fee_b": fee_b})
-        accounts.transfer(swap_a[0], get_exchange_fee_account(swap_a[1]),
-                          swap_a[1], swap_a[2] * fee_a,
-                          cur_time, False, local_meta)
-        accounts.transfer(swap_b[0], get_exchange_fee_account(swap_b[1]),
-                          swap_b[1], swap_b[2] * fee_b,
-                          cur_time, False, local_meta)
+        fee_account = get_default_exchange_fee_account()
+        if not accounts.has_user(fee_account):
+            accounts.add_user(fee_account)
+        transfers.append((swap_a[0], fee_account,
+                          swap_a[1], swap_a[2] * fee_a))
+        transfers.append((swap_b[0], fee_account,
+                          swap_b[1], swap_b[2] * fee_b))
+
+    # the swap and the fees are made at once, or not at all if either
+    # party can't afford them
+    accounts.transfer_batch(transfers, cur_time, local_meta)
     
     # append to exchange log csv
     asset_pair = swap_a[1] + "/" + swap_b[1]
@@ -141,8 +143,6 @@ def exchange(swap_a, swap_b, meta={}):
     fields=[cur_time, swap_a[0], swap_b[0], asset_pair, swap_a[2], swap_b[2], rate, local_meta]
     append_record(get_exchange_logfile_name(), fields)
 
-    accounts.sync_account_settings()
-
 
 class Order(object):
     
@@ -2,10 +2,17 @@
 Basic demo of how to use this module.
 """
 import atxcf
+from atxcf.PriceNetwork import instance as price_network
 import json
 import unittest
 import tempfile
 import os
+import time
+import threading
+import subprocess
+import sys
+import BaseHTTPServer
+import base64
 
 from functools import wraps
 from random import sample, triangular
@@ -13,6 +20,8 @@ from random import sample, triangular
 import cProfile
 import pstats
 
+import test_benchmark
+
 from itertools import izip, tee
 
 
@@ -167,6 +176,64 @@ def init_shared_users():
         print_portfolios()
 
 
+class FixedPriceSource(atxcf.PriceSource):
+    """
+    Test price source that lists a single market at a fixed price,
+    optionally taking some time to answer.
+    """
+    def __init__(self, market, price, delay=0.0):
+        super(FixedPriceSource, self).__init__()
+        self._market = market
+        self._price = price
+        self._delay = delay
+
+    def get_symbols(self):
+        return self._market.split("/")
+
+    def get_base_symbols(self):
+        return self._market.split("/")[1:]
+
+    def get_markets(self):
+        return [self._market]
+
+    def get_price(self, from_asset, to_asset, amount=1.0):
+        time.sleep(self._delay)
+        price = self._price
+        if from_asset + "/" + to_asset != self._market:
+            price = 1.0/price
+        return price * amount
+
+
+class HTTPPriceSource(FixedPriceSource):
+    """
+    Test price source that makes a request to url for every price.
+    """
+    def __init__(self, market, price, url):
+        super(HTTPPriceSource, self).__init__(market, price)
+        self._url = url
+
+    def get_price(self, from_asset, to_asset, amount=1.0):
+        atxcf.transport.get(self._url)
+        return super(HTTPPriceSource, self).get_price(from_asset, to_asset, amount)
+
+
+def record_http_response(url, data):
+    """
+    Saves data as the JSON response to GET url, to be served by the
+    replay transport.
+    """
+    transport = atxcf.transport
+    fn = transport._recording_filename(transport._request_key("GET", url))
+    if not os.path.isdir(os.path.dirname(fn)):
+        os.makedirs(os.path.dirname(fn))
+    with open(fn, "w") as f:
+        json.dump({"key": transport._request_key("GET", url), "url": url,
+                   "status_code": 200, "reason": "OK",
+                   "headers": {"Content-Type": "application/json"},
+                   "encoding": "utf-8", "elapsed": 0.0,
+                   "content": base64.b64encode(json.dumps(data))}, f)
+
+
 class SettingsContext():
     def __init__(self, prefix):
         self._prefix = prefix
@@ -185,10 +252,7 @@ class SettingsContext():
         atxcf.set_conversion("FOO_C/USD", 0.001)
         atxcf.set_conversion("FOO_D/USD", 0.0001)
 
-        # re-init the price network so the above conversions are available
-        # TODO: shouldn't have to re-init... when a source changes, any new
-        # nodes and edges should be added and nodes with no info available
-        # anymore should be dropped.
+        # re-init the price network so it only uses the sources above
         atxcf.init_price_network()
         
         return self
@@ -240,6 +304,14 @@ class TestAtxcf(unittest.TestCase):
         atxcf.set_setting("test", 4.20)
         self.assertEqual(atxcf.get_setting("test"), 4.20)
 
+        # the settings keep a copy of the value set
+        value = {"a": [1, 2]}
+        version = atxcf.get_settings_version()
+        atxcf.set_setting("test", value)
+        value["a"].append(3)
+        self.assertEqual(atxcf.get_setting("test"), {"a": [1, 2]})
+        self.assertEqual(atxcf.get_settings_version(), version + 1)
+
 
     @settings_context
     def test_settings_pre_change_callback(self, **kwargs):
@@ -281,6 +353,521 @@ class TestAtxcf(unittest.TestCase):
         self.assertTrue("key" in closure2)
 
 
+    @settings_context
+    def test_cache_get_or_compute(self, **kwargs):
+        """
+        Testing that get_or_compute only computes on a miss and that the
+        in-process LRU tier evicts its least recently used keys.
+        """
+        calls = []
+        def compute():
+            calls.append(1)
+            return "computed"
+        key = "test_cache_get_or_compute.%f" % time.time()
+        self.assertEqual(atxcf.get_or_compute(key, compute), "computed")
+        self.assertEqual(atxcf.get_or_compute(key, compute), "computed")
+        self.assertEqual(len(calls), 1)
+
+        lru = atxcf.cache.LRUCache(max_size=2)
+        lru.set_val("a", 1)
+        lru.set_val("b", 2)
+        lru.get_val("a")
+        lru.set_val("c", 3)
+        self.assertEqual(lru.get_val("a"), 1)
+        self.assertEqual(lru.get_val("b"), None)
+        self.assertEqual(lru.get_val("c"), 3)
+
+
+    @settings_context
+    def test_settings_async_change_callback(self, **kwargs):
+        """
+        Testing that change callbacks only fire for changes below their
+        path when asked to, and that async post-change callbacks don't
+        hold up the writer and run once per queued path.
+        """
+        calls = []
+        release = threading.Event()
+        def change_cb():
+            release.wait(5.0)
+            calls.append(atxcf.get_setting("test_async", "a", "b"))
+        exact_calls = []
+        def exact_change_cb():
+            exact_calls.append(1)
+
+        atxcf.add_settings_post_change_callback("test_async", change_cb, subtree=True)
+        atxcf.add_settings_post_change_callback("test_async", exact_change_cb, name="exact")
+        atxcf.set_option("settings_async_callbacks", True)
+        start = time.time()
+        for i in range(10):
+            atxcf.set_setting("test_async", "a", "b", i)
+        self.assertTrue(time.time() - start < 1.0)
+
+        release.set()
+        atxcf.flush_settings_change_callbacks()
+        self.assertTrue(1 <= len(calls) <= 2)
+        self.assertEqual(calls[-1], 9)
+        self.assertEqual(exact_calls, [])
+        atxcf.remove_settings_post_change_callback("test_async")
+        atxcf.remove_settings_post_change_callback("test_async", name="exact")
+
+
+    @settings_context
+    def test_setting_view(self, **kwargs):
+        """
+        Testing that setting views are read-only snapshots and that the
+        settings version is bumped on change.
+        """
+        atxcf.set_setting("test_setting_view", "a", {"b": [1, 2]})
+        version = atxcf.get_settings_version()
+        view = atxcf.get_setting_view("test_setting_view")
+        self.assertTrue(isinstance(view, atxcf.SettingsView))
+        self.assertEqual(list(view["a"]["b"]), [1, 2])
+        with self.assertRaises(TypeError):
+            view["c"] = 1
+
+        atxcf.set_setting("test_setting_view", "a", "b", [3])
+        self.assertTrue(atxcf.get_settings_version() > version)
+        self.assertEqual(list(view["a"]["b"]), [1, 2])
+        self.assertEqual(atxcf.get_setting("test_setting_view", "a", "b"), [3])
+
+        # get_setting still hands out copies
+        copied = atxcf.get_setting("test_setting_view", "a")
+        copied["b"].append(4)
+        self.assertEqual(atxcf.get_setting("test_setting_view", "a", "b"), [3])
+
+
+    @settings_context
+    def test_settings_journal(self, **kwargs):
+        """
+        Testing that journaled changes survive a reload without a write,
+        that a change the journal can't record isn't made, and that
+        writing the settings compacts the journal.
+        """
+        atxcf.set_option("settings_journal", True)
+        atxcf.set_setting("test_settings_journal", "a", 1)
+        atxcf.set_setting("test_settings_journal", "b", [1, 2])
+        atxcf.remove_setting("test_settings_journal", "a")
+        journal_fn = atxcf.get_settings_journal_filename()
+        self.assertTrue(os.path.isfile(journal_fn))
+
+        # a change that can't be journaled isn't made
+        version = atxcf.get_settings_version()
+        self.assertRaises(atxcf.SettingsError, atxcf.set_setting,
+                          "test_settings_journal", "d", object())
+        self.assertFalse(atxcf.has_setting("test_settings_journal", "d"))
+        self.assertEqual(atxcf.get_settings_version(), version)
+
+        # a record cut short by a crash is skipped
+        with open(journal_fn, 'a') as f:
+            f.write('["s",["test_settings_journal","c"],')
+
+        # drop the in-memory settings as if the process had died
+        atxcf.reload_settings()
+        self.assertEqual(atxcf.get_setting("test_settings_journal", "b"), [1, 2])
+        self.assertFalse(atxcf.has_setting("test_settings_journal", "a"))
+        self.assertFalse(atxcf.has_setting("test_settings_journal", "c"))
+
+        # other threads may journal new changes right away, but the ones
+        # above should now only be in the settings file
+        atxcf.write_settings()
+        if os.path.isfile(journal_fn):
+            with open(journal_fn) as f:
+                self.assertFalse("test_settings_journal" in f.read())
+        atxcf.reload_settings()
+        self.assertEqual(atxcf.get_setting("test_settings_journal", "b"), [1, 2])
+
+
+    @settings_context
+    def test_shared_settings(self, **kwargs):
+        """
+        Testing that a reader process sees the settings published by the
+        writer process without loading the settings file, and can't
+        change them.
+        """
+        atxcf.set_settings_role("writer")
+        try:
+            # only in the published snapshot, not in the settings file
+            atxcf.set_setting("test_shared_settings", {"a": [1, 2], "b": u"\xe9"})
+            atxcf.publish_settings()
+            self.assertTrue(os.path.isfile(atxcf.get_shared_settings_filename()))
+
+            script = "\n".join([
+                "import json, atxcf",
+                "print json.dumps(atxcf.get_setting('test_shared_settings'))",
+                "try:",
+                "    atxcf.set_setting('test_shared_settings', 1)",
+                "except atxcf.SettingsError:",
+                "    print 'read-only'",
+            ])
+            env = dict(os.environ)
+            env["ATXCF_SETTINGS"] = atxcf.get_settings_filename()
+            env["ATXCF_SETTINGS_ROLE"] = "reader"
+            env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.dirname(atxcf.__file__)),
+                                                 env.get("PYTHONPATH", "")])
+            output = subprocess.check_output([sys.executable, "-c", script], env=env)
+            lines = output.strip().splitlines()
+            self.assertEqual(json.loads(lines[-2]), {"a": [1, 2], "b": u"\xe9"})
+            self.assertEqual(lines[-1], "read-only")
+        finally:
+            atxcf.set_settings_role(None)
+
+
+    @settings_context
+    def test_lazy_import(self, **kwargs):
+        """
+        Testing that importing atxcf and using the accounts and shares
+        API neither loads the pricing dependencies nor creates the
+        price network, and that balance changes keep the share count
+        without importing shares.
+        """
+        script = "\n".join([
+            "import sys, atxcf",
+            "print sorted(m for m in ('networkx', 'numpy', 'pyquery', 'atxcf.core') if m in sys.modules)",
+            "atxcf.add_user('lazy_user')",
+            "atxcf.set_balance('lazy_portfolio', 'lazy_portfolio', -5)",
+            "print 'atxcf.shares' in sys.modules",
+            "print atxcf.get_num_shares_outstanding('lazy_portfolio')",
+            "print sys.modules['atxcf.PriceNetwork']._pn is None",
+            "print sorted(m for m in ('networkx', 'numpy', 'pyquery') if m in sys.modules)",
+        ])
+        env = dict(os.environ)
+        env["ATXCF_SETTINGS"] = atxcf.get_settings_filename()
+        env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.dirname(atxcf.__file__)),
+                                             env.get("PYTHONPATH", "")])
+        output = subprocess.check_output([sys.executable, "-c", script], env=env)
+        self.assertEqual(output.strip().splitlines()[-5:],
+                         ["[]", "False", "5.0", "True", "[]"])
+
+
+    def test_benchmark_regressions(self):
+        """
+        Testing that the benchmark harness measures a callable and flags
+        results that are worse than the baseline by more than the
+        threshold.
+        """
+        result = test_benchmark.measure(lambda: [0] * 10, 100, 2)
+        self.assertEqual(result["iterations"], 100)
+        self.assertTrue(result["wall"] >= 0.0)
+        if test_benchmark.resource:
+            self.assertTrue(result["maxrss_kb"] > 0)
+
+        baseline = {"a": {"wall": 0.01, "objects": 1000, "iterations": 1},
+                    "b": {"wall": 0.01, "objects": 1000, "iterations": 1}}
+        # a is within the threshold plus noise, b isn't
+        results = {"a": {"wall": 0.014, "objects": 1010, "iterations": 1000},
+                   "b": {"wall": 0.02, "objects": 2000, "iterations": 1},
+                   "c": {"wall": 1.0, "objects": 0, "iterations": 1}}
+        self.assertEqual(test_benchmark.find_regressions(results, baseline, 0.25),
+                         [("b", "wall", 0.01, 0.02), ("b", "objects", 1000, 2000)])
+        self.assertEqual(test_benchmark.find_regressions(results, baseline, 1.5), [])
+
+
+    @settings_context
+    def test_http_replay(self, **kwargs):
+        """
+        Testing that responses recorded from a server are replayed once
+        it is gone, that volatile parameters don't change the recording
+        used, that a missing recording can be added later, and that
+        replay injects errors.
+        """
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps({"path": self.path}))
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        server_thread = threading.Thread(target=server.handle_request)
+        server_thread.start()
+        url = "http://127.0.0.1:%d/ticker" % server.server_port
+        try:
+            atxcf.set_option("http_transport_mode", "record")
+            recorded = atxcf.transport.get(url, params={"pair": "BTCUSD", "nonce": 1}).json()
+            self.assertTrue(recorded["path"].startswith("/ticker?"))
+        finally:
+            server_thread.join()
+            server.server_close()
+
+        atxcf.set_option("http_transport_mode", "replay")
+        response = atxcf.transport.get(url, params={"pair": "BTCUSD", "nonce": 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), recorded)
+        with self.assertRaises(atxcf.transport.requests.exceptions.ConnectionError):
+            atxcf.transport.get(url, params={"pair": "LTCUSD"})
+
+        # a miss isn't remembered, a response recorded later is replayed
+        def recording_filename(pair):
+            key = atxcf.transport._request_key("GET", url, {"pair": pair})
+            return atxcf.transport._recording_filename(key)
+        with open(recording_filename("BTCUSD")) as f:
+            recording = f.read()
+        with open(recording_filename("LTCUSD"), "w") as f:
+            f.write(recording)
+        self.assertEqual(atxcf.transport.get(url, params={"pair": "LTCUSD"}).json(), recorded)
+
+        # replayed requests don't wait on the rate limit of the host
+        atxcf.set_option("http_rate_limits", {"127.0.0.1": [0.01, 1]})
+        start = time.time()
+        for i in range(3):
+            atxcf.transport.get(url, params={"pair": "BTCUSD"})
+        self.assertTrue(time.time() - start < 1.0)
+
+        atxcf.set_option("http_replay_error_rate", 1.0)
+        atxcf.set_option("http_replay_error", 503)
+        self.assertEqual(atxcf.transport.get(url, params={"pair": "BTCUSD"}).status_code, 503)
+        atxcf.set_option("http_replay_error", "timeout")
+        with self.assertRaises(atxcf.transport.requests.exceptions.ReadTimeout):
+            atxcf.transport.get(url, params={"pair": "BTCUSD"})
+        atxcf.set_option("http_transport_mode", "live")
+
+
+    @settings_context
+    def test_bitfinex_tickers(self, **kwargs):
+        """
+        Testing that Bitfinex prices come from v2 ticker snapshots
+        fetched 200 symbols at a time, falling back to the v1 ticker
+        for symbols missing from the snapshot.
+        """
+        from atxcf import bitfinex
+        from itertools import product
+        symbols = ["".join(s) + "usd" for s in product("abcdefghij", repeat=3)][:250]
+        tickers = [["t" + s.upper(), 0.5, 1.0, 1.5, 1.0, 0.0, 0.0, float(i + 1), 100.0, 2.0, 0.1]
+                   for i, s in enumerate(symbols)]
+        missing = tickers.pop(10)
+        client = bitfinex.Client()
+        atxcf.set_option("http_transport_mode", "replay")
+        try:
+            record_http_response(client.url_for(bitfinex.PATH_SYMBOLS), symbols)
+            for i in range(0, len(symbols), bitfinex.TICKERS_PER_REQUEST):
+                chunk = symbols[i:i + bitfinex.TICKERS_PER_REQUEST]
+                url = client.url_for(bitfinex.PATH_TICKERS, version=bitfinex.VERSION_V2,
+                                     parameters={"symbols": ",".join("t" + s.upper() for s in chunk)})
+                # funding tickers are left out
+                record_http_response(url, [t for t in tickers if t[0][1:].lower() in chunk] +
+                                     [["fUSD", 0.1, 0.1, 2, 1.0, 0.1, 2, 1.0, 0.0, 0.0, 0.1, 0.1, 0.1, 0.1]])
+            record_http_response(client.url_for(bitfinex.PATH_TICKER, symbols[10]),
+                                 {"last_price": "11.0", "bid": "0.5", "ask": "1.5", "mid": "1.0",
+                                  "timestamp": "1395552290.7"})
+
+            result = client.tickers(symbols)
+            self.assertEqual(len(result), 249)
+            self.assertEqual(result[symbols[0]],
+                             {"bid": 0.5, "ask": 1.5, "mid": 1.0, "last_price": 1.0,
+                              "volume": 100.0, "high": 2.0, "low": 0.1})
+            self.assertFalse(symbols[10] in result)
+
+            source = atxcf.Bitfinex()
+            self.assertEqual(source.get_price("AAA", "USD"), 1.0)
+            self.assertEqual(source.get_price(symbols[-1][:3].upper(), "USD", 2.0), 500.0)
+            self.assertEqual(source.get_price("USD", symbols[1][:3].upper()), 0.5)
+            self.assertEqual(source.get_price(symbols[10][:3].upper(), "USD"), 11.0)
+        finally:
+            atxcf.set_option("http_transport_mode", "live")
+
+
+    @settings_context
+    def test_http_keep_alive(self, **kwargs):
+        """
+        Testing that live requests share one kept alive connection per
+        host and ask for gzip, and that a replaced transport is closed.
+        """
+        connections = []
+        encodings = []
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            timeout = 0.5
+
+            def setup(self):
+                connections.append(self.client_address)
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+            def do_GET(self):
+                encodings.append(self.headers.get("Accept-Encoding"))
+                body = json.dumps({"path": self.path})
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        try:
+            atxcf.set_option("http_transport_mode", "live")
+            atxcf.transport.reset_transport()
+            for i in range(5):
+                url = "http://127.0.0.1:%d/ticker/%d" % (server.server_port, i)
+                self.assertEqual(atxcf.transport.get(url).json(), {"path": "/ticker/%d" % i})
+            # the transport is closed when the mode changes
+            transport = atxcf.transport.get_transport()
+            closed = []
+            close = transport.close
+            def close_transport():
+                closed.append(transport)
+                close()
+            transport.close = close_transport
+            atxcf.set_option("http_transport_mode", "replay")
+            self.assertNotEqual(atxcf.transport.get_transport(), transport)
+            self.assertEqual(closed, [transport])
+            atxcf.set_option("http_transport_mode", "live")
+        finally:
+            atxcf.transport.reset_transport()
+            server.shutdown()
+            server_thread.join()
+            server.server_close()
+        self.assertEqual(len(connections), 1)
+        self.assertTrue(all("gzip" in encoding for encoding in encodings))
+
+
+    def test_rate_limiter(self):
+        """
+        Testing that the rate limiter holds requests to its rate and lets
+        queued interactive requests go ahead of background ones.
+        """
+        transport = atxcf.transport
+        limiter = transport.RateLimiter(20, 1)
+        start = time.time()
+        for i in range(5):
+            limiter.acquire()
+        self.assertTrue(time.time() - start >= 4 / 20.0 - 0.01)
+
+        order = []
+        def acquire(name, priority):
+            limiter.acquire(priority)
+            order.append(name)
+
+        limiter = transport.RateLimiter(5, 1)
+        limiter.acquire()
+        threads = [threading.Thread(target=acquire, args=("background", transport.BACKGROUND))]
+        threads[0].start()
+        time.sleep(0.05)
+        threads.append(threading.Thread(target=acquire, args=("interactive", transport.INTERACTIVE)))
+        threads[1].start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ["interactive", "background"])
+
+        with transport.request_priority(transport.BACKGROUND):
+            self.assertEqual(transport.get_request_priority(), transport.BACKGROUND)
+        self.assertEqual(transport.get_request_priority(), transport.INTERACTIVE)
+
+
+    @settings_context
+    def test_append_record(self, **kwargs):
+        """
+        Testing that records are buffered until flushed, that with
+        record_fsync set to always every record from every thread is
+        written before append_record returns, and that closing the least
+        recently used file loses no records.
+        """
+        def num_rows(fn):
+            if not os.path.isfile(fn):
+                return 0
+            with open(fn) as f:
+                return len(f.readlines())
+
+        atxcf.set_option("record_buffer_size", 1000)
+        atxcf.set_option("record_fsync", "never")
+        fn = atxcf.get_settings_filename() + ".test_append_record.csv"
+        for i in range(10):
+            atxcf.append_record(fn, [i, "buffered"])
+        atxcf.flush_records(fn)
+        self.assertEqual(num_rows(fn), 10)
+
+        atxcf.set_option("record_fsync", "always")
+        def append_some():
+            for i in range(50):
+                atxcf.append_record(fn, [i, "always"])
+        threads = [threading.Thread(target=append_some) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(num_rows(fn), 410)
+
+        # with one file open at a time, writers are evicted while other
+        # threads append to them, and no row is lost
+        atxcf.set_option("record_fsync", "never")
+        atxcf.set_option("record_buffer_size", 10)
+        atxcf.set_option("record_max_open_files", 1)
+        fns = [fn + ".%d" % i for i in range(2)]
+        def append_evicted(i):
+            for j in range(100):
+                atxcf.append_record(fns[(i + j) % 2], [j, "evicted"])
+        threads = [threading.Thread(target=append_evicted, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        atxcf.flush_records()
+        self.assertEqual(num_rows(fns[0]) + num_rows(fns[1]), 800)
+
+
+    @settings_context
+    def test_cache_get_many(self, **kwargs):
+        """
+        Testing batched cache reads and writes, and that batched pricing
+        picks up rates from the shared cache.
+        """
+        prefix = "test_cache_get_many.%f." % time.time()
+        atxcf.cache.set_many({prefix + "a": 1, prefix + "b": [2, 3]})
+        self.assertEqual(atxcf.cache.get_many([prefix + "a", prefix + "b", prefix + "c"]),
+                         {prefix + "a": 1, prefix + "b": [2, 3]})
+
+        settings_cache = atxcf.cache.SettingsCache("test_cache_get_many")
+        settings_cache.set_many({"x": 4.0}, expire=60)
+        self.assertEqual(settings_cache.get_many(["x", "y"]), {"x": 4.0})
+
+        # a value found below the in-process tier is kept there for no
+        # longer than it has left, or than the caller's expire
+        for cache in atxcf.cache._caches:
+            if isinstance(cache, atxcf.cache.SettingsCache):
+                cache.set_val(prefix + "d", 5.0, expire=60)
+                cache.set_val(prefix + "e", 6.0, expire=60)
+                cache._get_cache()[prefix + "d"] = (time.time() - 59.5, 60, 5.0)
+                self.assertEqual(atxcf.cache.get_val(prefix + "d"), 5.0)
+                self.assertTrue(atxcf.cache._l1._cache[prefix + "d"][1] <= 0.5)
+                self.assertEqual(atxcf.cache.get_many([prefix + "e"], expire=10), {prefix + "e": 6.0})
+                self.assertEqual(atxcf.cache._l1._cache[prefix + "e"][1], 10)
+
+        # a price already in the shared cache is used without a fetch
+        mkt = "TCGMA/TCGMB"
+        pn = price_network()
+        pn.add_source(FixedPriceSource(mkt, 2.0))
+        atxcf.cache.set_val(mkt, 3.0, expire=60)
+        self.assertEqual(list(atxcf.get_prices_batch([2.0], [("TCGMA", "TCGMB")])), [6.0])
+
+
+    @settings_context
+    def test_settings_cache_flush(self, **kwargs):
+        """
+        Testing that a settings cache is written to a file next to the
+        current settings file and read back, and that a value that can't
+        be written doesn't keep the rest from being written.
+        """
+        settings_cache = atxcf.cache.SettingsCache("test_settings_cache_flush")
+        settings_cache.set_val("a", 1.0)
+        settings_cache.set_val("b", {"c": [2, 3]}, expire=60)
+        settings_cache.set_val("bad", object())
+        settings_cache.flush()
+        filename = settings_cache._get_filename()
+        self.assertTrue(filename.startswith(atxcf.get_settings_filename()))
+        self.assertTrue(os.path.isfile(filename))
+
+        settings_cache = atxcf.cache.SettingsCache("test_settings_cache_flush")
+        self.assertEqual(settings_cache.get_val("a"), 1.0)
+        self.assertEqual(settings_cache.get_val("b"), {"c": [2, 3]})
+        self.assertEqual(settings_cache.get_val("bad"), None)
+
+
     @settings_context
     def test_domain(self, **kwargs):
         """
@@ -349,6 +936,217 @@ class TestAtxcf(unittest.TestCase):
         self.assertTrue(abs(price - 1.0) <= 0.001)    
 
 
+    @settings_context
+    def test_parallel_price_fetch(self, **kwargs):
+        """
+        Testing that prices from several sources are averaged, that
+        sources slower than the fetch timeout are ignored and that the
+        fetches and requests they leave behind give up.
+        """
+        atxcf.set_option("price_fetch_timeout", 0.2)
+        atxcf.set_conversion("PAR_A/USD", 10.0)
+        atxcf.add_source(FixedPriceSource("PAR_A/USD", 0.3))
+        atxcf.add_source(FixedPriceSource("PAR_A/USD", 100.0, delay=1.0))
+        price = atxcf.get_price(1.0, "PAR_A/USD")
+        self.assertTrue(abs(price - 0.2) <= 0.001)
+
+        # fetches that don't start before the timeout are dropped
+        calls = []
+        class CountingSource(FixedPriceSource):
+            def get_price(self, *args):
+                calls.append(args)
+                return super(CountingSource, self).get_price(*args)
+        atxcf.set_option("price_fetch_workers", 1)
+        atxcf.init_price_network()
+        atxcf.add_source(FixedPriceSource("PAR_B/USD", 100.0, delay=0.5))
+        atxcf.add_source(CountingSource("PAR_B/USD", 3.0))
+        self.assertRaises(atxcf.PriceNetworkError, atxcf.get_price, 1.0, "PAR_B/USD")
+        time.sleep(0.5)
+        self.assertEqual(calls, [])
+
+        # and requests give up at the timeout
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(0.5)
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        server_thread = threading.Thread(target=server.handle_request)
+        server_thread.start()
+        try:
+            atxcf.set_option("http_transport_mode", "live")
+            start = time.time()
+            with atxcf.transport.request_deadline(start + 0.2):
+                with self.assertRaises(atxcf.transport.requests.exceptions.Timeout):
+                    atxcf.transport.get("http://127.0.0.1:%d/ticker" % server.server_port)
+            self.assertTrue(time.time() - start < 0.4)
+        finally:
+            server_thread.join()
+            server.server_close()
+
+
+    @settings_context
+    def test_price_fetch_priority(self, **kwargs):
+        """
+        Testing that an interactive price doesn't time out behind a
+        background sweep whose fetches wait on the rate limit, and that
+        replacing the price network stops its fetch workers.
+        """
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write("{}")
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        url = "http://127.0.0.1:%d/ticker" % server.server_port
+        try:
+            atxcf.set_option("http_transport_mode", "live")
+            atxcf.set_option("http_rate_limits", {"127.0.0.1": [4.0, 1]})
+            atxcf.set_option("price_fetch_timeout", 1.0)
+            markets = ["PFP_%d/USD" % i for i in range(8)] + ["PFP_I/USD"]
+            for mkt in markets:
+                atxcf.add_source(HTTPPriceSource(mkt, 2.0, url))
+                atxcf.add_source(HTTPPriceSource(mkt, 2.0, url))
+
+            def sweep(mkt):
+                with atxcf.transport.request_priority(atxcf.transport.BACKGROUND):
+                    try:
+                        atxcf.get_price(1.0, mkt)
+                    except atxcf.PriceNetworkError:
+                        pass
+            threads = [threading.Thread(target=sweep, args=(mkt,)) for mkt in markets[:-1]]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            start = time.time()
+            self.assertEqual(atxcf.get_price(1.0, "PFP_I/USD"), 2.0)
+            self.assertTrue(time.time() - start < 1.0)
+            for thread in threads:
+                thread.join()
+
+            # replacing the price network stops the old one's workers
+            workers = [thread for thread in threading.enumerate()
+                       if thread.name == "price fetch worker"]
+            self.assertTrue(workers)
+            atxcf.init_price_network()
+            for thread in workers:
+                thread.join(5.0)
+                self.assertFalse(thread.is_alive())
+        finally:
+            server.shutdown()
+            server_thread.join()
+            server.server_close()
+
+
+    @settings_context
+    def test_route_table(self, **kwargs):
+        """
+        Testing that routes follow sources added at runtime.
+        """
+        atxcf.add_source(FixedPriceSource("RT_A/RT_B", 2.0))
+        atxcf.add_source(FixedPriceSource("RT_B/USD", 3.0))
+        price = atxcf.get_price(1.0, "RT_A/USD")
+        self.assertTrue(abs(price - 6.0) <= 0.001)
+
+        # a direct market should replace the two hop route
+        atxcf.add_source(FixedPriceSource("RT_A/USD", 5.0))
+        price = atxcf.get_price(1.0, "RT_A/USD")
+        self.assertTrue(abs(price - 5.0) <= 0.001)
+
+
+    @settings_context
+    def test_market_changes(self, **kwargs):
+        """
+        Testing that market changes from sources update the price network
+        without re-initializing it.
+        """
+        atxcf.set_conversion("MC_A/USD", 10.0)
+        price = atxcf.get_price(1.0, "MC_A/USD")
+        self.assertTrue(abs(price - 0.1) <= 0.001)
+
+        # route MC_B through MC_A, then drop the MC_A conversion
+        atxcf.set_conversion("MC_B/MC_A", 2.0)
+        price = atxcf.get_price(1.0, "MC_B/USD")
+        self.assertTrue(abs(price - 0.05) <= 0.001)
+        conversions = atxcf.get_conversions()
+        del conversions["MC_A/USD"]
+        atxcf.set_conversions(conversions)
+        self.assertRaises(atxcf.PriceNetworkError,
+                          atxcf.get_price, 1.0, "MC_B/USD")
+
+        # removing a source drops the markets only it provided
+        source = FixedPriceSource("MC_C/USD", 3.0)
+        atxcf.add_source(source)
+        price = atxcf.get_price(1.0, "MC_C/USD")
+        self.assertTrue(abs(price - 3.0) <= 0.001)
+        atxcf.remove_source(source)
+        self.assertRaises(atxcf.PriceNetworkError,
+                          atxcf.get_price, 1.0, "MC_C/USD")
+
+        # lookups without a route don't ask a source for its markets
+        # more than once per cache expiration
+        num_publishes = [0]
+        class CountingSource(FixedPriceSource):
+            def publish_markets(self):
+                num_publishes[0] += 1
+                super(CountingSource, self).publish_markets()
+        atxcf.set_option("cache_price_expiration", 60)
+        atxcf.add_source(CountingSource("MC_D/USD", 4.0))
+        for i in range(3):
+            self.assertRaises(atxcf.PriceNetworkError,
+                              atxcf.get_price, 1.0, "MC_E/USD")
+        self.assertEqual(num_publishes[0], 1)
+
+
+    @settings_context
+    def test_get_prices_batch(self, **kwargs):
+        """
+        Testing pricing many amounts and pairs in one call.
+        """
+        amounts = [10.0, 100.0, 0.0, 5.0, 2.0]
+        pairs = [("FOO_A", "USD"), ("FOO_B", "USD"), ("FOO_C", "USD"),
+                 ("FOO_A", "FOO_B"), ("USD", "USD")]
+        prices = atxcf.get_prices_batch(amounts, pairs)
+        expected = [100.0, 10000.0, 0.0, 0.5, 2.0]
+        for price, expected_price in zip(prices, expected):
+            self.assertTrue(abs(price - expected_price) <= 0.001)
+
+
+    @settings_context
+    def test_edge_rate_cache(self, **kwargs):
+        """
+        Testing that one cached edge rate serves both directions, and
+        that rates from the shared cache don't outlive their expiration.
+        """
+        atxcf.set_conversion("ER_A/USD", 4.0)
+        price = atxcf.get_price(1.0, "ER_A/USD")
+        self.assertTrue(abs(price - 0.25) <= 0.001)
+
+        pn = price_network()
+        rate, num_sources, fetch_time = pn.get_edge_rate("USD", "ER_A")
+        self.assertTrue(abs(rate - 4.0) <= 0.001)
+        self.assertEqual(num_sources, 1)
+        price = atxcf.get_price(2.0, "USD/ER_A")
+        self.assertTrue(abs(price - 8.0) <= 0.001)
+
+        # a rate taken from the shared cache keeps its fetch time
+        atxcf.set_conversion("ER_B/USD", 5.0)
+        fetched = time.time() - 30
+        atxcf.cache.set_val("ER_B/USD", [3.0, fetched], expire=60)
+        self.assertEqual(atxcf.get_price(1.0, "ER_B/USD"), 3.0)
+        self.assertEqual(pn.get_edge_rate("ER_B", "USD")[2], fetched)
+
+
     @settings_context
     def test_get_nav(self, **kwargs):
         """
@@ -462,6 +1260,61 @@ class TestAtxcf(unittest.TestCase):
         self.assertTrue(atxcf.get_balance(username, user_asset) <= epsilon)
 
 
+    @settings_context
+    def test_balances_ledger(self, **kwargs):
+        """
+        Test that balances are kept in the ledger rather than the settings,
+        that the ledger is replayed from its file, that a ledger not
+        matching the settings is refused and that balances kept in the
+        settings by earlier versions are moved into a new ledger.
+        """
+        from atxcf import accounts
+        # the ledger is written through regardless of the record options
+        atxcf.set_option("record_buffer_size", 1000)
+        atxcf.set_option("record_fsync", "never")
+        atxcf.add_user("transfix")
+        atxcf.add_user("sheldon")
+        atxcf.set_balance("transfix", "FOO_A", 100.0)
+        atxcf.transfer("transfix", "sheldon", "FOO_A", 25.0)
+        self.assertFalse(atxcf.has_setting("accounts", "users", "transfix", "balances", "FOO_A", "amount"))
+
+        # forget the ledger in memory, it's replayed from the file
+        accounts._ledger.close()
+        accounts._ledger = None
+        self.assertEqual(atxcf.get_balance("transfix", "FOO_A"), 75.0)
+        self.assertEqual(atxcf.get_balance("sheldon", "FOO_A"), 25.0)
+        self.assertEqual(atxcf.get_assets("sheldon"), ["FOO_A"])
+
+        # a reader picks up a replaced ledger file as a whole
+        from atxcf.ledger import Ledger
+        reader = Ledger(atxcf.get_balances_filename(), read_only=True)
+        accounts._get_ledger()._compact()
+        reader.refresh()
+        self.assertEqual(reader.get_balance("sheldon", "FOO_A"), 25.0)
+        self.assertEqual(reader.get_holders("FOO_A"), {"transfix": 75.0, "sheldon": 25.0})
+
+        # a ledger that doesn't match the settings is refused, not replaced
+        ledger_id = atxcf.get_ledger_id()
+        atxcf.set_setting("accounts", "ledger_id", "not-" + ledger_id)
+        self.assertRaises(atxcf.SettingsError, atxcf.get_balance, "transfix", "FOO_A")
+        self.assertFalse(os.path.isfile(atxcf.get_balances_filename() + ".old"))
+
+        # settings that lost the id take the existing ledger back
+        atxcf.remove_setting("accounts", "ledger_id")
+        self.assertEqual(atxcf.get_balance("transfix", "FOO_A"), 75.0)
+        self.assertEqual(atxcf.get_ledger_id(), ledger_id)
+
+        # new settings start a new ledger, taking in the balances kept
+        # in the settings
+        set_temp_settings_filename("atxcf_test_balances_ledger_")
+        atxcf.clear_settings()
+        atxcf.set_setting("accounts", "users", "sheldon", "balances", "FOO_B", "amount", 5.0)
+        self.assertEqual(atxcf.get_balance("sheldon", "FOO_B"), 5.0)
+        self.assertEqual(atxcf.get_balance("sheldon", "FOO_A"), 0.0)
+        self.assertFalse(atxcf.has_setting("accounts", "users", "sheldon", "balances", "FOO_B"))
+        self.assertNotEqual(atxcf.get_ledger_id(), ledger_id)
+
+
     @settings_context
     def test_get_assets(self, **kwargs):
         """
@@ -545,8 +1398,209 @@ class TestAtxcf(unittest.TestCase):
 
         # TODO: reconcile all the transfers that happened with the transfer
         # log and ledgers to make sure everything lines up
-        
-        
+
+
+    @settings_context
+    def test_transfer_batch(self, **kwargs):
+        """
+        Test that a batch of transfers is made all at once or not at all.
+        """
+        for user in ["transfix", "sheldon", "icky"]:
+            atxcf.add_user(user)
+        atxcf.set_balance("transfix", "FOO_A", 10.0)
+
+        def num_transfers():
+            atxcf.flush_records()
+            if not os.path.isfile(atxcf.get_transfer_logfile_name()):
+                return 0
+            with open(atxcf.get_transfer_logfile_name()) as f:
+                return len(f.readlines())
+
+        # each transfer is checked against the balances the ones before left
+        atxcf.transfer_batch([("transfix", "sheldon", "FOO_A", 6.0),
+                              ("sheldon", "icky", "FOO_A", 4.0),
+                              ("transfix", "icky", "FOO_A", 4.0, {"note": "rest"})])
+        self.assertEqual(atxcf.get_balance("transfix", "FOO_A"), 0.0)
+        self.assertEqual(atxcf.get_balance("sheldon", "FOO_A"), 2.0)
+        self.assertEqual(atxcf.get_balance("icky", "FOO_A"), 8.0)
+        self.assertEqual(num_transfers(), 3)
+
+        # the last transfer overdraws sheldon, so none is made
+        with self.assertRaises(atxcf.InsufficientBalance):
+            atxcf.transfer_batch([("icky", "sheldon", "FOO_A", 1.0),
+                                  ("icky", "transfix", "FOO_A", 1.0),
+                                  ("sheldon", "transfix", "FOO_A", 5.0)])
+        self.assertEqual(atxcf.get_balance("transfix", "FOO_A"), 0.0)
+        self.assertEqual(atxcf.get_balance("sheldon", "FOO_A"), 2.0)
+        self.assertEqual(atxcf.get_balance("icky", "FOO_A"), 8.0)
+        self.assertEqual(num_transfers(), 3)
+
+        # portfolios issue their own shares
+        atxcf.add_user("catx_00")
+        atxcf.set_conversion("BTC/USD", 1000.0)
+        atxcf.init_price_network()
+        atxcf.set_balance("sheldon", "BTC", 2.0)
+        atxcf.create_shares("catx_00", "sheldon", {"BTC": 1.0})
+        self.assertTrue(atxcf.get_balance("sheldon", "catx_00") > 0.0)
+        self.assertEqual(atxcf.get_num_shares_outstanding("catx_00"),
+                         atxcf.get_balance("sheldon", "catx_00"))
+        self.assertEqual(atxcf.get_balance("catx_00", "BTC"), 1.0)
+        # creation fee of 0.01 percent
+        self.assertAlmostEqual(atxcf.get_balance("sheldon", "BTC"), 2.0 - 1.0 - 0.0001)
+
+        # an account named like an asset can't overdraw it
+        atxcf.add_user("FOO_A")
+        with self.assertRaises(atxcf.InsufficientBalance):
+            atxcf.transfer("FOO_A", "icky", "FOO_A", 1.0)
+        with self.assertRaises(atxcf.InsufficientBalance):
+            atxcf.transfer_batch([("FOO_A", "icky", "FOO_A", 1.0)])
+        self.assertEqual(atxcf.get_balance("FOO_A", "FOO_A"), 0.0)
+
+
+    @settings_context
+    def test_shareholders(self, **kwargs):
+        """
+        Test that the shareholders of a portfolio follow transfers of its
+        shares and survive replaying the ledger.
+        """
+        from atxcf import accounts
+        for user in ["catx_00", "transfix", "sheldon", "icky"]:
+            atxcf.add_user(user)
+        atxcf.set_balance("transfix", "BTC", 1.0)
+        atxcf.set_balance("sheldon", "BTC", 1.0)
+        atxcf.set_conversion("BTC/USD", 1000.0)
+        atxcf.init_price_network()
+        atxcf.create_shares("catx_00", "transfix", {"BTC": 0.5})
+        shares = atxcf.get_balance("transfix", "catx_00")
+        self.assertEqual(atxcf.get_shareholders("catx_00"), {"transfix": shares})
+
+        atxcf.transfer("transfix", "sheldon", "catx_00", shares / 2)
+        atxcf.transfer("transfix", "icky", "catx_00", shares / 2)
+        self.assertEqual(atxcf.get_shareholders("catx_00"),
+                         {"sheldon": shares / 2, "icky": shares / 2})
+        self.assertEqual(sorted(atxcf.get_shareholder_names("catx_00")), ["icky", "sheldon"])
+        self.assertEqual(atxcf.get_num_shareholders("catx_00"), 2)
+
+        atxcf.flush_records()
+        accounts._ledger.close()
+        accounts._ledger = None
+        self.assertEqual(atxcf.get_num_shareholders("catx_00"), 2)
+        with self.assertRaises(atxcf.SharesError):
+            atxcf.get_shareholders("catx_99")
+
+
+    @settings_context
+    def test_portfolio_nav_cache(self, **kwargs):
+        """
+        Test that portfolio NAVs are cached until a balance of the
+        portfolio or the rate of a market it is priced through changes,
+        and neither aborted nor cached while one of its assets can't be
+        priced.
+        """
+        from atxcf import portfolio
+        epsilon = kwargs["SettingsContext"].error_epsilon
+        atxcf.add_user("transfix")
+        atxcf.add_user("sheldon")
+        atxcf.set_balance("transfix", "FOO_A", 10.0)
+        atxcf.set_balance("transfix", "FOO_B", 100.0)
+        atxcf.set_balance("sheldon", "FOO_A", 1.0)
+
+        rate_a = atxcf.get_price(1.0, "FOO_A", "USD")
+        rate_b = atxcf.get_price(1.0, "FOO_B", "USD")
+
+        num_navs = [0]
+        get_prices = portfolio.get_prices
+        def _counting_get_prices(*args, **kwargs):
+            num_navs[0] += 1
+            return get_prices(*args, **kwargs)
+        portfolio.get_prices = _counting_get_prices
+        try:
+            nav = 10.0 * rate_a + 100.0 * rate_b
+            self.assertTrue(abs(atxcf.get_portfolio_nav("transfix", "USD") - nav) <= epsilon)
+            self.assertTrue(abs(atxcf.get_portfolio_nav("transfix", "USD") - nav) <= epsilon)
+            self.assertEqual(num_navs[0], 1)
+
+            # other portfolios' balances don't matter
+            atxcf.set_balance("sheldon", "FOO_A", 2.0)
+            atxcf.get_portfolio_nav("transfix", "USD")
+            self.assertEqual(num_navs[0], 1)
+
+            atxcf.transfer("sheldon", "transfix", "FOO_A", 1.0)
+            nav = 11.0 * rate_a + 100.0 * rate_b
+            self.assertTrue(abs(atxcf.get_portfolio_nav("transfix", "USD") - nav) <= epsilon)
+            self.assertTrue(abs(atxcf.get_portfolio_nav("transfix", "USD") - nav) <= epsilon)
+            self.assertEqual(num_navs[0], 2)
+
+            price_network()._set_edge_rate("FOO_A", "USD", 2 * rate_a, 1)
+            nav = 22.0 * rate_a + 100.0 * rate_b
+            self.assertTrue(abs(atxcf.get_portfolio_nav("transfix", "USD") - nav) <= epsilon)
+            self.assertEqual(num_navs[0], 3)
+
+            # an asset that can't be priced yet keeps the NAV from being cached
+            atxcf.add_source(FixedPriceSource("NAVZ/USD", 0.0))
+            atxcf.set_balance("transfix", "NAVZ", 5.0)
+            self.assertTrue(abs(atxcf.get_portfolio_nav("transfix", "USD") - nav) <= epsilon)
+            self.assertTrue(abs(atxcf.get_portfolio_nav("transfix", "USD") - nav) <= epsilon)
+            self.assertEqual(num_navs[0], 5)
+
+            # neither is it cached while an asset has no route at all
+            atxcf.set_balance("transfix", "NAVZ", 0.0)
+            atxcf.set_balance("transfix", "NAVNR", 5.0)
+            self.assertTrue(abs(atxcf.get_portfolio_nav("transfix", "USD") - nav) <= epsilon)
+            num_navs[0] = 0
+            self.assertTrue(abs(atxcf.get_portfolio_nav("transfix", "USD") - nav) <= epsilon)
+            self.assertTrue(num_navs[0] > 0)
+        finally:
+            portfolio.get_prices = get_prices
+
+
+    @settings_context
+    def test_transfer_user_locks(self, **kwargs):
+        """
+        Test that transfers only wait for transfers involving the same
+        users, and that opposite transfers between two users don't
+        deadlock.
+        """
+        from atxcf import accounts
+        def lock_index(name):
+            return hash(name) % accounts._num_user_locks
+        others = [name for name in ["sheldon", "icky", "scott", "catx_00", "catx_01"]
+                  if lock_index(name) != lock_index("transfix")][:2]
+        users = ["transfix"] + others
+        for user in users:
+            atxcf.add_user(user)
+            atxcf.set_balance(user, "FOO_A", 1000.0)
+
+        def transfer_thread(from_user, to_user, num_transfers=1):
+            def _transfer():
+                for i in xrange(num_transfers):
+                    atxcf.transfer(from_user, to_user, "FOO_A", 1.0)
+            t = threading.Thread(target=_transfer)
+            t.daemon = True
+            t.start()
+            return t
+
+        with accounts._locked_users("transfix"):
+            unrelated = transfer_thread(others[0], others[1])
+            unrelated.join(5.0)
+            self.assertFalse(unrelated.is_alive())
+            blocked = transfer_thread(others[0], "transfix")
+            blocked.join(0.2)
+            self.assertTrue(blocked.is_alive())
+        blocked.join(5.0)
+        self.assertFalse(blocked.is_alive())
+
+        threads = [transfer_thread("transfix", others[0], 200),
+                   transfer_thread(others[0], "transfix", 200),
+                   transfer_thread(others[1], "transfix", 100)]
+        for t in threads:
+            t.join(30.0)
+            self.assertFalse(t.is_alive())
+        self.assertEqual(atxcf.get_balance("transfix", "FOO_A"), 1101.0)
+        self.assertEqual(atxcf.get_balance(others[0], "FOO_A"), 998.0)
+        self.assertEqual(atxcf.get_balance(others[1], "FOO_A"), 901.0)
+
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,280 @@
+"""
+Startup and hot path benchmarks for atxcf. They run offline against a
+temporary settings file, pricing only through the Conversions source.
+
+    python test_benchmark.py [-o results.json] [-b baseline.json] [-t 0.25]
+
+Writes the results as JSON. Given a baseline results file, exits with
+status 1 if a benchmark's wall time or object count grew by more than
+the threshold, allowing some more for timing noise.
+
+With --http-replay DIR it also sweeps the prices of every market of
+the exchange sources, serving the HTTP responses recorded in DIR by an
+earlier run with --http-record DIR (the only one that needs network).
+"""
+
+import argparse
+import atexit
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # not on windows
+    resource = None
+
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+# how many conversion markets the benchmark price network knows
+num_conversions = 200
+
+# timer and scheduling noise allowed on top of the threshold, in seconds
+# per measurement and as a fraction of the baseline wall time
+wall_noise = 0.0005
+wall_noise_ratio = 0.25
+
+_import_script = """
+import gc, json, time
+num_objects = len(gc.get_objects())
+start = time.time()
+import %s
+wall = time.time() - start
+try:
+    import resource
+    maxrss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+except ImportError:
+    maxrss_kb = 0
+print json.dumps({"wall": wall,
+                  "objects": len(gc.get_objects()) - num_objects,
+                  "maxrss_kb": maxrss_kb})
+"""
+
+
+def get_maxrss_kb():
+    """
+    Returns the peak RSS of the process in kB, or 0 where it can't be
+    read.
+    """
+    if not resource:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(fn, iterations=1, repeat=3):
+    """
+    Calls fn iterations times, repeat times over. Returns the best wall
+    time per call in seconds, how many more objects the garbage
+    collector tracked after the first pass (python 2 has no allocation
+    counter) and the peak RSS of the process in kB.
+    """
+    best = None
+    objects = None
+    for i in xrange(repeat):
+        gc.collect()
+        num_objects = len(gc.get_objects())
+        start = time.time()
+        for j in xrange(iterations):
+            fn()
+        wall = (time.time() - start) / iterations
+        if objects is None:
+            objects = len(gc.get_objects()) - num_objects
+        if best is None or wall < best:
+            best = wall
+    return {"wall": best, "objects": objects, "maxrss_kb": get_maxrss_kb(),
+            "iterations": iterations}
+
+
+def measure_import(module_name, settings_filename, repeat=3):
+    """
+    Measures importing module_name in a fresh interpreter.
+    """
+    env = dict(os.environ)
+    env["ATXCF_SETTINGS"] = settings_filename
+    env["PYTHONPATH"] = os.pathsep.join([_here, env.get("PYTHONPATH", "")])
+    best = None
+    for i in xrange(repeat):
+        output = subprocess.check_output([sys.executable, "-c",
+                                          _import_script % module_name], env=env)
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result["wall"] < best["wall"]:
+            best = result
+    best["iterations"] = 1
+    return best
+
+
+def init_benchmark_settings(settings_filename):
+    """
+    Points atxcf at settings_filename and configures it so that only
+    the Conversions source is used and nothing goes over the network.
+    """
+    import atxcf
+    atxcf.set_settings_filename(settings_filename)
+    atxcf.clear_settings()
+    atxcf.set_option("price_sources", ["Conversions"])
+    atxcf.set_option("using_memcached", False)
+    atxcf.set_conversions(dict(("BENCH%d/BENCH" % i, float(i + 1))
+                               for i in xrange(num_conversions)))
+    atxcf.write_settings()
+
+
+def price_sweep():
+    """
+    Prices every market known by a new price network with the default
+    price sources.
+    """
+    import atxcf
+    pn = atxcf.PriceNetwork()
+    prices = {}
+    for mkt in pn.get_markets():
+        from_asset, to_asset = mkt.split("/", 1)
+        try:
+            prices[mkt] = pn.get_price(from_asset, to_asset)
+        except atxcf.PriceSourceError:
+            pass
+    return prices
+
+
+def run_benchmarks(iterations=1000, repeat=5, http_mode=None, http_dir=None,
+                   http_latency_scale=1.0, http_error_rate=0.0):
+    """
+    Runs every benchmark and returns a dict of results by name. Call it
+    before atxcf is loaded, so the cache files are bound to the
+    temporary settings file rather than the default one. With
+    http_mode record or replay, also runs a price sweep recording or
+    replaying the responses in http_dir. Replayed responses take
+    http_latency_scale times as long as they did when recorded and fail
+    with probability http_error_rate.
+    """
+    # atexit handlers run last registered first, so registering this
+    # before atxcf is loaded removes the files after atxcf writes them
+    tmp_dir = tempfile.mkdtemp(prefix="atxcf_benchmark_")
+    atexit.register(shutil.rmtree, tmp_dir, True)
+    settings_filename = os.path.join(tmp_dir, "atxcf.json")
+    os.environ["ATXCF_SETTINGS"] = settings_filename
+    init_benchmark_settings(settings_filename)
+
+    import atxcf
+    results = {}
+    results["import"] = measure_import("atxcf", settings_filename, repeat)
+    results["import_cmd"] = measure_import("atxcf.cmd", settings_filename, repeat)
+
+    def new_price_network():
+        pn = atxcf.PriceNetwork()
+        pn.get_shortest_path("BENCH0", "BENCH")
+        return pn
+    results["price_network"] = measure(new_price_network, 10, repeat)
+
+    pn = new_price_network()
+    pn.get_price("BENCH0", "BENCH")
+    results["get_price_hit"] = measure(lambda: pn.get_price("BENCH0", "BENCH"),
+                                       iterations, repeat)
+
+    # every call prices a market that hasn't been priced yet
+    num_misses = min(iterations, (num_conversions - 1) // repeat)
+    unpriced = iter(xrange(1, num_conversions))
+    results["get_price_miss"] = measure(lambda: pn.get_price("BENCH%d" % next(unpriced), "BENCH"),
+                                        num_misses, repeat)
+
+    atxcf.add_user("bench_from")
+    atxcf.add_user("bench_to")
+    atxcf.set_balance("bench_from", "BTC", float(iterations * repeat))
+    results["transfer"] = measure(lambda: atxcf.transfer("bench_from", "bench_to", "BTC", 1.0),
+                                  iterations, repeat)
+
+    if http_mode:
+        atxcf.remove_option("price_sources")
+        atxcf.set_option("http_transport_mode", http_mode)
+        atxcf.set_option("http_recordings_dir", os.path.abspath(http_dir))
+        atxcf.set_option("http_replay_latency_scale", http_latency_scale)
+        atxcf.set_option("http_replay_error_rate", http_error_rate)
+        # later sweeps would be served by the price cache
+        results["price_sweep"] = measure(price_sweep, 1, 1)
+        atxcf.set_option("http_transport_mode", "live")
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    """
+    Returns a list of (benchmark, measurement, baseline value, value)
+    tuples for the measurements in results that are more than threshold
+    (a fraction) worse than in baseline.
+    """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        if not name in baseline:
+            continue
+        for key in ("wall", "objects"):
+            base_value = baseline[name].get(key)
+            if base_value is None:
+                continue
+            # allow for some noise either way
+            if key == "wall":
+                allowed = (base_value * (1.0 + threshold + wall_noise_ratio) +
+                           wall_noise / result["iterations"])
+            else:
+                allowed = max(base_value * (1.0 + threshold), base_value + 16)
+            if result[key] > allowed:
+                regressions.append((name, key, base_value, result[key]))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="atxcf benchmarks")
+    parser.add_argument("-o", "--output", default="benchmark_results.json",
+                        help="file to write the results to")
+    parser.add_argument("-b", "--baseline",
+                        help="results file to compare against")
+    parser.add_argument("-t", "--threshold", type=float, default=0.25,
+                        help="allowed regression as a fraction of the baseline")
+    parser.add_argument("-n", "--iterations", type=int, default=1000)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--http-record", metavar="DIR",
+                        help="sweep prices from the exchanges, recording the responses to DIR")
+    parser.add_argument("--http-replay", metavar="DIR",
+                        help="sweep prices replaying the responses recorded to DIR")
+    parser.add_argument("--http-latency-scale", type=float, default=1.0,
+                        help="fraction of the recorded response times to replay")
+    parser.add_argument("--http-error-rate", type=float, default=0.0,
+                        help="probability that a replayed request fails")
+    args = parser.parse_args(argv)
+
+    http_mode = None
+    http_dir = None
+    if args.http_record:
+        http_mode, http_dir = "record", args.http_record
+    elif args.http_replay:
+        http_mode, http_dir = "replay", args.http_replay
+    results = run_benchmarks(args.iterations, args.repeat, http_mode, http_dir,
+                             args.http_latency_scale, args.http_error_rate)
+    with open(args.output, "w") as f:
+        json.dump({"python": platform.python_version(),
+                   "time": time.time(),
+                   "benchmarks": results}, f, sort_keys=True, indent=4,
+                  separators=(',', ': '))
+    for name, result in sorted(results.iteritems()):
+        print "%-16s %12.6fs %10d objects %10d kB" % (name, result["wall"],
+                                                      result["objects"],
+                                                      result["maxrss_kb"])
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["benchmarks"]
+        regressions = find_regressions(results, baseline, args.threshold)
+        for name, key, base_value, value in regressions:
+            print "REGRESSION %s %s: %s -> %s" % (name, key, base_value, value)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))